@@ -3,6 +3,7 @@
 
 #define GRID_WIDTH 20
 #define GRID_HEIGHT 20
+#define MAX_CHARGES 256
 
 // Electric charges: (x, y, q)
 typedef struct {
@@ -11,7 +12,16 @@ typedef struct {
   float q;
 } Charge;
 
-Charge charges[2];
+// Live charges are packed into charges[0..n_charges); deleting one moves the last into its slot.
+// IDs stay stable across deletions: charge_slot[id] is the slot of charge id (-1 once deleted)
+// and charge_ids[slot] the ID in a slot. Freed IDs are reused.
+Charge charges[MAX_CHARGES];
+int n_charges = 0;
+int charge_ids[MAX_CHARGES];
+int charge_slot[MAX_CHARGES];
+int next_id = 0;  // IDs below next_id have been handed out
+int free_ids[MAX_CHARGES];
+int n_free = 0;
 
 // Output field: size = GRID_WIDTH * GRID_HEIGHT * 2 (x, y)
 float field[GRID_WIDTH * GRID_HEIGHT * 2];
@@ -27,7 +37,7 @@ float* compute_field() {
       float fx = 0.0f;
       float fy = 0.0f;
 
-      for (int c = 0; c < 2; c++) {
+      for (int c = 0; c < n_charges; c++) {
         float dx = px - charges[c].x;
         float dy = py - charges[c].y;
         float r2 = dx * dx + dy * dy + 1e-4;  // Avoid division by zero
@@ -46,13 +56,65 @@ float* compute_field() {
   return field;
 }
 
+// Adds a charge; returns its ID, or -1 when MAX_CHARGES are live
 EMSCRIPTEN_KEEPALIVE
-void set_charges(float x1, float y1, float q1, float x2, float y2, float q2) {
-  charges[0].x = x1;
-  charges[0].y = y1;
-  charges[0].q = q1;
+int add_charge(float x, float y, float q) {
+  if (n_charges == MAX_CHARGES) {
+    return -1;
+  }
+  int id = n_free > 0 ? free_ids[--n_free] : next_id++;
+  charges[n_charges].x = x;
+  charges[n_charges].y = y;
+  charges[n_charges].q = q;
+  charge_ids[n_charges] = id;
+  charge_slot[id] = n_charges++;
+  return id;
+}
+
+static int slot_of(int id) {
+  return (id >= 0 && id < next_id) ? charge_slot[id] : -1;
+}
+
+// Returns 0, or -1 for an unknown ID
+EMSCRIPTEN_KEEPALIVE
+int update_charge(int id, float x, float y, float q) {
+  int slot = slot_of(id);
+  if (slot < 0) {
+    return -1;
+  }
+  charges[slot].x = x;
+  charges[slot].y = y;
+  charges[slot].q = q;
+  return 0;
+}
 
-  charges[1].x = x2;
-  charges[1].y = y2;
-  charges[1].q = q2;
+// Returns 0, or -1 for an unknown ID
+EMSCRIPTEN_KEEPALIVE
+int remove_charge(int id) {
+  int slot = slot_of(id);
+  if (slot < 0) {
+    return -1;
+  }
+  int last = --n_charges;
+  charges[slot] = charges[last];
+  charge_ids[slot] = charge_ids[last];
+  charge_slot[charge_ids[slot]] = slot;
+  charge_slot[id] = -1;
+  free_ids[n_free++] = id;
+  return 0;
+}
+
+EMSCRIPTEN_KEEPALIVE
+int get_charge_count() {
+  return n_charges;
+}
+
+// Replaces all charges with these two (IDs 0 and 1)
+EMSCRIPTEN_KEEPALIVE
+void set_charges(float x1, float y1, float q1, float x2, float y2, float q2) {
+  n_charges = 0;
+  next_id = 0;
+  n_free = 0;
+  add_charge(x1, y1, q1);
+  add_charge(x2, y2, q2);
 }
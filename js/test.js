@@ -18,7 +18,6 @@ const startApp = async () => {
     let coulombclass;
     let coulombclassInstance;
     let paused = false;
-    let particles = [];
     let particlePaths = [];
 
     // KE-to-Color settings
@@ -30,9 +29,13 @@ const startApp = async () => {
       n_charges: 3,
       charge_strength: 5000,
       charge_radius: 16,
-      particle_radius: 8
+      particle_radius: 8,
+      export: 'buffer'   // update() returns the reused float32 frame buffer
     };
 
+    // Must match FRAME_HEADER in python/test.py (slot 0 is the frame counter)
+    const FRAME_HEADER = 1;
+
     function getKeColor(ke, alpha = 150) {
       let cKe = sketch.constrain(ke, minKe, maxKe);
       let hue = sketch.map(cKe, minKe, maxKe, lowKeHue, highKeHue);
@@ -66,60 +69,71 @@ const startApp = async () => {
 
     sketch.draw = function () {
       this.background(0, 0, 15);
-      if (!paused && coulombclassInstance) {
+      if (!coulombclassInstance) return;
+
+      // Zero-copy views into the Python float32 buffers; released in the finally below
+      let frameProxy, frameBuf, chargeProxy, chargeBuf;
+      try {
         try {
           const dt = sketch.deltaTime / 1000;
-          let proxy = coulombclassInstance.update(dt);
-          particles = proxy.toJs({ create_proxies: false, depth: 2 });
-          proxy.destroy();
-
-          particles.forEach((p, i) => {
-            if (Array.isArray(p) && p.length === 3) {
-              const [x, y, ke] = p;
-              if (!isNaN(x) && !isNaN(y) && !isNaN(ke)) {
-                particlePaths[i].push({ pos: sketch.createVector(x, y), ke });
-              }
-            }
-          });
+          frameProxy = paused ? coulombclassInstance.get_frame() : coulombclassInstance.update(dt);
+          frameBuf = frameProxy.getBuffer('f32');
+          chargeProxy = coulombclassInstance.get_charges_buffer();
+          chargeBuf = chargeProxy.getBuffer('f32');
         } catch (err) {
           console.error("Simulation update error:", err);
           paused = true;
+          return;
+        }
+        const frame = frameBuf.data;
+        const nParticles = (frame.length - FRAME_HEADER) / 3;
+
+        if (!paused) {
+          for (let i = 0; i < nParticles; i++) {
+            const o = FRAME_HEADER + 3 * i;
+            const x = frame[o], y = frame[o + 1], ke = frame[o + 2];
+            if (!isNaN(x) && !isNaN(y) && !isNaN(ke)) {
+              particlePaths[i].push({ pos: sketch.createVector(x, y), ke });
+            }
+          }
         }
-      }
 
-      // Draw charges
-      if (coulombclassInstance) {
-        let charges = coulombclassInstance.get_charges().toJs({ depth: 2 });
-        charges.forEach(([x, y, q]) => {
-          sketch.fill(q > 0 ? sketch.color(0,100,100) : sketch.color(240,100,100));
+        // Draw charges
+        const charges = chargeBuf.data;
+        for (let o = 0; o < charges.length; o += 3) {
+          sketch.fill(charges[o + 2] > 0 ? sketch.color(0,100,100) : sketch.color(240,100,100));
           sketch.noStroke();
-          sketch.ellipse(x, y, simulation_params.charge_radius, simulation_params.charge_radius);
-        });
-      }
+          sketch.ellipse(charges[o], charges[o + 1], simulation_params.charge_radius, simulation_params.charge_radius);
+        }
 
-      // Draw paths
-      sketch.noFill();
-      sketch.strokeWeight(1.5);
-      particlePaths.forEach(path => {
-        for (let j = 1; j < path.length; j++) {
-          const prev = path[j-1], curr = path[j];
-          if (prev && curr) {
-            sketch.stroke(getKeColor(curr.ke, 150));
-            sketch.line(prev.pos.x, prev.pos.y, curr.pos.x, curr.pos.y);
+        // Draw paths
+        sketch.noFill();
+        sketch.strokeWeight(1.5);
+        particlePaths.forEach(path => {
+          for (let j = 1; j < path.length; j++) {
+            const prev = path[j-1], curr = path[j];
+            if (prev && curr) {
+              sketch.stroke(getKeColor(curr.ke, 150));
+              sketch.line(prev.pos.x, prev.pos.y, curr.pos.x, curr.pos.y);
+            }
           }
-        }
-      });
-
-      // Draw particles
-      sketch.noStroke();
-      particles.forEach(p => {
-        if (Array.isArray(p) && p.length === 3) {
-          const [x, y, ke] = p;
-          let col = getKeColor(ke, 200);
+        });
+
+        // Draw particles
+        sketch.noStroke();
+        for (let i = 0; i < nParticles; i++) {
+          const o = FRAME_HEADER + 3 * i;
+          let col = getKeColor(frame[o + 2], 200);
           sketch.fill(sketch.hue(col), sketch.saturation(col), 100);
-          sketch.ellipse(x, y, simulation_params.particle_radius, simulation_params.particle_radius);
+          sketch.ellipse(frame[o], frame[o + 1], simulation_params.particle_radius, simulation_params.particle_radius);
         }
-      });
+
+      } finally {
+        if (frameBuf) frameBuf.release();
+        if (frameProxy) frameProxy.destroy();
+        if (chargeBuf) chargeBuf.release();
+        if (chargeProxy) chargeProxy.destroy();
+      }
     };
   });
 };
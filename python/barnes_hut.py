@@ -0,0 +1,250 @@
+"""
+Array-backed Barnes-Hut tree (quadtree in 2D, octree in 3D) for mutual Coulomb forces
+between charged particles, O(N log N) instead of the O(N^2) direct sum.
+
+Nodes live in flat NumPy arrays indexed by node id (root = 0). Each node keeps its
+charge moments about its |q|-weighted centre: monopole and dipole always (the dipole
+only vanishes when all charges share a sign), plus an optional traceless quadrupole.
+Both build and traversal are vectorized over particles.
+
+The potential is the 3D 1/r law (field ~ 1/r^2) in either dimension, matching the
+Coulomb classes in main.py / test.py.
+"""
+import numpy as np
+
+
+def _cumsum0(a):
+    """Cumulative sum along axis 0 with a leading zero row, for segment sums c[end] - c[start]."""
+    out = np.zeros((a.shape[0] + 1,) + a.shape[1:], dtype=np.float64)
+    np.cumsum(a, axis=0, out=out[1:])
+    return out
+
+
+class BarnesHutTree:
+    def __init__(self, positions, charges, leaf_size=8, quadrupole=False, max_depth=None):
+        """
+        positions: (N, D) array with D = 2 (quadtree) or 3 (octree).
+        charges:   (N,) particle charges.
+        leaf_size: nodes with more particles than this are subdivided.
+        quadrupole: also store quadrupole moments (more accurate at the same theta).
+        max_depth: subdivision limit; defaults to the key resolution (31 levels in 2D, 21 in 3D).
+        """
+        pos = np.asarray(positions, dtype=np.float64)
+        q = np.asarray(charges, dtype=np.float64).reshape(-1)
+        n, dim = pos.shape
+        if dim not in (2, 3):
+            raise ValueError(f"BarnesHutTree supports 2D or 3D positions, got D={dim}")
+        if q.shape[0] != n:
+            raise ValueError("positions and charges must have the same length")
+
+        self.dim = dim
+        self.n = n
+        self.leaf_size = max(1, int(leaf_size))
+        self.quadrupole = bool(quadrupole)
+        self.n_children = 1 << dim
+        levels = max_depth if max_depth is not None else (31 if dim == 2 else 21)
+
+        # --- Root cube and Morton (Z-order) keys ---
+        lo = pos.min(axis=0) if n else np.zeros(dim)
+        side = float((pos.max(axis=0) - lo).max()) if n else 1.0
+        side = side * (1.0 + 1e-9) if side > 0 else 1.0
+        cells = 1 << levels
+        ic = np.minimum(((pos - lo) / side * cells).astype(np.uint64), np.uint64(cells - 1))
+        keys = np.zeros(n, dtype=np.uint64)
+        for b in range(levels):
+            for a in range(dim):
+                keys |= ((ic[:, a] >> np.uint64(b)) & np.uint64(1)) << np.uint64(b * dim + a)
+
+        self.order = np.argsort(keys, kind='stable')
+        keys = keys[self.order]
+        self.pos = pos[self.order]
+        self.q = q[self.order]
+
+        # --- Level-by-level subdivision (particles of a node are contiguous in key order) ---
+        start = [np.zeros(1, dtype=np.int64)]
+        count = [np.array([n], dtype=np.int64)]
+        box_center = [(lo + side / 2.0)[None, :]]
+        half = [np.array([side / 2.0])]
+        parent = [np.array([-1], dtype=np.int64)]
+        octant = [np.zeros(1, dtype=np.int64)]
+
+        pnode = np.zeros(n, dtype=np.int64)   # Node id containing each particle at the current level
+        active = np.full(n, n > self.leaf_size)
+        level_first, n_nodes = 0, 1
+        bits = (np.arange(self.n_children)[:, None] >> np.arange(dim)) & 1 # Octant -> per-axis bit
+
+        for level in range(1, levels + 1):
+            idx = np.flatnonzero(active)
+            if idx.size == 0:
+                break
+            prefix = keys[idx] >> np.uint64(dim * (levels - level))
+            is_first = np.empty(idx.size, dtype=bool)
+            is_first[0] = True
+            np.not_equal(prefix[1:], prefix[:-1], out=is_first[1:])
+            first_pos = np.flatnonzero(is_first)
+
+            lvl_start = idx[first_pos]
+            lvl_count = np.diff(np.append(first_pos, idx.size))
+            lvl_parent = pnode[lvl_start]
+            lvl_octant = (prefix[first_pos] & np.uint64(self.n_children - 1)).astype(np.int64)
+            local_parent = lvl_parent - level_first
+            lvl_half = half[-1][local_parent] / 2.0
+            lvl_center = box_center[-1][local_parent] + (bits[lvl_octant] * 2 - 1) * lvl_half[:, None]
+
+            pnode[idx] = n_nodes + np.cumsum(is_first) - 1
+            start.append(lvl_start)
+            count.append(lvl_count)
+            box_center.append(lvl_center)
+            half.append(lvl_half)
+            parent.append(lvl_parent)
+            octant.append(lvl_octant)
+
+            split = lvl_count > self.leaf_size
+            active[idx] = split[pnode[idx] - n_nodes]
+            level_first, n_nodes = n_nodes, n_nodes + lvl_start.size
+
+        self.start = np.concatenate(start)
+        self.count = np.concatenate(count)
+        self.box_center = np.concatenate(box_center)
+        self.half = np.concatenate(half)
+        self.children = np.full((n_nodes, self.n_children), -1, dtype=np.int64)
+        self.children[np.concatenate(parent)[1:], np.concatenate(octant)[1:]] = np.arange(1, n_nodes)
+        self.is_leaf = (self.children < 0).all(axis=1)
+        self.n_nodes = n_nodes
+
+        self._compute_moments(lo + side / 2.0)
+
+    def _compute_moments(self, origin):
+        """Segment sums over the key-sorted particles give every node's moments at once."""
+        x = self.pos - origin # Relative to the root centre to limit cancellation
+        q = self.q
+        aq = np.abs(q)
+        s, e = self.start, self.start + self.count
+
+        def seg(values):
+            c = _cumsum0(values)
+            return c[e] - c[s]
+
+        total_q = seg(q)
+        total_aq = seg(aq)
+        qx = seg(q[:, None] * x)
+        aqx = seg(aq[:, None] * x)
+
+        has_charge = total_aq > 0
+        com = np.where(has_charge[:, None], aqx / np.where(has_charge, total_aq, 1.0)[:, None],
+                       self.box_center - origin)
+
+        self.monopole = total_q
+        self.dipole = qx - total_q[:, None] * com
+        self.center = com + origin
+
+        if self.quadrupole:
+            qxx = seg(q[:, None, None] * x[:, :, None] * x[:, None, :])
+            # Second moment about the expansion centre: sum q d d^T, with d = x - com
+            m2 = (qxx - com[:, :, None] * qx[:, None, :] - qx[:, :, None] * com[:, None, :]
+                  + total_q[:, None, None] * com[:, :, None] * com[:, None, :])
+            trace = np.trace(m2, axis1=1, axis2=2)
+            self.quad = 3.0 * m2 - trace[:, None, None] * np.eye(self.dim)
+
+    def _multipole_field(self, targets, nodes):
+        """Far-field E (per unit k) at particles `targets` from the expansions of `nodes`."""
+        r = self.pos[targets] - self.center[nodes]
+        r2 = np.einsum('ij,ij->i', r, r)
+        inv_r = 1.0 / np.sqrt(r2)
+        inv_r3 = inv_r / r2
+        inv_r5 = inv_r3 / r2
+
+        p = self.dipole[nodes]
+        p_dot_r = np.einsum('ij,ij->i', p, r)
+        e = r * (self.monopole[nodes] * inv_r3 + 3.0 * p_dot_r * inv_r5)[:, None] - p * inv_r3[:, None]
+
+        if self.quadrupole:
+            qm = self.quad[nodes]
+            qr = np.einsum('ijk,ik->ij', qm, r)
+            rqr = np.einsum('ij,ij->i', r, qr)
+            e += r * (2.5 * rqr * inv_r5 / r2)[:, None] - qr * inv_r5[:, None]
+        return e
+
+    def _leaf_field(self, targets, nodes, eps2):
+        """Exact softened E at `targets` from every particle of leaf `nodes` (self excluded)."""
+        cnt = self.count[nodes]
+        total = int(cnt.sum())
+        tgt = np.repeat(targets, cnt)
+        offsets = np.arange(total) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+        src = np.repeat(self.start[nodes], cnt) + offsets
+        keep = src != tgt
+        tgt, src = tgt[keep], src[keep]
+
+        r = self.pos[tgt] - self.pos[src]
+        r2 = np.einsum('ij,ij->i', r, r) + eps2
+        return tgt, r * (self.q[src] / (r2 * np.sqrt(r2)))[:, None]
+
+    def field(self, theta=0.5, softening=1e-3, chunk=4096):
+        """
+        Electric field (per unit k) at every particle due to all other particles.
+
+        theta: opening angle; a node is used as a whole when side / distance < theta and
+               the target lies outside it. Smaller is more accurate and slower (0 = direct sum).
+        softening: Plummer softening length for the exact near-field pairs.
+        chunk: particles traversed together; bounds the size of the pair frontier.
+        Returns an (N, D) array in the caller's original particle order.
+        """
+        theta2 = float(theta) ** 2
+        eps2 = float(softening) ** 2
+        side2 = (2.0 * self.half) ** 2
+        out = np.zeros((self.n, self.dim))
+
+        for c0 in range(0, self.n, chunk):
+            c1 = min(c0 + chunk, self.n)
+            acc = np.zeros((c1 - c0, self.dim))
+            tgt = np.arange(c0, c1)
+            node = np.zeros(tgt.size, dtype=np.int64)
+
+            while tgt.size:
+                r = self.pos[tgt] - self.center[node]
+                d2 = np.einsum('ij,ij->i', r, r)
+                outside = (np.abs(self.pos[tgt] - self.box_center[node]) > self.half[node, None]).any(axis=1)
+                accept = outside & (side2[node] < theta2 * d2)
+                if accept.any():
+                    self._accumulate(acc, c0, tgt[accept], self._multipole_field(tgt[accept], node[accept]))
+
+                rest = ~accept
+                leaf = rest & self.is_leaf[node]
+                if leaf.any():
+                    self._accumulate(acc, c0, *self._leaf_field(tgt[leaf], node[leaf], eps2))
+
+                opened = rest & ~self.is_leaf[node]
+                ch = self.children[node[opened]]
+                valid = ch >= 0
+                tgt = np.repeat(tgt[opened], valid.sum(axis=1))
+                node = ch[valid]
+
+            out[c0:c1] = acc
+
+        result = np.empty_like(out)
+        result[self.order] = out
+        return result
+
+    @staticmethod
+    def _accumulate(acc, offset, targets, values):
+        for a in range(acc.shape[1]):
+            acc[:, a] += np.bincount(targets - offset, weights=values[:, a], minlength=acc.shape[0])
+
+
+def tree_field(positions, charges, theta=0.5, softening=1e-3, leaf_size=8, quadrupole=False):
+    """Builds a BarnesHutTree and returns the field (per unit k) at every particle."""
+    tree = BarnesHutTree(positions, charges, leaf_size=leaf_size, quadrupole=quadrupole)
+    return tree.field(theta=theta, softening=softening)
+
+
+def direct_field(positions, charges, softening=1e-3, chunk=1024):
+    """O(N^2) reference: softened field (per unit k) at every particle from all others."""
+    pos = np.asarray(positions, dtype=np.float64)
+    q = np.asarray(charges, dtype=np.float64).reshape(-1)
+    eps2 = float(softening) ** 2
+    out = np.zeros_like(pos)
+    for c0 in range(0, pos.shape[0], chunk):
+        r = pos[c0:c0 + chunk, None, :] - pos[None, :, :]
+        r2 = np.sum(r * r, axis=2) + eps2 # Self pairs have r = 0 and contribute nothing
+        out[c0:c0 + chunk] = np.einsum('ijk,ij->ik', r, q[None, :] / (r2 * np.sqrt(r2)))
+    return out
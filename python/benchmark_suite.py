@@ -0,0 +1,293 @@
+"""
+Scaling benchmark suite for every engine on the CPU, with a stored-baseline regression check.
+
+Sweeps particle count, charge count, interaction radius and grid resolution over test.Coulomb,
+main.Coulomb, CoulombEnsemble and ParticleSimulationTaichi (cpu backend). Each case runs in a
+fresh spawned process so its peak RSS is its own; steps/s, per-step latency percentiles and
+peak RSS go into a JSON results file. A force cross-check first verifies that the engines
+agree on identical inputs.
+
+Run from the python/ directory, e.g.
+    python benchmark_suite.py --preset quick --output results.json
+    python benchmark_suite.py --baseline baseline.json --threshold 0.15
+    python benchmark_suite.py --engines test main --output baseline.json
+Exits with status 1 on a cross-check failure or a regression beyond the threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+import barnes_hut
+import ensemble
+import main
+from benchmarks import _isolated, _peak_rss_bytes, _taichi_sim
+from test import Coulomb
+
+PRESETS = {
+    'quick': {'particles': (1_000, 10_000), 'charges': (3, 30), 'radii': (0.4,), 'resolutions': (64,),
+              'taichi_particles': (10_000,), 'min_time': 0.3, 'max_steps': 100},
+    'full': {'particles': (1_000, 10_000, 100_000), 'charges': (3, 30, 300), 'radii': (0.4, 0.2, 0.1),
+             'resolutions': (64, 256, 1024), 'taichi_particles': (10_000, 100_000, 400_000),
+             'min_time': 2.0, 'max_steps': 500},
+}
+ENGINES = ('test', 'main', 'ensemble', 'taichi')
+
+
+def build_cases(preset, engines=ENGINES):
+    """Benchmark cases as {'id', 'engine', 'params'} dicts; ids are stable across runs for baseline matching."""
+    p = PRESETS[preset]
+    cases = []
+
+    def add(engine, params, **tags):
+        label = ",".join(f"{k}={v}" for k, v in tags.items())
+        cases.append({'id': f"{engine}[{label}]", 'engine': engine, 'params': params})
+
+    for n in p['particles']:
+        for m in p['charges']:
+            if 'test' in engines:
+                add('test', {'n_particles': n, 'n_charges': m, 'export': 'buffer'}, n=n, m=m, field='exact')
+                for res in p['resolutions']:
+                    add('test', {'n_particles': n, 'n_charges': m, 'export': 'buffer', 'field_mode': 'lattice',
+                                 'lattice_resolution': res}, n=n, m=m, field='lattice', res=res)
+            if 'main' in engines:
+                add('main', {'n_particles': n, 'n_charges': m}, n=n, m=m, force='direct')
+                add('main', {'n_particles': n, 'n_charges': m, 'force_mode': 'tiled'}, n=n, m=m, force='tiled')
+        if 'main' in engines and n <= 10_000:
+            add('main', {'n_particles': n, 'n_charges': 0, 'particle_interactions': 'tree'}, n=n, mutual='tree')
+        if 'ensemble' in engines:
+            add('ensemble', {'n_members': 16, 'n_particles': max(n // 16, 1), 'n_charges': p['charges'][0]},
+                n=n, members=16)
+    if 'taichi' in engines:
+        for n in p['taichi_particles']:
+            for radius in p['radii']:
+                for grid in ('dense', 'hash'):
+                    add('taichi', {'num_particles': n, 'interaction_radius': radius, 'particle_radius': radius / 4,
+                                   'grid': grid}, n=n, radius=radius, grid=grid)
+                add('taichi', {'num_particles': n, 'interaction_radius': radius, 'particle_radius': radius / 4,
+                               'neighbor_list': True, 'skin': radius / 4, 'max_neighbors': 128},
+                    n=n, radius=radius, grid='dense', lists=True)
+    return cases
+
+
+def _make_stepper(engine, params):
+    """(step, sync) callables for one case; sync waits for asynchronous device work."""
+    dt = 1e-3
+    if engine == 'test':
+        sim = Coulomb(800, 600, params)
+        return (lambda: sim.update(dt)), None
+    if engine == 'main':
+        sim = main.Coulomb(800, 600, params)
+        return (lambda: sim.update(dt)), None
+    if engine == 'ensemble':
+        members = [Coulomb(800, 600, {'n_particles': params['n_particles'], 'n_charges': params['n_charges']})
+                   for _ in range(params['n_members'])]
+        ens = ensemble.CoulombEnsemble(members)
+        return (lambda: ens.update(dt)), None
+    import taichi as ti
+    sim = _taichi_sim(params)
+    return (lambda: sim.step(0.005)), ti.sync
+
+
+def run_case(engine, params, min_time, max_steps, warmup=2):
+    """Per-step latencies of one case until min_time has elapsed or max_steps were taken."""
+    step, sync = _make_stepper(engine, params)
+    for _ in range(warmup): # Compilation, lattice build, workspace allocation
+        step()
+    if sync:
+        sync()
+    latencies = []
+    start = time.perf_counter()
+    while len(latencies) < max_steps and (len(latencies) < 5 or time.perf_counter() - start < min_time):
+        t0 = time.perf_counter()
+        step()
+        if sync:
+            sync()
+        latencies.append(time.perf_counter() - t0)
+    lat = np.array(latencies)
+    p50, p95, p99 = np.percentile(lat, (50, 95, 99))
+    return {'steps': int(lat.size), 'steps_per_s': float(lat.size / lat.sum()), 'median_steps_per_s': float(1.0 / p50),
+            'latency_ms': {'mean': float(lat.mean() * 1e3), 'p50': float(p50 * 1e3), 'p95': float(p95 * 1e3),
+                           'p99': float(p99 * 1e3), 'max': float(lat.max() * 1e3)},
+            'peak_rss_mib': _peak_rss_bytes() / 1024**2}
+
+
+# --- Force cross-check ---
+
+def _rel_max(approx, exact):
+    return float(np.abs(approx - exact).max() / max(np.abs(exact).max(), 1e-30))
+
+
+def _taichi_reference_forces(sim):
+    """O(N^2) NumPy version of gravity + pair_force within interaction_radius, in storage order."""
+    pos = sim.positions.to_numpy().astype(np.float64)
+    mass = sim.mass.to_numpy().astype(np.float64)
+    radius, contact = float(sim.interaction_radius[None]), 2.0 * float(sim.particle_radius[None])
+    forces = np.asarray(sim.gravity[None].to_list()) * mass[:, None]
+    for p0 in range(0, pos.shape[0], 512):
+        d = pos[None, :, :] - pos[p0:p0 + 512, None, :]               # neighbour - particle
+        dist_sq = np.sum(d**2, axis=2)
+        dist = np.sqrt(dist_sq)
+        hit = (dist_sq < radius**2) & (dist_sq > 1e-9) & (dist_sq < contact**2)
+        overlap = np.where(hit, contact - dist, 0.0)
+        unit = d / np.where(hit, dist, 1.0)[:, :, None]
+        forces[p0:p0 + 512] -= np.sum(unit * (sim.collision_k * overlap * 0.5)[:, :, None], axis=1)
+    return forces
+
+
+def cross_check(include_taichi=True, n=2_000, m=25):
+    """Runs every engine pair on identical inputs; returns [{'check', 'error', 'tolerance', 'ok'}]."""
+    rng = np.random.default_rng(0)
+    xy = rng.uniform([0, 0], [800, 600], size=(n, 2))
+    charges = np.column_stack([rng.uniform([0, 0], [800, 600], size=(m, 2)), rng.choice([-1.0, 1.0], m)])
+    checks = []
+
+    def check(name, approx, exact, tol):
+        err = _rel_max(np.asarray(approx, dtype=np.float64), np.asarray(exact, dtype=np.float64))
+        checks.append({'check': name, 'error': err, 'tolerance': tol, 'ok': bool(err <= tol)})
+
+    t = Coulomb(800, 600, {'n_particles': n, 'n_charges': m, 'dtype': 'float64', 'charge_strength': 1000.0})
+    t.charges[:] = charges
+    t.particles[:, :2] = xy
+    exact = t.field_at(xy)
+    mc = main.Coulomb(800, 600, {'n_particles': n, 'n_charges': m, 'charge_strength': 1000.0, 'tile_bytes': 64 * 1024})
+    mc.charges[:] = charges
+    mc.particles[:] = xy
+    # main.py's force points the other way for the same charge sign (q > 0 attracts there)
+    check('main.direct vs test.exact', -mc._pair_force(mc.particles, mc.charges), exact, 1e-6)
+    check('main.tiled vs main.direct', mc._tiled_force(mc.particles, mc.charges), mc._pair_force(mc.particles, mc.charges), 1e-12)
+    mc_pre = main.Coulomb(800, 600, {'n_particles': n, 'n_charges': m, 'charge_strength': 1000.0, 'preallocate': True,
+                                     'force_mode': 'tiled', 'tile_bytes': 64 * 1024})
+    mc_pre.charges[:] = charges
+    mc_pre.particles[:] = xy
+    check('main.preallocated vs main.direct', mc_pre._force_inplace(), mc._pair_force(mc.particles, mc.charges), 1e-12)
+
+    t_pre = Coulomb(800, 600, {'n_particles': n, 'n_charges': m, 'dtype': 'float64', 'charge_strength': 1000.0,
+                               'preallocate': True})
+    t_pre.charges[:] = charges
+    t_pre.particles[:, :2] = xy
+    t_pre._allocate_workspace()
+    check('test.preallocated vs test.exact', t_pre._field_inplace(t_pre._ws), exact, 1e-12)
+    # The lattice is checked away from the charges, where the field is smooth enough to interpolate
+    far = np.min(np.linalg.norm(xy[:, None, :] - charges[None, :, :2], axis=2), axis=1) > 40
+    t_lat = Coulomb(800, 600, {'n_particles': n, 'n_charges': m, 'dtype': 'float64', 'charge_strength': 1000.0,
+                               'field_mode': 'lattice', 'lattice_resolution': 512, 'interpolation': 'bicubic'})
+    t_lat.charges[:] = charges
+    check('test.lattice vs test.exact (> 40 from charges)', t_lat.lattice_field(xy[far]), exact[far], 1e-2)
+
+    members = [Coulomb(800, 600, {'n_particles': n, 'n_charges': m, 'dtype': 'float64', 'charge_strength': 1000.0})]
+    members[0].charges[:] = charges
+    members[0].particles[:, :2] = xy
+    check('ensemble vs test.exact', ensemble.CoulombEnsemble(members).field()[0], exact, 1e-12)
+
+    q = rng.choice([-1.0, 1.0], n)
+    direct = barnes_hut.direct_field(xy, q)
+    check('barnes_hut.tree(theta=0.3, quadrupole) vs direct', barnes_hut.tree_field(xy, q, theta=0.3, quadrupole=True),
+          direct, 1e-2)
+
+    if include_taichi:
+        base = {'num_particles': n, 'domain_size': [10.0, 10.0, 10.0], 'interaction_radius': 0.4,
+                'particle_radius': 0.15, 'gravity': [0, -2.0, 0]}
+        grid = _taichi_sim(base)
+        grid.update_grid()
+        grid.calculate_forces()
+        reference = _taichi_reference_forces(grid)
+        check('taichi.grid vs numpy reference', grid.forces.to_numpy(), reference, 1e-4)
+        positions = grid.positions.to_numpy()
+        for name, params in (('hash', {'grid': 'hash'}), ('neighbor_list', {'neighbor_list': True}),
+                             ('neighbor_list half_shell', {'neighbor_list': True, 'half_shell': True}),
+                             # 8 slots for the occupied cells: most share a slot, so collisions are exercised
+                             ('hash neighbor_list half_shell', {'grid': 'hash', 'hash_table_size': 8,
+                                                                'neighbor_list': True, 'half_shell': True})):
+            sim = _taichi_sim({**base, **params, 'max_neighbors': 128})
+            sim.positions.from_numpy(positions)
+            if sim.neighbor_list:
+                sim.update_neighbor_list()
+                sim.calculate_forces_neighbor_list()
+            else:
+                sim.update_grid()
+                sim.calculate_forces()
+            check(f'taichi.{name} vs numpy reference', sim.forces.to_numpy(), reference, 1e-4)
+    return checks
+
+
+# --- Results and baselines ---
+
+def compare(results, baseline, threshold, metric='median_steps_per_s'):
+    """
+    Rows of (id, baseline, current, ratio, regressed) for cases present in both. The default metric is
+    1 / median step latency, which shrugs off the odd slow step that moves the mean by 10-30% on short runs.
+    """
+    base = {r['id']: r for r in baseline['results']}
+    rows = []
+    for r in results['results']:
+        if r['id'] in base:
+            before, now = base[r['id']][metric], r[metric]
+            ratio = now / before
+            rows.append((r['id'], before, now, ratio, ratio < 1.0 - threshold))
+    return rows
+
+
+def _environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count(), 'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='quick')
+    parser.add_argument('--engines', nargs='*', choices=ENGINES, default=list(ENGINES))
+    parser.add_argument('--output', help="Write results JSON here")
+    parser.add_argument('--baseline', help="Results JSON to compare against")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="Flag cases whose steps/s dropped by more than this fraction (default 0.10)")
+    parser.add_argument('--metric', choices=('median_steps_per_s', 'steps_per_s'), default='median_steps_per_s',
+                        help="Throughput compared against the baseline (default: 1 / median step latency)")
+    parser.add_argument('--filter', default='', help="Only run cases whose id contains this string")
+    parser.add_argument('--skip-check', action='store_true', help="Skip the force cross-check")
+    args = parser.parse_args(argv)
+
+    failed = False
+    checks = []
+    if not args.skip_check:
+        checks = cross_check(include_taichi='taichi' in args.engines)
+        print(f"{'cross-check':>52} {'error':>10} {'tol':>8}")
+        for c in checks:
+            print(f"{c['check']:>52} {c['error']:>10.2e} {c['tolerance']:>8.0e} {'ok' if c['ok'] else 'FAIL'}")
+        failed = not all(c['ok'] for c in checks)
+
+    preset = PRESETS[args.preset]
+    results = {'preset': args.preset, 'environment': _environment(), 'cross_check': checks, 'results': []}
+    print(f"{'case':>60} {'steps/s':>10} {'p50 (ms)':>9} {'p99 (ms)':>9} {'RSS (MiB)':>10}")
+    for case in build_cases(args.preset, args.engines):
+        if args.filter not in case['id']:
+            continue
+        stats = _isolated(run_case, case['engine'], case['params'], preset['min_time'], preset['max_steps'])
+        results['results'].append({**case, **stats})
+        lat = stats['latency_ms']
+        print(f"{case['id']:>60} {stats['steps_per_s']:>10.1f} {lat['p50']:>9.2f} {lat['p99']:>9.2f} "
+              f"{stats['peak_rss_mib']:>10.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline, args.threshold, args.metric)
+        print(f"vs {args.baseline}: {args.metric}, threshold {args.threshold:.0%}")
+        print(f"{'case':>60} {'before':>10} {'now':>10} {'ratio':>7}")
+        for case_id, before, now, ratio, regressed in rows:
+            print(f"{case_id:>60} {before:>10.1f} {now:>10.1f} {ratio:>7.2f}{'  REGRESSION' if regressed else ''}")
+        failed |= any(row[4] for row in rows)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,645 @@
+"""
+Micro-benchmarks for the Python simulation engines.
+
+Run from the python/ directory, e.g.
+    python benchmarks.py frame_export
+"""
+import argparse
+import multiprocessing
+import os
+import pickle
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import barnes_hut
+import ensemble
+import fieldmap
+import main
+import stepper
+import trajectory
+from test import Coulomb
+
+
+def _time_per_call(fn, repeats):
+    """Best-of-three mean wall time (seconds) of fn() over `repeats` calls."""
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        best = min(best, (time.perf_counter() - start) / repeats)
+    return best
+
+
+def _peak_rss_bytes():
+    # ru_maxrss survives fork + exec on Linux, so a spawned worker would report its parent's peak;
+    # VmHWM belongs to the current address space
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # Linux reports KiB
+
+
+def _isolated(fn, *args):
+    """Runs fn(*args) in a fresh spawned process, so peak RSS reflects that run alone."""
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+def bench_frame_export(sizes=(1_000, 10_000, 100_000), repeats=20):
+    """Per-frame export cost of test.Coulomb: list-of-lists vs the reused float32 frame buffer."""
+    print(f"{'particles':>10} {'list (ms)':>12} {'buffer (ms)':>12} {'speedup':>10}")
+    for n in sizes:
+        sim = Coulomb(800, 600, {'n_particles': n, 'n_charges': 3, 'export': 'buffer'})
+        sim.update(0.01)
+
+        t_list = _time_per_call(sim._frame_list, repeats)
+        # The host wraps the buffer through the buffer protocol (PyProxy.getBuffer in Pyodide)
+        t_buf = _time_per_call(lambda: memoryview(sim.get_frame()).cast('B'), repeats)
+        print(f"{n:>10} {t_list*1e3:>12.3f} {t_buf*1e3:>12.4f} {t_list/t_buf:>9.0f}x")
+
+
+def _run_main_force(n, m, force_mode, tile_bytes, steps):
+    sim = main.Coulomb(800, 600, {'n_particles': n, 'n_charges': m,
+                                  'force_mode': force_mode, 'tile_bytes': tile_bytes})
+    start = time.perf_counter()
+    for _ in range(steps):
+        sim.update(1e-4)
+    elapsed = time.perf_counter() - start
+    return n * m * steps / elapsed, _peak_rss_bytes()
+
+
+def bench_tiled_force(n=20_000, m=500, steps=3,
+                      tile_sizes=(16 * 1024, 256 * 1024, 4 * 1024**2, 64 * 1024**2)):
+    """Throughput and peak RSS of main.Coulomb.update, direct vs tiled at several tile budgets."""
+    # Correctness: tiled accumulation must match the single broadcast
+    sim = main.Coulomb(800, 600, {'n_particles': 2_000, 'n_charges': 300, 'tile_bytes': 64 * 1024})
+    direct = sim._pair_force(sim.particles, sim.charges)
+    tiled = sim._tiled_force(sim.particles, sim.charges)
+    print(f"max |tiled - direct| / max |direct| = {np.abs(tiled - direct).max() / np.abs(direct).max():.2e}")
+
+    print(f"N={n} M={m}")
+    print(f"{'mode':>8} {'tile':>10} {'Mpairs/s':>10} {'peak RSS (MiB)':>15}")
+    configs = [('direct', 0)] + [('tiled', t) for t in tile_sizes]
+    for mode, tile in configs:
+        rate, rss = _isolated(_run_main_force, n, m, mode, tile, steps)
+        label = f"{tile // 1024}K" if tile else '-'
+        print(f"{mode:>8} {label:>10} {rate / 1e6:>10.1f} {rss / 1024**2:>15.1f}")
+
+
+def _rel_rms(approx, exact):
+    return np.sqrt(np.sum((approx - exact)**2) / np.sum(exact**2))
+
+
+def bench_barnes_hut(n_accuracy=5_000, thetas=(0.2, 0.3, 0.5, 0.7, 1.0),
+                     sizes=(1_000, 4_000, 16_000, 64_000), direct_limit=16_000):
+    """Barnes-Hut accuracy vs theta and time vs N, against the direct O(N^2) sum."""
+    rng = np.random.default_rng(0)
+    for dim in (2, 3):
+        pos = rng.uniform(0, 100, size=(n_accuracy, dim))
+        q = rng.choice([-1.0, 1.0], size=n_accuracy)
+        exact = barnes_hut.direct_field(pos, q)
+        print(f"{dim}D accuracy, N={n_accuracy} (relative RMS field error)")
+        print(f"{'theta':>6} {'monopole':>10} {'quadrupole':>11}")
+        for theta in thetas:
+            errs = [_rel_rms(barnes_hut.tree_field(pos, q, theta=theta, quadrupole=quad), exact)
+                    for quad in (False, True)]
+            print(f"{theta:>6.2f} {errs[0]:>10.2e} {errs[1]:>11.2e}")
+
+    print("2D time vs N (theta=0.5, monopole)")
+    print(f"{'N':>8} {'tree (s)':>10} {'direct (s)':>11}")
+    for n in sizes:
+        pos = rng.uniform(0, 100, size=(n, 2))
+        q = rng.choice([-1.0, 1.0], size=n)
+        t_tree = _time_per_call(lambda: barnes_hut.tree_field(pos, q, theta=0.5), 1)
+        t_direct = _time_per_call(lambda: barnes_hut.direct_field(pos, q), 1) if n <= direct_limit else float('nan')
+        print(f"{n:>8} {t_tree:>10.3f} {t_direct:>11.3f}")
+
+
+def bench_field_lattice(n=50_000, charge_counts=(3, 100), resolutions=(32, 64, 128, 256, 512), steps=10):
+    """test.Coulomb lattice mode: interpolation error and step time vs resolution, against exact."""
+    for m in charge_counts:
+        exact = Coulomb(800, 600, {'n_particles': n, 'n_charges': m})
+        t_exact = _time_per_call(lambda: exact.update(1e-4), steps)
+        print(f"N={n} M={m}: exact step {t_exact*1e3:.2f} ms")
+        print(f"{'interp':>9} {'res':>5} {'step (ms)':>10} {'median':>10} {'p95':>10} {'p99':>10}")
+        for interp in ('bilinear', 'bicubic'):
+            for res in resolutions:
+                sim = Coulomb(800, 600, {'n_particles': n, 'n_charges': m, 'field_mode': 'lattice',
+                                         'lattice_resolution': res, 'interpolation': interp})
+                sim.charges[:] = exact.charges # Same layout for every resolution
+                err = sim.lattice_error()
+                t = _time_per_call(lambda: sim.update(1e-4), steps)
+                print(f"{interp:>9} {res:>5} {t*1e3:>10.2f} {err['median']:>10.2e} {err['p95']:>10.2e} {err['p99']:>10.2e}")
+
+
+def _taichi_sim(params):
+    """ParticleSimulationTaichi on the cpu backend; Taichi is imported only by these benchmarks."""
+    import octree
+    return octree.ParticleSimulationTaichi({'arch': 'cpu', 'domain_size': [20.0, 20.0, 20.0], **params})
+
+
+def _time_synced(fn, repeats):
+    import taichi as ti
+
+    def call():
+        fn()
+        ti.sync()
+    call() # Compile outside the timed region
+    return _time_per_call(call, repeats)
+
+
+def bench_binning(particle_counts=(10_000, 100_000), radii=(0.4, 0.2, 0.1, 0.05), repeats=5):
+    """ParticleSimulationTaichi.update_grid: full parallel_sort vs counting sort + parallel scan."""
+    print(f"{'particles':>10} {'cells':>9} {'sort (ms)':>10} {'counting (ms)':>14}")
+    for n in particle_counts:
+        for radius in radii:
+            sim = _taichi_sim({'num_particles': n, 'interaction_radius': radius})
+            times = {}
+            for binning in ('sort', 'counting'):
+                sim.binning = binning
+                times[binning] = _time_synced(sim.update_grid, repeats)
+            print(f"{n:>10} {sim.num_grid_cells:>9} {times['sort']*1e3:>10.2f} {times['counting']*1e3:>14.2f}")
+
+
+def bench_neighbor_list(n=50_000, skins=(0.02, 0.05, 0.1, 0.2, 0.4), steps=100, dt=0.005):
+    """Verlet lists vs per-step grid traversal: throughput, rebuild frequency and pairs per step."""
+    import taichi as ti
+
+    base = {'num_particles': n, 'interaction_radius': 0.4, 'particle_radius': 0.15,
+            'initial_velocity_range': 1.0}
+    print(f"N={n}, {steps} steps, dt={dt}")
+    print(f"{'mode':>10} {'skin':>6} {'steps/s':>9} {'rebuild freq':>13} {'pairs/step':>11}")
+
+    sim = _taichi_sim(base)
+    sim.run(2, dt) # Compile
+    start = time.perf_counter()
+    sim.run(steps, dt, stride=steps)
+    ti.sync()
+    print(f"{'grid':>10} {'-':>6} {steps / (time.perf_counter() - start):>9.1f} {'1.00':>13} {'-':>11}")
+
+    for half in (False, True):
+        for skin in skins:
+            sim = _taichi_sim({**base, 'neighbor_list': True, 'half_shell': half, 'skin': skin,
+                               'max_neighbors': 128})
+            sim.run(2, dt)
+            sim.neighbor_counters = {'steps': 0, 'rebuilds': 0, 'pairs_evaluated': 0}
+            start = time.perf_counter()
+            sim.run(steps, dt, stride=steps)
+            ti.sync()
+            rate = steps / (time.perf_counter() - start)
+            stats = sim.neighbor_list_stats()
+            mode = 'half' if half else 'full'
+            print(f"{mode:>10} {skin:>6.2f} {rate:>9.1f} {stats['rebuild_frequency']:>13.2f} {stats['pairs_per_step']:>11.0f}")
+
+
+def bench_sparse_grid(n=50_000, domain_sizes=(20.0, 80.0, 160.0), steps=20, dt=0.005):
+    """Dense vs hashed grid as the domain grows around a fixed cluster of particles."""
+    import taichi as ti
+
+    rng = np.random.default_rng(0)
+    cluster = rng.normal(0.0, 2.0, size=(n, 3)).astype(np.float32) # Same blob in every domain
+    print(f"N={n} clustered particles, interaction radius 0.4")
+    print(f"{'domain':>7} {'grid':>6} {'slots':>10} {'grid MiB':>9} {'step (ms)':>10}")
+    for size in domain_sizes:
+        for grid in ('dense', 'hash'):
+            sim = _taichi_sim({'num_particles': n, 'domain_size': [size] * 3, 'domain_center': [0, 0, 0],
+                               'grid': grid, 'gravity': [0, 0, 0], 'initial_velocity_range': 0.5})
+            sim.positions.from_numpy(cluster)
+            sim.run(1, dt)
+            ti.sync()
+            start = time.perf_counter()
+            sim.run(steps, dt, stride=steps)
+            ti.sync()
+            step_ms = (time.perf_counter() - start) / steps * 1e3
+            grid_bytes = 4 * (sim.num_grid_cells + 1 + sim.num_scan_blocks)
+            print(f"{size:>7.0f} {grid:>6} {sim.num_grid_cells:>10} {grid_bytes / 1024**2:>9.1f} {step_ms:>10.2f}")
+
+
+def bench_reorder(n=400_000, windows=8, steps_per_window=25, dt=0.01, interval=25):
+    """Step time over a long run with and without periodic space-filling-curve reordering (cpu)."""
+    import taichi as ti
+
+    base = {'num_particles': n, 'domain_size': [40.0, 40.0, 40.0], 'domain_center': [0, 0, 0],
+            'gravity': [0, 0, 0], 'initial_velocity_range': 5.0, 'boundary_mode': 'wrap'}
+    print(f"N={n}, step time (ms) per window of {steps_per_window} steps")
+    for mode in (None, 'morton', 'cell'):
+        sim = _taichi_sim({**base, 'reorder': mode or 'morton', 'reorder_interval': interval})
+        # Every run starts from Z-ordered storage; only the reordering modes keep it that way
+        sim.reorder_particles()
+        sim.reorder = mode
+        sim.step(dt)
+        ti.sync()
+        row = []
+        for _ in range(windows):
+            start = time.perf_counter()
+            for _ in range(steps_per_window):
+                sim.step(dt)
+            ti.sync()
+            row.append((time.perf_counter() - start) / steps_per_window * 1e3)
+        print(f"{mode or 'none':>7} " + " ".join(f"{t:7.1f}" for t in row))
+
+
+def _step_transient_bytes(sim, dt, warmup=3, steps=5):
+    """Peak traced allocation above the steady-state baseline over `steps` updates."""
+    for _ in range(warmup):
+        sim.update(dt)
+    tracemalloc.start()
+    sim.update(dt)
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    for _ in range(steps):
+        sim.update(dt)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - base
+
+
+def bench_allocations(particle_counts=(20_000, 100_000), m=20, dt=0.01):
+    """
+    Per-step transient allocations of both engines, default vs preallocate, float64 vs float32.
+
+    Report only; test_allocations.py checks that the preallocated step neither retains memory
+    nor allocates per particle (NumPy still takes a small fixed iterator buffer for ufuncs).
+    """
+    engines = (('test', lambda p: Coulomb(800, 600, {**p, 'export': 'buffer'})),
+               ('main', lambda p: main.Coulomb(800, 600, p)),
+               ('main-tiled', lambda p: main.Coulomb(800, 600, {**p, 'force_mode': 'tiled', 'tile_bytes': 256 * 1024})),
+               ('test-lattice', lambda p: Coulomb(800, 600, {**p, 'export': 'buffer', 'field_mode': 'lattice'})))
+    print(f"{'engine':>12} {'dtype':>8} {'particles':>10} {'default (KiB)':>14} {'prealloc (KiB)':>15}")
+    for name, make in engines:
+        for dtype in ('float64', 'float32'):
+            for n in particle_counts:
+                params = {'n_particles': n, 'n_charges': m, 'dtype': dtype}
+                default = _step_transient_bytes(make(params), dt)
+                prealloc = _step_transient_bytes(make({**params, 'preallocate': True}), dt)
+                print(f"{name:>12} {dtype:>8} {n:>10} {default / 1024:>14.1f} {prealloc / 1024:>15.1f}")
+
+
+def bench_ensemble(member_counts=(1, 4, 16, 64, 256), n=100, m=3, steps=20, dt=0.01):
+    """Particle-steps/s of B test.Coulomb members stepped in a loop vs one CoulombEnsemble."""
+    rng = np.random.default_rng(0)
+    print(f"N={n} M={m} (ragged: members get {n // 2}..{n} particles, 1..{m} charges)")
+    print(f"{'B':>6} {'loop (Mp-steps/s)':>18} {'ensemble (Mp-steps/s)':>22} {'speedup':>8}")
+    for b in member_counts:
+        params = [{'n_particles': int(rng.integers(n // 2, n + 1)), 'n_charges': int(rng.integers(1, m + 1)),
+                   'charge_strength': float(rng.uniform(500, 2000)), 'export': 'buffer'} for _ in range(b)]
+        members = [Coulomb(800, 600, p) for p in params]
+        ens = ensemble.CoulombEnsemble(members)
+        work = sum(p['n_particles'] for p in params)
+
+        def loop():
+            for sim in members:
+                sim.update(dt)
+
+        t_loop = _time_per_call(loop, steps)
+        t_ens = _time_per_call(lambda: ens.update(dt), steps)
+        print(f"{b:>6} {work / t_loop / 1e6:>18.2f} {work / t_ens / 1e6:>22.2f} {t_loop / t_ens:>7.1f}x")
+
+
+def _orbit_sim(make, n, seed=0):
+    """n particles on eccentric orbits (pericentres down to ~1) around one attracting charge at the centre."""
+    sim = make()
+    rng = np.random.default_rng(seed)
+    r = rng.uniform(40, 150, n)
+    angle = rng.uniform(0, 2 * np.pi, n)
+    speed = rng.uniform(0.3, 1.0, n) * np.sqrt(sim.k / r) # Fraction of the circular speed
+    sim.particles[:, 0] = 400 + r * np.cos(angle)
+    sim.particles[:, 1] = 400 + r * np.sin(angle)
+    sim.velocities[:, 0] = -speed * np.sin(angle)
+    sim.velocities[:, 1] = speed * np.cos(angle)
+    return sim
+
+
+def bench_integrators(n=2_000, t_end=50.0):
+    """Relative energy drift and wall time to reach t_end: Euler vs Verlet vs Verlet with block substeps."""
+    def test_engine(params):
+        sim = Coulomb(800, 800, {'n_particles': n, 'n_charges': 1, 'dtype': 'float64', 'export': 'buffer', **params})
+        sim.charges[0] = [400, 400, -1] # Attracting in test.py's sign convention
+        return sim
+
+    def main_engine(params):
+        sim = main.Coulomb(800, 800, {'n_particles': n, 'n_charges': 1, 'charge_strength': 1000.0, **params})
+        sim.charges[0] = [400, 400, 1]  # Attracting in main.py's sign convention
+        return sim
+
+    adaptive = {'integrator': 'verlet', 'max_substeps': 64}
+    configs = [('test', 'euler', {}, dt) for dt in (0.1, 0.02, 0.005)]
+    configs += [('test', 'verlet', {'integrator': 'verlet'}, dt) for dt in (0.1, 0.02)]
+    configs += [('test', f'block {tol:g}', {**adaptive, 'step_tolerance': tol}, 0.1) for tol in (2e-3, 5e-4, 2e-4)]
+    # main.py's default Euler step is position-only (no kinetic energy), so only Verlet is compared there
+    configs += [('main', 'verlet', {'integrator': 'verlet'}, dt) for dt in (0.1, 0.02)]
+    configs += [('main', f'block {tol:g}', {**adaptive, 'step_tolerance': tol}, 0.1) for tol in (2e-3, 2e-4)]
+
+    print(f"N={n} orbits around one charge, t_end={t_end}")
+    print(f"{'engine':>6} {'integrator':>12} {'dt':>6} {'|dE/E0|':>10} {'time (s)':>9} {'evals/particle':>15}")
+    for engine, label, params, dt in configs:
+        sim = _orbit_sim(lambda: (test_engine if engine == 'test' else main_engine)(params), n)
+        e0 = sim.energy()['total']
+        evals = 0
+        start = time.perf_counter()
+        for _ in range(int(round(t_end / dt))):
+            sim.update(dt)
+            evals += sim.force_evals
+        elapsed = time.perf_counter() - start
+        drift = abs(sim.energy()['total'] - e0) / abs(e0)
+        print(f"{engine:>6} {label:>12} {dt:>6g} {drift:>10.2e} {elapsed:>9.2f} {evals / n:>15.0f}")
+
+
+def bench_trajectory(n=20_000, frames=200, dt=0.01):
+    """Per-frame write cost and file size: pickling each frame vs TrajectoryWriter raw and zlib; checkpoint resume."""
+    sim = Coulomb(800, 600, {'n_particles': n, 'n_charges': 3, 'export': 'buffer', 'seed': 0})
+    sim.update(dt)
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"N={n}, {frames} frames")
+        print(f"{'writer':>8} {'frame (ms)':>11} {'MiB':>8} {'read 10 frames (ms)':>20}")
+        path = os.path.join(tmp, 'frames.pkl')
+        start = time.perf_counter()
+        with open(path, 'wb') as f:
+            for _ in range(frames):
+                pickle.dump({'particles': sim.particles.copy(), 'velocities': sim.velocities.copy()}, f)
+        t_write = (time.perf_counter() - start) / frames
+        start = time.perf_counter()
+        with open(path, 'rb') as f: # Reaching frame k means unpickling every frame before it
+            for _ in range(frames // 2 + 10):
+                pickle.load(f)
+        t_read = time.perf_counter() - start
+        print(f"{'pickle':>8} {t_write*1e3:>11.3f} {os.path.getsize(path) / 1024**2:>8.1f} {t_read*1e3:>20.2f}")
+
+        for compression in (None, 'zlib'):
+            path = os.path.join(tmp, f'{compression}.traj')
+            start = time.perf_counter()
+            with trajectory.TrajectoryWriter.for_simulation(sim, path, n_frames=frames, dt=dt,
+                                                            compression=compression) as writer:
+                for _ in range(frames):
+                    writer.record(sim)
+            t_write = (time.perf_counter() - start) / frames
+            start = time.perf_counter()
+            with trajectory.TrajectoryReader(path) as reader:
+                np.array(reader[frames // 2:frames // 2 + 10]['particles'])
+            t_read = time.perf_counter() - start
+            print(f"{compression or 'raw':>8} {t_write*1e3:>11.3f} {os.path.getsize(path) / 1024**2:>8.1f} {t_read*1e3:>20.2f}")
+
+        # Resuming from a checkpoint must reproduce the uninterrupted run exactly
+        for engine, params in ((Coulomb, {'integrator': 'verlet', 'max_substeps': 8}), (main.Coulomb, {})):
+            ref = engine(800, 600, {'n_particles': 1_000, 'n_charges': 5, 'seed': 1, **params})
+            for _ in range(20):
+                ref.update(dt)
+            path = os.path.join(tmp, 'checkpoint.traj')
+            trajectory.save_checkpoint(ref, path)
+            resumed = trajectory.load_checkpoint(path)
+            for _ in range(20):
+                ref.update(dt)
+                resumed.update(dt)
+            if not (np.array_equal(ref.particles, resumed.particles) and np.array_equal(ref.velocities, resumed.velocities)):
+                raise AssertionError(f"{engine.__module__}.Coulomb: resumed run differs from the uninterrupted one")
+        print("checkpoint resume: bit-for-bit")
+
+
+def bench_profile(n=20_000, m=20, steps=50, dt=0.01):
+    """Per-phase breakdown of every engine from the built-in profiler, and its cost when enabled."""
+    engines = (('test', lambda p: Coulomb(800, 600, {'n_particles': n, 'n_charges': m, 'export': 'buffer', **p})),
+               ('main', lambda p: main.Coulomb(800, 600, {'n_particles': n, 'n_charges': m, **p})))
+    for name, make in engines:
+        plain = make({})
+        t_plain = _time_per_call(lambda: plain.update(dt), steps)
+        sim = make({'profile': True})
+        t_prof = _time_per_call(lambda: sim.update(dt), steps)
+        print(f"--- {name}.Coulomb N={n} M={m}: {t_plain*1e3:.3f} ms/step, profiled {t_prof*1e3:.3f} ms/step")
+        print(sim.profiler.report())
+
+    import taichi as ti
+    for neighbor_list in (False, True):
+        sim = _taichi_sim({'num_particles': n, 'profile': True, 'neighbor_list': neighbor_list})
+        sim.run(3, dt) # Compile
+        sim.profiler.reset()
+        sim.run(steps, dt, stride=steps)
+        ti.sync()
+        print(f"--- ParticleSimulationTaichi N={n} neighbor_list={neighbor_list}")
+        print(sim.profiler.report())
+        hist = next(r['counts'] for r in sim.profiler.records() if r['name'] == 'particles_per_cell')
+        print("particles per cell (cells):", ", ".join(f"{k}: {c}" for k, c in enumerate(hist)))
+
+
+def bench_sharded(n_strong=400_000, n_weak=100_000, m=20, steps=5, dt=1e-3, max_workers=None):
+    """Strong (fixed N) and weak (N per worker) scaling of the sharded Euler step, checked against serial."""
+    max_workers = max_workers or os.cpu_count()
+    counts = sorted({1 << k for k in range(max_workers.bit_length()) if 1 << k <= max_workers} | {max_workers})
+    engines = (('test', lambda p: Coulomb(800, 600, {**p, 'export': 'buffer'})),
+               ('main', lambda p: main.Coulomb(800, 600, p)))
+    print(f"{os.cpu_count()} cpus")
+    for name, make in engines:
+        ref = make({'n_particles': 2_000, 'n_charges': m, 'seed': 0})
+        for _ in range(3):
+            ref.update(dt)
+        for workers in counts:
+            sim = make({'n_particles': 2_000, 'n_charges': m, 'seed': 0, 'workers': workers})
+            for _ in range(3):
+                sim.update(dt)
+            sim.close()
+            if not np.array_equal(sim.particles, ref.particles):
+                raise AssertionError(f"{name}.Coulomb: {workers} workers differ from the serial step")
+
+        for mode, n_of in (('strong', lambda w: n_strong), ('weak', lambda w: n_weak * w)):
+            print(f"{name}.Coulomb {mode} scaling, M={m}")
+            print(f"{'workers':>8} {'N':>9} {'step (ms)':>10} {'speedup':>8} {'efficiency':>11}")
+            t1 = None
+            for workers in counts:
+                sim = make({'n_particles': n_of(workers), 'n_charges': m, 'workers': workers})
+                t = _time_per_call(lambda: sim.update(dt), steps)
+                sim.close()
+                t1 = t1 or t
+                # Weak scaling keeps the work per worker fixed, so the ideal step time stays at t1
+                speedup = t1 / t * (workers if mode == 'weak' else 1)
+                print(f"{workers:>8} {n_of(workers):>9} {t*1e3:>10.2f} {speedup:>8.2f} {speedup / workers:>11.0%}")
+
+
+def bench_async_stepper(n=50_000, m=10, dt=0.01, render_ms=12.0, seconds=3.0, ring_sizes=(2, 3, 5)):
+    """
+    Consumer frame rate with a render that takes render_ms (a sleep, like waiting on the GPU/vsync):
+    stepping inline in the draw loop vs AsyncStepper with each policy and ring size.
+    """
+    make = lambda: Coulomb(800, 600, {'n_particles': n, 'n_charges': m, 'export': 'buffer'})
+    sim = make()
+    start, frames = time.perf_counter(), 0
+    while time.perf_counter() - start < seconds:
+        sim.update(dt)
+        time.sleep(render_ms / 1e3)
+        frames += 1
+    print(f"N={n} M={m}, render {render_ms} ms; inline stepping: {frames / seconds:.1f} fps")
+
+    print(f"{'policy':>9} {'ring':>5} {'consumer fps':>13} {'sim fps':>8} {'dropped':>8} {'skipped':>8} "
+          f"{'mean depth':>11} {'p50 lat (ms)':>13} {'p95 lat (ms)':>13}")
+    for policy in ('block', 'drop', 'decouple'):
+        for ring in ring_sizes:
+            with stepper.AsyncStepper(make(), dt, n_buffers=ring, policy=policy) as st:
+                start = time.perf_counter()
+                while time.perf_counter() - start < seconds:
+                    frame = st.latest(timeout=5) if policy == 'decouple' else st.next(timeout=5)
+                    with frame:
+                        time.sleep(render_ms / 1e3)
+                stats = st.metrics()
+            lat = stats.get('latency_ms', {'p50': float('nan'), 'p95': float('nan')})
+            print(f"{policy:>9} {ring:>5} {stats['consumer_fps']:>13.1f} {stats['producer_fps']:>8.1f} "
+                  f"{stats['dropped']:>8} {stats['skipped']:>8} {stats['mean_queue_depth']:>11.2f} "
+                  f"{lat['p50']:>13.2f} {lat['p95']:>13.2f}")
+
+
+def bench_charge_edits(n=20_000, charge_counts=(10, 100, 1_000), edits=50, res=128):
+    """
+    test.Coulomb charge edits by ID (add, move, remove) against rebuilding the charge-dependent state,
+    per field mode: exact Euler (no cache), lattice (cached lattice patched) and exact Verlet (cached
+    accelerations patched). Edit costs should not grow with M; rebuilds grow linearly.
+    """
+    modes = (('exact', {}),
+             ('lattice', {'field_mode': 'lattice', 'lattice_resolution': res}),
+             ('verlet', {'integrator': 'verlet'}))
+    print(f"N={n}, {res}x{res} lattice; times per edit (us) vs a rebuild (ms)")
+    print(f"{'mode':>14} {'M':>6} {'add':>9} {'move':>9} {'remove':>9} {'rebuild (ms)':>13} {'max rel err':>12}")
+    rng = np.random.default_rng(0)
+    for name, params in modes:
+        for m in charge_counts:
+            sim = Coulomb(800, 600, {'n_particles': n, 'n_charges': m, 'seed': 0, 'charge_capacity': m + edits, **params})
+            sim.update(1e-4) # Builds the caches the edits patch
+            # Each edit is followed by the next step's cache check (a no-op when the edit patched the cache)
+            settle = sim._ensure_lattice if sim.field_mode == 'lattice' else (lambda: None)
+            xy = rng.uniform([0, 0], [800, 600], size=(edits, 2))
+            ids = []
+            start = time.perf_counter()
+            for x, y in xy:
+                ids.append(sim.add_charge(x, y, 1.0))
+                settle()
+            t_add = (time.perf_counter() - start) / edits
+            start = time.perf_counter()
+            for i, (x, y) in zip(ids, xy[::-1]):
+                sim.update_charge(i, x=x, y=y)
+                settle()
+            t_move = (time.perf_counter() - start) / edits
+            start = time.perf_counter()
+            for i in ids:
+                sim.remove_charge(i)
+                settle()
+            t_remove = (time.perf_counter() - start) / edits
+
+            # What each edit cost before: the charge-dependent caches rebuilt from all M charges
+            if sim._lattice is not None:
+                patched = sim._lattice.copy()
+                t_rebuild = _time_per_call(lambda: (sim.invalidate_field(), sim._ensure_lattice()), 1)
+                err = float(np.max(np.linalg.norm(patched - sim._lattice, axis=-1))
+                            / np.max(np.linalg.norm(sim._lattice, axis=-1)))
+            elif sim._accel is not None:
+                patched = sim._accel.copy()
+                exact = sim.field_at(sim.particles[:, :2])
+                t_rebuild = _time_per_call(lambda: sim.field_at(sim.particles[:, :2]), 1)
+                err = float(np.max(np.linalg.norm(patched - exact, axis=1)) / np.max(np.linalg.norm(exact, axis=1)))
+            else:
+                t_rebuild = _time_per_call(lambda: sim.set_charges(sim.charges), 3)
+                err = 0.0
+            print(f"{name:>14} {m:>6} {t_add*1e6:>9.1f} {t_move*1e6:>9.1f} {t_remove*1e6:>9.1f} "
+                  f"{t_rebuild*1e3:>13.3f} {err:>12.2e}")
+
+
+def _uniform_map_error(charges, k, nx, ny, probes, exact, floor, width=800, height=600):
+    """Max relative error of bilinear sampling from an nx x ny uniform grid of exact field samples."""
+    gx, gy = np.linspace(0, width, nx), np.linspace(0, height, ny)
+    grid = fieldmap.coulomb_field(np.stack(np.meshgrid(gx, gy), axis=-1).reshape(-1, 2), charges, k).reshape(ny, nx, 2)
+    fx, fy = probes[:, 0] * ((nx - 1) / width), probes[:, 1] * ((ny - 1) / height)
+    ix, iy = np.minimum(fx.astype(np.intp), nx - 2), np.minimum(fy.astype(np.intp), ny - 2)
+    tx, ty = (fx - ix)[:, None], (fy - iy)[:, None]
+    approx = ((1 - ty) * ((1 - tx) * grid[iy, ix] + tx * grid[iy, ix + 1])
+              + ty * ((1 - tx) * grid[iy + 1, ix] + tx * grid[iy + 1, ix + 1]))
+    return float(np.max(np.linalg.norm(approx - exact, axis=1) / (np.linalg.norm(exact, axis=1) + floor)))
+
+
+def bench_field_map(charge_counts=(3, 10), tolerances=(0.05, 0.01), n_probes=200_000, max_side=2048):
+    """
+    Adaptive quadtree field map vs the coarsest uniform grid with the same measured max error (relative
+    to |E| + field_floor, outside the charge cores) on random probes plus probes clustered near charges.
+    ratio is uniform samples per adaptive field evaluation; build times are the field evaluations.
+    """
+    rng = np.random.default_rng(0)
+    for m in charge_counts:
+        sim = Coulomb(800, 600, {'n_particles': 1, 'n_charges': m, 'seed': 0})
+        charges = sim.charges.astype(np.float64)
+        print(f"M={m} ('>' marks a uniform grid capped at {max_side} nodes across)")
+        print(f"{'tol':>6} {'adaptive samples':>17} {'build (ms)':>11} {'max err':>9} "
+              f"{'uniform samples':>16} {'build (ms)':>11} {'max err':>9} {'ratio':>7}")
+        for tol in tolerances:
+            start = time.perf_counter()
+            fm = fieldmap.for_simulation(sim, tolerance=tol)
+            t_adaptive = time.perf_counter() - start
+            core, floor = fm.stats['core_radius'], fm.stats['field_floor']
+
+            # Probes: uniform over the domain, plus a ring of 1..20 core radii around every charge
+            near_r = core * rng.uniform(1, 20, size=(n_probes // 4, 1))
+            angle = rng.uniform(0, 2 * np.pi, size=(n_probes // 4, 1))
+            ring = charges[rng.integers(m, size=n_probes // 4), :2] + near_r * np.hstack([np.cos(angle), np.sin(angle)])
+            probes = np.vstack([rng.uniform([0, 0], [800, 600], size=(n_probes, 2)), ring])
+            probes = probes[(probes >= 0).all(axis=1) & (probes <= [800, 600]).all(axis=1)]
+            probes = probes[fieldmap.charge_distance(probes, charges) >= core]
+            exact = fieldmap.coulomb_field(probes, charges, sim.k)
+            err = float(np.max(np.linalg.norm(fm.sample(probes) - exact, axis=1) / (np.linalg.norm(exact, axis=1) + floor)))
+
+            # Smallest uniform grid (600/800 aspect) reaching the same max error, by bisection on nodes across
+            error_of = lambda nx: _uniform_map_error(charges, sim.k, nx, max(2, round(nx * 0.75)), probes, exact, floor)
+            lo, hi = 2, max_side
+            if error_of(hi) > err:
+                lo = hi
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if error_of(mid) <= err:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            ny = max(2, round(lo * 0.75))
+            u_err = error_of(lo)
+            nodes = np.stack(np.meshgrid(np.linspace(0, 800, lo), np.linspace(0, 600, ny)), axis=-1).reshape(-1, 2)
+            start = time.perf_counter()
+            fieldmap.coulomb_field(nodes, charges, sim.k)
+            t_uniform = time.perf_counter() - start
+            mark = '>' if lo == max_side and u_err > err else ' '
+            print(f"{tol:>6g} {fm.stats['evaluations']:>17} {t_adaptive*1e3:>11.1f} {err:>9.4f} "
+                  f"{mark}{lo * ny:>15} {t_uniform*1e3:>11.1f} {u_err:>9.4f} {lo * ny / fm.stats['evaluations']:>7.1f}")
+
+
+BENCHMARKS = {
+    'frame_export': bench_frame_export,
+    'tiled_force': bench_tiled_force,
+    'barnes_hut': bench_barnes_hut,
+    'field_lattice': bench_field_lattice,
+    'binning': bench_binning,
+    'neighbor_list': bench_neighbor_list,
+    'sparse_grid': bench_sparse_grid,
+    'reorder': bench_reorder,
+    'allocations': bench_allocations,
+    'ensemble': bench_ensemble,
+    'integrators': bench_integrators,
+    'trajectory': bench_trajectory,
+    'profile': bench_profile,
+    'sharded': bench_sharded,
+    'async_stepper': bench_async_stepper,
+    'charge_edits': bench_charge_edits,
+    'field_map': bench_field_map,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names', nargs='*', help=f"Benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+    for name in args.names or BENCHMARKS:
+        print(f"--- {name} ---")
+        BENCHMARKS[name]()
@@ -0,0 +1,267 @@
+"""
+Adaptive electric-field maps: a quadtree of exact field samples over the Coulomb charge arrays,
+refined where bilinear interpolation of the field is worst, i.e. where |grad E| or the field
+direction changes fastest relative to |E|.
+
+Cells are split into four equal children. A cell is kept as a leaf once the field at its centre
+and edge midpoints matches the bilinear interpolation of its corners to within `tolerance`:
+
+    |E - E_bilinear| / (|E| + field_floor) <= tolerance
+
+Cells lying entirely within core_radius of a charge are not tested, since no finite cell resolves
+the 1/r^2 singularity itself; the map is accurate to tolerance outside those cores. Refinement
+stops at max_depth or when the next cells would take the map past max_samples field evaluations;
+cells with the largest parent error are refined first.
+Samples sit on a 2^max_depth grid per axis and are shared between neighbouring cells.
+
+The result is a FieldMap of flat arrays (see FieldMap.to_arrays) for rendering or export:
+
+    fm = fieldmap.for_simulation(sim, tolerance=0.01)
+    fm.points, fm.field   # (V, 2) float32 sample positions and fields
+    fm.cells, fm.level    # (L, 4) int32 corner indices, (L,) uint8 depth of each leaf
+    fm.sample(xy)         # bilinear interpolation within the leaves
+
+E = k q r / |r|^3 with test.py's distance floor, which is the force on a unit charge in test.Coulomb.
+main.Coulomb uses the opposite sign convention, so its particles move along -E.
+"""
+from typing import Dict, Optional
+
+import numpy as np
+
+# Deepest quadtree: _cell_keys packs the level (5 bits) above 2 * max_depth + 2 bits of row and
+# column, which must fit in the 63 value bits of an int64
+MAX_DEPTH = 28
+
+
+def coulomb_field(points: np.ndarray, charges: np.ndarray, k: float = 1000.0, epsilon: float = 1e-6,
+                  chunk: int = 8192) -> np.ndarray:
+    """Exact float64 field at points (P, 2) from charges (M, 3), summed in chunks of points."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    charges = np.asarray(charges, dtype=np.float64).reshape(-1, 3)
+    out = np.zeros_like(points)
+    if charges.shape[0] == 0:
+        return out
+    c_xy, kq = charges[None, :, :2], k * charges[None, :, 2]
+    for c0 in range(0, points.shape[0], chunk):
+        disp = points[c0:c0 + chunk, None, :] - c_xy
+        dist_sq = np.maximum(np.sum(disp * disp, axis=2), epsilon)
+        out[c0:c0 + chunk] = np.einsum('ijk,ij->ik', disp, kq / (dist_sq * (np.sqrt(dist_sq) + epsilon)))
+    return out
+
+
+def charge_distance(points: np.ndarray, charges: np.ndarray, chunk: int = 8192) -> np.ndarray:
+    """Distance from each point (P, 2) to the nearest charge (inf without charges)."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    out = np.full(points.shape[0], np.inf)
+    if charges.shape[0] == 0:
+        return out
+    for c0 in range(0, points.shape[0], chunk):
+        disp = points[c0:c0 + chunk, None, :] - charges[None, :, :2]
+        out[c0:c0 + chunk] = np.sqrt(np.min(np.sum(disp * disp, axis=2), axis=1))
+    return out
+
+
+class FieldMap:
+    def __init__(self, width: float, height: float, max_depth: int, points: np.ndarray, field: np.ndarray,
+                 cells: np.ndarray, level: np.ndarray, cell_xy: np.ndarray, error: np.ndarray, stats: Dict):
+        self.width = width
+        self.height = height
+        self.max_depth = max_depth
+        self.points = points    # (V, 2) float32 sample positions
+        self.field = field      # (V, 2) float32 exact field at each sample
+        self.cells = cells      # (L, 4) int32 leaf corners: (x0, y0), (x1, y0), (x0, y1), (x1, y1)
+        self.level = level      # (L,) uint8 leaf depth; a leaf is width / 2^level by height / 2^level
+        self.cell_xy = cell_xy  # (L, 2) int32 leaf column and row at its depth
+        self.error = error      # (L,) float32 estimated relative interpolation error of each leaf
+        self.stats = stats      # evaluations, vertices, refined, capped (leaves left above tolerance), ...
+
+    def __len__(self) -> int:
+        return self.cells.shape[0]
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """The mesh as flat contiguous arrays (e.g. for np.savez or a typed-array view on the host)."""
+        return {'points': self.points.reshape(-1), 'field': self.field.reshape(-1),
+                'cells': self.cells.reshape(-1), 'level': self.level,
+                'extent': np.array([self.width, self.height], dtype=np.float32)}
+
+    def locate(self, xy: np.ndarray) -> np.ndarray:
+        """Index of the leaf containing each point of xy (P, 2), clamped to the domain."""
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        side = 1 << self.max_depth
+        fx = np.clip(xy[:, 0] / self.width * side, 0, side - 1).astype(np.int64)
+        fy = np.clip(xy[:, 1] / self.height * side, 0, side - 1).astype(np.int64)
+        keys = _cell_keys(self.level, self.cell_xy[:, 0], self.cell_xy[:, 1], self.max_depth)
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+        out = np.full(xy.shape[0], -1, dtype=np.int64)
+        for depth in np.unique(self.level):
+            shift = self.max_depth - int(depth)
+            todo = out < 0
+            probe = _cell_keys(depth, fx[todo] >> shift, fy[todo] >> shift, self.max_depth)
+            pos = np.minimum(np.searchsorted(sorted_keys, probe), sorted_keys.shape[0] - 1)
+            hit = sorted_keys[pos] == probe
+            out[np.flatnonzero(todo)[hit]] = order[pos[hit]]
+        return out
+
+    def sample(self, xy: np.ndarray) -> np.ndarray:
+        """Field at points xy (P, 2), interpolated bilinearly from the corners of their leaves."""
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        leaf = self.locate(xy)
+        corners = self.cells[leaf]
+        p0 = self.points[corners[:, 0]].astype(np.float64)
+        p1 = self.points[corners[:, 3]].astype(np.float64)
+        t = np.clip((xy - p0) / (p1 - p0), 0, 1)
+        tx, ty = t[:, :1], t[:, 1:]
+        f = self.field.astype(np.float64)
+        return ((1 - ty) * ((1 - tx) * f[corners[:, 0]] + tx * f[corners[:, 1]])
+                + ty * ((1 - tx) * f[corners[:, 2]] + tx * f[corners[:, 3]]))
+
+
+def _cell_keys(level, ix, iy, max_depth: int) -> np.ndarray:
+    """Unique int64 key per (level, column, row) cell."""
+    level = np.asarray(level, dtype=np.int64)
+    return (level << np.int64(2 * max_depth + 2)) | (np.asarray(iy, dtype=np.int64) << np.int64(max_depth + 1)) \
+        | np.asarray(ix, dtype=np.int64)
+
+
+class _Samples:
+    """Exact field samples on the 2^max_depth (+1) vertex grid, evaluated once each."""
+
+    def __init__(self, evaluate, width: float, height: float, max_depth: int):
+        self.evaluate = evaluate
+        self.side = 1 << max_depth
+        self.scale = np.array([width / self.side, height / self.side])
+        self.keys = np.empty(0, dtype=np.int64)  # Sorted
+        self.values = np.empty((0, 2))
+
+    def key(self, gx: np.ndarray, gy: np.ndarray) -> np.ndarray:
+        return gy * (self.side + 1) + gx
+
+    def get(self, gx: np.ndarray, gy: np.ndarray) -> np.ndarray:
+        """Field at grid vertices (gx, gy), evaluating the ones not seen before."""
+        keys = self.key(gx, gy)
+        new = np.unique(keys)
+        if self.keys.shape[0]:
+            pos = np.minimum(np.searchsorted(self.keys, new), self.keys.shape[0] - 1)
+            new = new[self.keys[pos] != new]
+        if new.shape[0]:
+            xy = np.stack([new % (self.side + 1), new // (self.side + 1)], axis=1) * self.scale
+            merged = np.concatenate([self.keys, new])
+            order = np.argsort(merged, kind='stable')
+            self.keys = merged[order]
+            self.values = np.concatenate([self.values, self.evaluate(xy)])[order]
+        return self.values[np.searchsorted(self.keys, keys)]
+
+    def count_new(self, gx: np.ndarray, gy: np.ndarray) -> int:
+        new = np.unique(self.key(gx, gy))
+        if not self.keys.shape[0]:
+            return int(new.shape[0])
+        pos = np.minimum(np.searchsorted(self.keys, new), self.keys.shape[0] - 1)
+        return int(np.count_nonzero(self.keys[pos] != new))
+
+
+# Test points of a cell, in units of half its side from its (x0, y0) corner: centre, then the
+# midpoints of the bottom, top, left and right edges, and the corners each one interpolates from
+_TESTS = ((1, 1, (0, 1, 2, 3)), (1, 0, (0, 1)), (1, 2, (2, 3)), (0, 1, (0, 2)), (2, 1, (1, 3)))
+
+
+def adaptive_field_map(charges: np.ndarray, width: float, height: float, k: float = 1000.0,
+                       epsilon: float = 1e-6, tolerance: float = 0.01, max_samples: int = 1 << 18,
+                       min_depth: int = 2, max_depth: int = 14, core_radius: Optional[float] = None,
+                       field_floor: Optional[float] = None) -> FieldMap:
+    """
+    Builds the quadtree field map of charges (M, 3) over [0, width] x [0, height].
+    core_radius defaults to 0.2% of the larger side; field_floor (the |E| below which errors are
+    measured absolutely) defaults to 1% of the median |E| over the min_depth grid.
+    """
+    charges = np.asarray(charges, dtype=np.float64).reshape(-1, 3)
+    max_depth = int(max_depth)
+    min_depth = min(int(min_depth), max_depth)
+    if max_depth > MAX_DEPTH:
+        raise ValueError(f"max_depth must be at most {MAX_DEPTH}")
+    core = 0.002 * max(width, height) if core_radius is None else float(core_radius)
+    samples = _Samples(lambda xy: coulomb_field(xy, charges, k, epsilon), width, height, max_depth)
+
+    n = 1 << min_depth
+    iy, ix = np.divmod(np.arange(n * n, dtype=np.int64), n)
+    level = np.full(n * n, min_depth, dtype=np.int64)
+    priority = np.full(n * n, np.inf) # Parent error; the roots have none
+    if field_floor is None:
+        shift = max_depth - min_depth
+        e = samples.get(ix << shift, iy << shift)
+        field_floor = 0.01 * float(np.median(np.linalg.norm(e, axis=1)))
+    floor = max(float(field_floor), 1e-300)
+
+    leaves = {'level': [], 'ix': [], 'iy': [], 'error': []}
+    refined = 0
+    while ix.shape[0]:
+        # Corner (c) and test point (t) coordinates on the vertex grid; test points need one more level
+        step = np.int64(1) << (max_depth - level)
+        half = step >> 1 # 0 at max_depth, where cells are not tested
+        gx0, gy0 = ix * step, iy * step
+        can_split = level < max_depth
+        tx = np.stack([gx0 + a * half for a, _, _ in _TESTS], axis=1)
+        ty = np.stack([gy0 + b * half for _, b, _ in _TESTS], axis=1)
+
+        # Budget: test the most promising cells whose test points still fit
+        test = np.flatnonzero(can_split)
+        budget = max_samples - samples.keys.shape[0]
+        if test.shape[0] and samples.count_new(tx[test], ty[test]) > budget:
+            test = test[np.argsort(-priority[test], kind='stable')]
+            lo, hi = 0, test.shape[0] # Longest prefix that fits, by bisection
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if samples.count_new(tx[test[:mid]], ty[test[:mid]]) <= budget:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            test = test[:lo]
+
+        corners = samples.get(np.stack([gx0, gx0 + step, gx0, gx0 + step], axis=1),
+                              np.stack([gy0, gy0, gy0 + step, gy0 + step], axis=1))
+        err = priority.copy() # Untested cells (budget or depth) keep their parent's estimate
+        if test.shape[0]:
+            exact = samples.get(tx[test], ty[test])
+            c = corners[test]
+            err[test] = 0.0
+            for j, (_, _, idx) in enumerate(_TESTS):
+                approx = c[:, list(idx)].mean(axis=1)
+                e = np.linalg.norm(exact[:, j] - approx, axis=1) / (np.linalg.norm(exact[:, j], axis=1) + floor)
+                err[test] = np.maximum(err[test], e)
+            # Inside a core: centre distance plus half the diagonal below core_radius
+            centre = np.stack([tx[test, 0], ty[test, 0]], axis=1) * samples.scale
+            half_diag = 0.5 * np.hypot(*(step[test, None] * samples.scale).T)
+            err[test[charge_distance(centre, charges) + half_diag < core]] = 0.0
+        split = np.zeros(ix.shape[0], dtype=bool)
+        split[test] = err[test] > tolerance
+
+        keep = ~split
+        for name, value in (('level', level), ('ix', ix), ('iy', iy), ('error', err)):
+            leaves[name].append(value[keep])
+        refined += int(np.count_nonzero(split))
+        # Children in order (0, 0), (1, 0), (0, 1), (1, 1)
+        level = np.repeat(level[split] + 1, 4)
+        ix = (np.repeat(ix[split] * 2, 4) + np.tile([0, 1, 0, 1], int(np.count_nonzero(split))))
+        iy = (np.repeat(iy[split] * 2, 4) + np.tile([0, 0, 1, 1], int(np.count_nonzero(split))))
+        priority = np.repeat(err[split], 4)
+
+    level = np.concatenate(leaves['level'])
+    ix, iy = np.concatenate(leaves['ix']), np.concatenate(leaves['iy'])
+    step = np.int64(1) << (max_depth - level)
+    gx = np.stack([ix * step, (ix + 1) * step, ix * step, (ix + 1) * step], axis=1)
+    gy = np.stack([iy * step, iy * step, (iy + 1) * step, (iy + 1) * step], axis=1)
+    used, cells = np.unique(samples.key(gx, gy), return_inverse=True)
+    values = samples.values[np.searchsorted(samples.keys, used)]
+    points = np.stack([used % (samples.side + 1), used // (samples.side + 1)], axis=1) * samples.scale
+    error = np.concatenate(leaves['error'])
+    stats = {'evaluations': int(samples.keys.shape[0]), 'vertices': int(used.shape[0]), 'leaves': int(level.shape[0]),
+             'refined': refined, 'capped': int(np.count_nonzero(error > tolerance)), 'tolerance': tolerance, 'field_floor': floor, 'core_radius': core}
+    return FieldMap(width, height, max_depth, points.astype(np.float32), values.astype(np.float32),
+                    cells.reshape(-1, 4).astype(np.int32), level.astype(np.uint8),
+                    np.stack([ix, iy], axis=1).astype(np.int32), error.astype(np.float32), stats)
+
+
+def for_simulation(sim, **kwargs) -> FieldMap:
+    """adaptive_field_map of a test.Coulomb or main.Coulomb instance's current charges."""
+    return adaptive_field_map(sim.charges, sim.width, sim.height, k=float(sim.k),
+                              epsilon=float(getattr(sim, 'epsilon', 1e-6)), **kwargs)
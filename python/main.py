@@ -2,6 +2,10 @@ import numpy as np
 import random # Keep random for choice if needed, but NumPy's is often preferred
 
 class Coulomb:
+    # Temporaries held per (particle, charge) pair by _pair_force, in elements of self.dtype:
+    # delta_pos (2), r_sq (1), r (1), f_mag (1), unit vector (2), f_vectors (2)
+    PAIR_TEMP_VALUES = 9
+
     def __init__(self, width, height, params):
         """
         Initializes the simulation using NumPy arrays.
@@ -11,24 +15,80 @@ class Coulomb:
         self.params = params
         self.k = params.get('charge_strength', 1.0) # Coulomb's constant / scaling factor
 
-        rng = np.random.default_rng()
+        # Force evaluation mode:
+        #   'direct' - one broadcast over all (N, M) particle/charge pairs (peak memory ~ N*M)
+        #   'tiled'  - blocks of particles x charges sized to fit `tile_bytes` of temporaries,
+        #              so peak memory stays flat as N*M grows
+        self.force_mode = params.get('force_mode', 'direct')
+        self.tile_bytes = int(params.get('tile_bytes', 4 * 1024 * 1024)) # Default ~ L2/L3 sized
+
+        # Mutual particle<->particle forces, each particle carrying `particle_charge`:
+        #   'none'   - particles only feel the fixed charges (default)
+        #   'direct' - O(N^2) pairwise sum (reference)
+        #   'tree'   - Barnes-Hut quadtree from barnes_hut.py, O(N log N) with opening angle `theta`
+        self.particle_interactions = params.get('particle_interactions', 'none')
+        self.particle_charge = float(params.get('particle_charge', 1.0))
+        self.theta = float(params.get('theta', 0.5))
+        self.quadrupole = bool(params.get('quadrupole', False))
+
+        # Floating point type of all particle/charge state and temporaries ('float64' or 'float32')
+        self.dtype = np.dtype(params.get('dtype', 'float64'))
+        # Preallocated workspace: scratch buffers for one force block are sized here and every
+        # step runs in place with out= (mutual particle forces still allocate)
+        self.preallocate = bool(params.get('preallocate', False))
+
+        # Time integration:
+        #   'euler'  - position-only step, pos += force * dt (overdamped, the original behaviour)
+        #   'verlet' - kick-drift-kick velocity Verlet with unit mass, particles carry self.velocities
+        # Verlet block time steps: each particle takes 2^l substeps (up to max_substeps, rounded up to
+        # a power of two) no longer than sqrt(2 * step_tolerance / |a|) under the fixed-charge force.
+        # Mutual particle forces are the slow part: they kick once per full step, half at each end.
+        self.integrator = params.get('integrator', 'euler')
+        self.max_substeps = 1 << max(0, int(np.ceil(np.log2(max(1, int(params.get('max_substeps', 1)))))))
+        self.step_tolerance = float(params.get('step_tolerance', 0.002))
+        self.force_evals = 0 # Particle force evaluations (fixed charges) in the last update
+        self._accel = None   # Fixed-charge and mutual accelerations at the current positions (Verlet)
+        self._mutual_accel = None
+        self._accel_charges = None
+
+        # Multi-core Euler step (sharded.py, imported on first use): `workers` threads each own a
+        # contiguous block of particles, evaluate its charge forces, meet at a barrier and integrate it.
+        # Matches the serial allocating step bit-for-bit
+        self.workers = max(1, int(params.get('workers', 1)))
+        if self.workers > 1 and (self.integrator != 'euler' or self.preallocate):
+            raise ValueError("workers > 1 supports the 'euler' integrator without preallocate")
+        self._pool = None
+        self._shards = (None, None) # (particle count, bounds) the shards were cut for
+
+        # Per-phase timers and counters (profiling.py, imported only when enabled, like barnes_hut);
+        # with None every hook is a single check
+        self.profiler = None
+        if params.get('profile', False):
+            import profiling
+            self.profiler = profiling.Profiler()
+
+        # Kept on the instance (and seedable) so checkpoints can save and restore its state
+        self.rng = rng = np.random.default_rng(params.get('seed'))
 
         # Initialize charges as NumPy array: [[x1, y1, q1], [x2, y2, q2], ...]
         n_charges = int(params.get('n_charges', 1)) # Ensure integer
-        self.charges = np.zeros((n_charges, 3))
+        self.charges = np.zeros((n_charges, 3), dtype=self.dtype)
         self.charges[:, 0] = rng.uniform(0, width, size=n_charges)  # x positions
         self.charges[:, 1] = rng.uniform(0, height, size=n_charges) # y positions
         self.charges[:, 2] = rng.choice([-1, 1], size=n_charges)    # charge value
 
         # Initialize particles as NumPy array: [[x1, y1], [x2, y2], ...]
         n_particles = int(params.get('n_particles', 100)) # Ensure integer
-        self.particles = np.zeros((n_particles, 2))
+        self.particles = np.zeros((n_particles, 2), dtype=self.dtype)
         self.particles[:, 0] = rng.uniform(0, width, size=n_particles)  # x positions
         self.particles[:, 1] = rng.uniform(0, height, size=n_particles) # y positions
         
-        # Add velocities for more realistic motion (optional but recommended)
-        # self.velocities = np.zeros_like(self.particles) 
-        # Consider adding mass from params if using velocity/acceleration
+        # Velocities for the 'verlet' integrator (the Euler step ignores them); unit particle mass
+        self.velocities = np.zeros_like(self.particles)
+
+        self._ws = None
+        if self.preallocate:
+            self._allocate_workspace()
 
 
     def get_particles(self):
@@ -39,20 +99,17 @@ class Coulomb:
         """Returns the charge data as a NumPy array."""
         return self.charges
 
-    def update(self, dt):
+    def _pair_force(self, particles, charges):
         """
-        Updates the positions of the particles based on Coulomb forces using NumPy.
-        Assumes particle charge is +1 for simplicity.
+        Total Coulomb force from `charges` (M, 3) on `particles` (N, 2) in one broadcast.
+        Allocates (N, M) temporaries. Assumes particle charge is +1.
         """
-        if self.particles.shape[0] == 0 or self.charges.shape[0] == 0:
-             return self.particles # Nothing to do
-
         # Expand dimensions for broadcasting:
         # particles: (N, 1, 2) -> [[x_p1, y_p1]], [[x_p2, y_p2]], ...
         # charges:   (1, M, 3) -> [[[x_c1, y_c1, q_c1], [x_c2, y_c2, q_c2], ...]]
-        p_pos = self.particles[:, np.newaxis, :] # Shape (N, 1, 2)
-        c_pos = self.charges[np.newaxis, :, :2]  # Shape (1, M, 2)
-        c_q = self.charges[np.newaxis, :, 2]     # Shape (1, M)
+        p_pos = particles[:, np.newaxis, :] # Shape (N, 1, 2)
+        c_pos = charges[np.newaxis, :, :2]  # Shape (1, M, 2)
+        c_q = charges[np.newaxis, :, 2]     # Shape (1, M)
 
         # Calculate displacement vectors (dx, dy) from each charge to each particle
         # Broadcasting happens here: (N, 1, 2) - (1, M, 2) -> (N, M, 2)
@@ -85,16 +142,292 @@ class Coulomb:
         # Sum forces from all charges acting on each particle
         # Sum over axis=1 (charges) -> (N, 2)
         total_force = np.sum(f_vectors, axis=1)
+        return total_force
+
+    def _block_shape(self, n, m):
+        """(particles, charges) per block: everything for 'direct', the tile budget for 'tiled'."""
+        if self.force_mode != 'tiled':
+            return max(n, 1), max(m, 1)
+        max_pairs = max(1, self.tile_bytes // (self.PAIR_TEMP_VALUES * self.dtype.itemsize))
+        # Prefer whole charge rows (M is usually small), then fill the budget with particles
+        charge_block = max(1, min(m, max_pairs))
+        particle_block = max(1, max_pairs // charge_block)
+        return particle_block, charge_block
+
+    def _allocate_workspace(self):
+        """Scratch buffers for one force block plus the (N, 2) force accumulator."""
+        n, m = self.particles.shape[0], self.charges.shape[0]
+        bp, bc = self._block_shape(n, m)
+        self._ws = {
+            'shape': (n, m),
+            'delta': np.empty((bp, bc, 2), dtype=self.dtype),
+            'sq': np.empty((bp, bc, 2), dtype=self.dtype),
+            'r_sq': np.empty((bp, bc), dtype=self.dtype),
+            'r': np.empty((bp, bc), dtype=self.dtype),
+            'kq': np.empty(bc, dtype=self.dtype),
+            'block_force': np.empty((bp, 2), dtype=self.dtype),
+            'force': np.empty((n, 2), dtype=self.dtype),
+        }
+
+    def _pair_force_into(self, particles, charges, out):
+        """_pair_force written into `out` (n, 2) through the workspace, without allocating arrays."""
+        ws = self._ws
+        n, m = particles.shape[0], charges.shape[0]
+        delta, sq = ws['delta'][:n, :m], ws['sq'][:n, :m]
+        r_sq, r, kq = ws['r_sq'][:n, :m], ws['r'][:n, :m], ws['kq'][:m]
+
+        np.subtract(particles[:, np.newaxis, :], charges[np.newaxis, :, :2], out=delta)
+        np.multiply(delta, delta, out=sq)
+        np.add(sq[:, :, 0], sq[:, :, 1], out=r_sq)
+        np.maximum(r_sq, 1e-6, out=r_sq)        # Same epsilon floor as _pair_force
+        np.sqrt(r_sq, out=r)
+        np.multiply(r, r_sq, out=r)             # r^3
+        np.multiply(charges[:, 2], -self.k, out=kq)
+        np.divide(kq[np.newaxis, :], r, out=r)  # f_mag / r = -k q / r^3
+        np.multiply(delta, r[:, :, np.newaxis], out=delta)
+        return np.sum(delta, axis=1, out=out)
+
+    def _force_inplace(self):
+        """Direct or tiled charge forces accumulated into the workspace force buffer."""
+        if self._ws is None or self._ws['shape'] != (self.particles.shape[0], self.charges.shape[0]):
+            self._allocate_workspace() # Only when particle/charge counts change
+        ws = self._ws
+        total_force = ws['force']
+        n, m = ws['shape']
+        if m == 0:
+            total_force.fill(0)
+            return total_force
+        bp, bc = self._block_shape(n, m)
+        if bp >= n and bc >= m:
+            return self._pair_force_into(self.particles, self.charges, total_force)
+
+        total_force.fill(0)
+        for p0 in range(0, n, bp):
+            p1 = min(p0 + bp, n)
+            block = ws['block_force'][:p1 - p0]
+            for c0 in range(0, m, bc):
+                self._pair_force_into(self.particles[p0:p1], self.charges[c0:c0 + bc], block)
+                np.add(total_force[p0:p1], block, out=total_force[p0:p1])
+        return total_force
+
+    def _tiled_force(self, particles, charges):
+        """
+        Same result as _pair_force, evaluated over blocks of particles x charges whose
+        temporaries fit in self.tile_bytes. Forces are accumulated per block into total_force.
+        """
+        n, m = particles.shape[0], charges.shape[0]
+        particle_block, charge_block = self._block_shape(n, m)
+
+        total_force = np.zeros((n, 2), dtype=self.dtype)
+        for p0 in range(0, n, particle_block):
+            p1 = min(p0 + particle_block, n)
+            for c0 in range(0, m, charge_block):
+                total_force[p0:p1] += self._pair_force(particles[p0:p1], charges[c0:c0 + charge_block])
+        return total_force
+
+    def _mutual_force(self):
+        """
+        Forces between the particles themselves, with the same sign convention as the
+        fixed charges in _pair_force. Imported lazily: barnes_hut.py is not shipped to Pyodide.
+        """
+        import barnes_hut
+
+        q = np.full(self.particles.shape[0], self.particle_charge)
+        softening = 1e-3 # sqrt of the 1e-6 r^2 floor in _pair_force
+        if self.particle_interactions == 'tree':
+            field = barnes_hut.tree_field(self.particles, q, theta=self.theta,
+                                          softening=softening, quadrupole=self.quadrupole)
+        else:
+            field = barnes_hut.direct_field(self.particles, q, softening=softening)
+        return -self.k * self.particle_charge * field
+
+    def _charge_force(self, particles):
+        """Force from the fixed charges on `particles`, direct or tiled."""
+        if self.charges.shape[0] == 0:
+            return np.zeros_like(particles)
+        if self.force_mode == 'tiled':
+            return self._tiled_force(particles, self.charges)
+        return self._pair_force(particles, self.charges)
+
+    def energy(self):
+        """
+        Kinetic, potential and total energy. The potential of a charge is -k q / r (the force above is
+        attractive for q > 0), using the same r^2 floor; mutual pairs use the softened distance.
+        """
+        delta_pos = self.particles[:, np.newaxis, :] - self.charges[np.newaxis, :, :2]
+        r = np.sqrt(np.maximum(np.sum(delta_pos**2, axis=2), 1e-6))
+        potential = float(np.sum(-self.k * self.charges[np.newaxis, :, 2] / r, dtype=np.float64))
+        if self.particle_interactions != 'none':
+            n = self.particles.shape[0]
+            for p0 in range(0, n, 1024): # Blocks of rows keep the pair temporaries small
+                d = self.particles[p0:p0 + 1024, np.newaxis, :] - self.particles[np.newaxis, :, :]
+                r_ij = np.sqrt(np.sum(d**2, axis=2) + 1e-6)
+                upper = np.arange(p0, p0 + r_ij.shape[0])[:, np.newaxis] < np.arange(n)[np.newaxis, :]
+                potential -= float(self.k * self.particle_charge**2 * np.sum(upper / r_ij))
+        kinetic = float(0.5 * np.sum(self.velocities**2, dtype=np.float64))
+        return {'kinetic': kinetic, 'potential': potential, 'total': kinetic + potential}
+
+    def _substep_counts(self, dt, accel):
+        """Power-of-two substeps per particle from the |a| time step criterion."""
+        if self.max_substeps == 1:
+            return np.ones(accel.shape[0], dtype=np.intp)
+        a = np.maximum(np.sqrt(np.sum(accel.astype(np.float64)**2, axis=1)), 1e-30)
+        dt_i = np.sqrt(2 * self.step_tolerance / a)
+        level = np.ceil(np.log2(np.maximum(dt / dt_i, 1.0)))
+        return 1 << np.minimum(level, np.log2(self.max_substeps)).astype(np.intp)
+
+    def _update_verlet(self, dt, prof=None):
+        """
+        Velocity Verlet with per-particle block substeps for the fixed-charge force, nested inside
+        a half kick of the mutual force at each end of the step (impulse / multiple time stepping).
+        Returns the seconds spent in force evaluations when profiling (else 0).
+        """
+        mutual = self.particle_interactions != 'none'
+        force_time = 0.0
+        if (self._accel is None or self._accel.shape != self.particles.shape
+                or not np.array_equal(self._accel_charges, self.charges)):
+            t0 = prof.tic() if prof else 0.0
+            self._accel = self._charge_force(self.particles)
+            self._mutual_accel = self._mutual_force() if mutual else None
+            self._accel_charges = self.charges.copy()
+            if prof:
+                force_time += prof.tic() - t0
+        accel, vel, pos = self._accel, self.velocities, self.particles
+
+        if mutual:
+            vel += 0.5 * dt * self._mutual_accel
+
+        # Only the fixed charges act inside the step, so particles substep independently. Slot s of
+        # max_substeps runs the particles whose (power of two) stride divides s, i.e. whose stride is
+        # at most the lowest set bit of s: a prefix of the particles sorted by stride
+        n_sub = self._substep_counts(dt, accel)
+        stride = self.max_substeps // n_sub
+        order = np.argsort(stride, kind='stable')
+        sorted_stride = stride[order]
+        h_all = (dt / n_sub).astype(self.dtype)[:, np.newaxis]
+        self.force_evals = 0
+        for s in range(0, self.max_substeps, int(sorted_stride[0])):
+            active = order[:np.searchsorted(sorted_stride, s & -s, side='right')] if s else slice(None)
+            h = h_all[active]
+            v = vel[active] + 0.5 * h * accel[active]
+            p = pos[active] + v * h
+            # Wrap around, as in the Euler step
+            np.mod(p, [self.width, self.height], out=p)
+            t0 = prof.tic() if prof else 0.0
+            a = self._charge_force(p)
+            if prof:
+                force_time += prof.tic() - t0
+            vel[active] = v + 0.5 * h * a
+            pos[active] = p
+            accel[active] = a
+            self.force_evals += a.shape[0]
+
+        if mutual:
+            t0 = prof.tic() if prof else 0.0
+            self._mutual_accel = self._mutual_force()
+            if prof:
+                force_time += prof.tic() - t0
+            vel += 0.5 * dt * self._mutual_accel
+        return force_time
+
+    def _profile_step(self, prof):
+        """Counters for one update: pairs summed (charges, plus mutual pairs) and bytes returned."""
+        prof.count('pairs_tested', self.force_evals * self.charges.shape[0])
+        if self.particle_interactions == 'direct':
+            n = self.particles.shape[0]
+            prof.count('mutual_pairs_tested', n * (n - 1))
+        prof.count('bytes_exported', self.particles.nbytes)
+        prof.end_step()
+
+    def _update_sharded(self, dt, prof=None):
+        """The Euler step of update() over the worker pool; mutual forces are evaluated up front, serially."""
+        import sharded
+        if self._pool is None:
+            self._pool = sharded.ShardPool(self.workers, owner=self)
+        n = self.particles.shape[0]
+        if self._shards[0] != n:
+            self._shards = (n, sharded.shard_bounds(n, self.workers))
+        bounds = self._shards[1]
+        mutual = self._mutual_force() if self.particle_interactions != 'none' else None
+        pos = self.particles
+
+        def task(i, barrier):
+            lo, hi = bounds[i]
+            p = prof if i == 0 else None # Worker 0 reports the phase times
+            t0 = p.tic() if p else 0.0
+            force = self._charge_force(pos[lo:hi])
+            if mutual is not None:
+                force += mutual[lo:hi]
+            barrier() # Every force is in before any position moves
+            if p:
+                t0 = p.toc('force', t0)
+            np.multiply(force, dt, out=force)
+            np.add(pos[lo:hi], force, out=pos[lo:hi])
+            np.mod(pos[lo:hi, 0], self.width, out=pos[lo:hi, 0])
+            np.mod(pos[lo:hi, 1], self.height, out=pos[lo:hi, 1])
+            if p:
+                p.toc('integrate', t0)
+
+        self._pool.run(task)
+
+    def close(self):
+        """Stops the worker threads, if any (they also stop when the instance is collected)."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def update(self, dt):
+        """
+        Updates the positions of the particles based on Coulomb forces using NumPy.
+        Assumes particle charge is +1 for simplicity.
+        """
+        mutual = self.particle_interactions != 'none'
+        if self.particles.shape[0] == 0 or (self.charges.shape[0] == 0 and not mutual):
+             return self.particles # Nothing to do
+
+        prof = self.profiler
+        t0 = prof.tic() if prof else 0.0
+        if self.integrator == 'verlet':
+            force_time = self._update_verlet(dt, prof)
+            if prof:
+                prof.add('force', force_time)
+                t0 = prof.toc('integrate', t0 + force_time) # Everything but the force evaluations
+                prof.toc('export', t0)
+                self._profile_step(prof)
+            return self.particles
+        self.force_evals = self.particles.shape[0]
+        if self.workers > 1:
+            self._update_sharded(dt, prof)
+            if prof:
+                self._profile_step(prof)
+            return self.particles
+
+        if self.preallocate:
+            total_force = self._force_inplace()
+        elif self.charges.shape[0] == 0:
+            total_force = np.zeros_like(self.particles)
+        elif self.force_mode == 'tiled':
+            total_force = self._tiled_force(self.particles, self.charges)
+        else:
+            total_force = self._pair_force(self.particles, self.charges)
+
+        if mutual:
+            total_force += self._mutual_force()
+        if prof:
+            t0 = prof.toc('force', t0)
 
         # Update particle positions using Euler's method
         # pos_new = pos_old + force * dt (ignoring mass for simplicity, force acts like acceleration)
-        self.particles += total_force * dt
+        np.multiply(total_force, dt, out=total_force)
+        np.add(self.particles, total_force, out=self.particles)
 
         # --- Boundary Conditions (Wrap around) ---
         # Wrap X
-        self.particles[:, 0] = np.mod(self.particles[:, 0], self.width)
+        np.mod(self.particles[:, 0], self.width, out=self.particles[:, 0])
         # Wrap Y
-        self.particles[:, 1] = np.mod(self.particles[:, 1], self.height)
+        np.mod(self.particles[:, 1], self.height, out=self.particles[:, 1])
+        if prof:
+            t0 = prof.toc('integrate', t0)
 
         # --- Boundary Conditions (Reflection - Alternative) ---
         # particles_x = self.particles[:, 0]
@@ -118,4 +451,7 @@ class Coulomb:
         # self.particles += self.velocities * dt
         # # Add velocity reflection for reflection boundary conditions
 
+        if prof:
+            prof.toc('export', t0) # The positions array itself is returned, nothing is copied
+            self._profile_step(prof)
         return self.particles # Return updated positions
\ No newline at end of file
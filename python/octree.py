@@ -2,31 +2,55 @@ import taichi as ti
 import taichi.math as tm # Use Taichi's math functions in kernels
 import numpy as np # Still useful for initial data generation, some constants
 import time
+import warnings
+
+from profiling import Profiler
 
 # --- Taichi Initialization ---
-# Try Vulkan first, fallback to cuda, metal, cpu.
-# You can force a specific backend e.g. ti.init(arch=ti.gpu) or ti.init(arch=ti.cpu)
-# OpenGL backend often needed for ti.ui if others fail on some drivers.
-try:
-    ti.init(arch=ti.vulkan)
-except:
-    try:
-        ti.init(arch=ti.cuda)
-    except:
+# Deferred until the first simulation is created (or init_taichi is called), so importing
+# this module does not probe backends. arch='auto' tries vulkan, cuda, metal, opengl, then cpu.
+# You can force a specific backend e.g. init_taichi('cpu', cpu_threads=8) or params['arch'] = 'cuda'.
+AUTO_ARCHS = ('vulkan', 'cuda', 'metal', 'opengl', 'cpu')
+
+def init_taichi(arch='auto', cpu_threads=None):
+    """
+    Initializes Taichi on first call and returns the active backend. Taichi cannot switch backends
+    without resetting every field, so later calls keep it and warn if they ask for a different one.
+    """
+    if ti.lang.impl.get_runtime().prog is not None:
+        cfg = ti.lang.impl.current_cfg()
+        if arch != 'auto' and getattr(ti, arch) != cfg.arch:
+            warnings.warn(f"Taichi already runs on {cfg.arch}; ignoring arch={arch!r}", RuntimeWarning, stacklevel=2)
+        if cpu_threads and int(cpu_threads) != cfg.cpu_max_num_threads:
+            warnings.warn(f"Taichi already runs with cpu_max_num_threads={cfg.cpu_max_num_threads}; "
+                          f"ignoring cpu_threads={cpu_threads}", RuntimeWarning, stacklevel=2)
+        return cfg.arch
+
+    options = {}
+    if cpu_threads:
+        options['cpu_max_num_threads'] = int(cpu_threads)
+    candidates = AUTO_ARCHS if arch == 'auto' else (arch,)
+    for i, name in enumerate(candidates):
         try:
-            ti.init(arch=ti.metal)
-        except:
-             try:
-                 ti.init(arch=ti.opengl) # Good fallback for UI
-             except:
-                 ti.init(arch=ti.cpu)
+            ti.init(arch=getattr(ti, name), **options)
+            break
+        except Exception:
+            if i == len(candidates) - 1:
+                raise
 
-print(f"Using Taichi backend: {ti.lang.impl.current_cfg().arch}")
+    print(f"Using Taichi backend: {ti.lang.impl.current_cfg().arch}")
+    return ti.lang.impl.current_cfg().arch
 
 @ti.data_oriented
 class ParticleSimulationTaichi:
     def __init__(self, params):
+        """
+        Headless simulation state. Rendering is optional: attach a ParticleRenderer
+        (or call run_visualization) to view a running simulation.
+        """
         self.params = params
+        init_taichi(params.get('arch', 'auto'), params.get('cpu_threads'))
+
         self.num_particles = params.get('num_particles', 1000)
         self.domain_size = tm.vec3(params.get('domain_size', 20.0))
         self.domain_center = tm.vec3(params.get('domain_center', [0, 5, 0]))
@@ -36,9 +60,10 @@ class ParticleSimulationTaichi:
         self.interaction_radius = ti.field(dtype=ti.f32, shape=())
         self.particle_radius = ti.field(dtype=ti.f32, shape=())
         self.gravity = ti.Vector.field(3, dtype=ti.f32, shape=())
-        self.boundary_mode = params.get('boundary_mode', 'reflect') # String, used in Python logic
+        self.boundary_mode = params.get('boundary_mode', 'reflect') # 'reflect', 'wrap' or 'open' (no walls)
         self.collision_k = params.get('collision_spring_k', 10000.0)
         self.damping = params.get('damping', 0.999) # Velocity damping factor
+        self.initial_velocity_range = params.get('initial_velocity_range', 3.0)
 
         # Set constant simulation parameters (can be fields if they need to change)
         self.interaction_radius[None] = params.get('interaction_radius', 0.4)
@@ -54,68 +79,153 @@ class ParticleSimulationTaichi:
         # --- Uniform Grid Setup ---
         # Cell size should be related to interaction radius for efficiency
         self.grid_cell_size = self.interaction_radius[None] * 2.0 # Common choice
-        self.grid_dims = tm.ceil(self.domain_size / self.grid_cell_size).cast(int)
-        self.num_grid_cells = self.grid_dims.x * self.grid_dims.y * self.grid_dims.z
-        print(f"Grid dimensions: {self.grid_dims}, Total cells: {self.num_grid_cells}")
+        self.grid_dims = tm.ivec3(np.ceil(np.asarray(self.domain_size.to_list()) / self.grid_cell_size).astype(int).tolist())
+        # 'dense' - one slot per cell of the domain (memory ~ domain volume)
+        # 'hash'  - cells hashed into a power-of-two table of hash_table_size slots (default
+        #           >= 2 * num_particles), so memory follows particle count; cells outside
+        #           the domain are fine, which suits boundary_mode 'open'
+        self.grid_type = params.get('grid', 'dense')
+        self.hashed_grid = self.grid_type == 'hash'
+        if self.hashed_grid:
+            table_size = int(params.get('hash_table_size', 2 * self.num_particles))
+            self.num_grid_cells = 1 << max(table_size - 1, 1).bit_length() # Round up to a power of two
+            print(f"Hashed grid: {self.num_grid_cells} slots")
+        else:
+            self.num_grid_cells = self.grid_dims.x * self.grid_dims.y * self.grid_dims.z
+            print(f"Grid dimensions: {self.grid_dims}, Total cells: {self.num_grid_cells}")
 
         # Grid data fields
         self.particle_grid_indices = ti.field(dtype=ti.i32, shape=self.num_particles) # Stores cell index for each particle
         self.particle_ids_sorted = ti.field(dtype=ti.i32, shape=self.num_particles) # Particle indices sorted by cell
         self.grid_cell_offsets = ti.field(dtype=ti.i32, shape=self.num_grid_cells + 1) # Start offset (+1 for end of last cell)
-
-        # Allocate temporary storage for radix sort if needed (Taichi might handle internally)
-        # self.sort_temp_keys = ti.field(dtype=ti.i32, shape=self.num_particles)
-        # self.sort_temp_values = ti.field(dtype=ti.i32, shape=self.num_particles)
+        if self.hashed_grid:
+            # Several cells can share a slot; the stored cell coordinate tells them apart
+            self.particle_cell_coords = ti.Vector.field(3, dtype=ti.i32, shape=self.num_particles)
+
+        # Binning engine used by update_grid:
+        #   'counting' - counting sort by cell + parallel block-wise exclusive scan (default)
+        #   'sort'     - full parallel_sort of (cell, id) pairs + serial scan
+        self.binning = params.get('binning', 'counting')
+        # Counting sort: rank of each particle within its cell, from the counting atomic_add
+        self.particle_cell_rank = ti.field(dtype=ti.i32, shape=self.num_particles)
+        # Exclusive scan works on blocks of scan_block cells: each block is summed and scanned
+        # in parallel, only the per-block totals are scanned serially
+        self.scan_block = int(params.get('scan_block', 256))
+        self.num_scan_blocks = (self.num_grid_cells + 1 + self.scan_block - 1) // self.scan_block
+        self.scan_block_sums = ti.field(dtype=ti.i32, shape=self.num_scan_blocks)
+
+        # --- Verlet neighbor lists (optional) ---
+        # Lists hold every neighbour within interaction_radius + skin and are rebuilt only once
+        # some particle has moved more than skin / 2 since the last build. With half_shell each
+        # pair is stored once (13 forward cells + own cell) and gets equal and opposite forces.
+        self.neighbor_list = bool(params.get('neighbor_list', False))
+        self.skin = float(params.get('skin', 0.1))
+        self.half_shell = bool(params.get('half_shell', False))
+        self.max_neighbors = int(params.get('max_neighbors', 64))
+        if self.neighbor_list:
+            if self.interaction_radius[None] + self.skin > self.grid_cell_size:
+                raise ValueError("skin must not exceed interaction_radius: the 3x3x3 cell stencil "
+                                 "only covers neighbours up to one cell size away")
+            self.neighbor_ids = ti.field(dtype=ti.i32, shape=(self.num_particles, self.max_neighbors))
+            self.neighbor_count = ti.field(dtype=ti.i32, shape=self.num_particles)
+            self.list_positions = ti.Vector.field(3, dtype=ti.f32, shape=self.num_particles) # Positions at last build
+        self.stencil = [(dx, dy, dz) for dz in (-1, 0, 1) for dy in (-1, 0, 1) for dx in (-1, 0, 1)]
+        if self.half_shell:
+            # Offsets with a positive linear cell delta; the own cell is handled by id ordering
+            self.stencil = [o for o in self.stencil if (o[2], o[1], o[0]) >= (0, 0, 0)]
+        self.list_valid = False
+        self.list_pairs = 0 # Pairs stored in the current lists (= pairs evaluated per step)
+        self.neighbor_counters = {'steps': 0, 'rebuilds': 0, 'pairs_evaluated': 0}
+
+        # --- Periodic reordering of particle storage (optional) ---
+        # Every reorder_interval steps all per-particle fields are permuted into 'morton'
+        # (Z-order of the grid coordinate) or 'cell' (binning) order so neighbours sit close
+        # in memory. particle_ext_ids keeps the caller-visible id of each storage slot.
+        self.reorder = params.get('reorder', None)
+        self.reorder_interval = int(params.get('reorder_interval', 100))
+        self.step_count = 0
+        self.storage_permuted = False
+        self.particle_ext_ids = ti.field(dtype=ti.i32, shape=self.num_particles)
+        if self.reorder:
+            self.reorder_keys = ti.field(dtype=ti.i32, shape=self.num_particles)
+            self.reorder_perm = ti.field(dtype=ti.i32, shape=self.num_particles)
+            self.reorder_positions = ti.Vector.field(3, dtype=ti.f32, shape=self.num_particles)
+            self.reorder_velocities = ti.Vector.field(3, dtype=ti.f32, shape=self.num_particles)
+            self.reorder_mass = ti.field(dtype=ti.f32, shape=self.num_particles)
+            self.reorder_ext_ids = ti.field(dtype=ti.i32, shape=self.num_particles)
+
+        # --- Instrumentation (optional) ---
+        # Per-phase timers synchronized with ti.sync, plus pairs tested / within radius counted in
+        # the force kernels and a particles-per-cell histogram. Disabled, the counting code is
+        # compiled out of the kernels and the Python hooks are a single check on None.
+        self.profile = bool(params.get('profile', False))
+        self.profiler = Profiler(sync=ti.sync) if self.profile else None
+        if self.profile:
+            self.pair_counters = ti.field(dtype=ti.i64, shape=2) # Pairs tested, pairs within radius
 
         # Initialize particles
         self.init_particles()
 
-        # Visualization setup
-        self.window = ti.ui.Window("Taichi Particle Simulation", (800, 800), vsync=True)
-        self.canvas = self.window.get_canvas()
-        self.scene = ti.ui.Scene()
-        self.camera = ti.ui.Camera()
-        self.camera.position(self.domain_center.x, self.domain_center.y, self.domain_center.z + self.domain_size.z * 1.2) # Adjust camera distance
-        self.camera.lookat(self.domain_center.x, self.domain_center.y, self.domain_center.z)
-        self.camera.up(0, 1, 0)
-
-
     @ti.kernel
     def init_particles(self):
-        vel_range = self.params.get('initial_velocity_range', 3.0)
+        vel_range = self.initial_velocity_range
         for i in range(self.num_particles):
             # Initialize within bounds
-            self.positions[i] = self.bounds_min + tm.rand(3) * self.domain_size
-            self.velocities[i] = (tm.rand(3) * 2.0 - 1.0) * vel_range
+            self.positions[i] = self.bounds_min + tm.vec3(ti.random(), ti.random(), ti.random()) * self.domain_size
+            self.velocities[i] = (tm.vec3(ti.random(), ti.random(), ti.random()) * 2.0 - 1.0) * vel_range
             self.mass[i] = 1.0 # Assume uniform mass for simplicity
             self.forces[i] = tm.vec3(0.0)
             self.particle_ids_sorted[i] = i # Initialize sorted IDs
+            self.particle_ext_ids[i] = i
 
 
-    @ti.func # Helper function usable within kernels
-    def get_grid_cell_index(self, pos):
-        """Calculates the 1D index for the grid cell containing pos."""
+    @ti.func
+    def get_grid_coord(self, pos):
+        """Integer 3D coordinate of the grid cell containing pos."""
         grid_coord = tm.floor((pos - self.bounds_min) / self.grid_cell_size).cast(int)
-        # Clamp coordinates to be within grid bounds (important for particles near max boundary)
-        grid_coord = tm.clamp(grid_coord, 0, self.grid_dims - 1)
-        # Convert 3D grid coord to 1D index
-        return grid_coord.x + grid_coord.y * self.grid_dims.x + grid_coord.z * self.grid_dims.x * self.grid_dims.y
+        if ti.static(not self.hashed_grid):
+            # Clamp coordinates to be within grid bounds (important for particles near max boundary)
+            grid_coord = tm.clamp(grid_coord, 0, self.grid_dims - 1)
+        return grid_coord
+
+    @ti.func
+    def get_cell_slot(self, grid_coord):
+        """Slot of a cell in grid_cell_offsets, or -1 for a cell outside the dense grid."""
+        slot = -1
+        if ti.static(self.hashed_grid):
+            c = ti.cast(grid_coord, ti.u32)
+            h = (c.x * ti.u32(73856093)) ^ (c.y * ti.u32(19349663)) ^ (c.z * ti.u32(83492791))
+            slot = ti.cast(h & ti.u32(self.num_grid_cells - 1), ti.i32)
+        elif (grid_coord >= 0).all() and (grid_coord < self.grid_dims).all():
+            # Convert 3D grid coord to 1D index
+            slot = grid_coord.x + grid_coord.y * self.grid_dims.x + grid_coord.z * self.grid_dims.x * self.grid_dims.y
+        return slot
+
+    @ti.func # Helper function usable within kernels
+    def get_grid_cell_index(self, i):
+        """Calculates the 1D slot for the grid cell containing particle i."""
+        grid_coord = self.get_grid_coord(self.positions[i])
+        if ti.static(self.hashed_grid):
+            self.particle_cell_coords[i] = grid_coord
+        return self.get_cell_slot(grid_coord)
+
+    @ti.func
+    def in_cell(self, n_idx, grid_coord):
+        """False if particle n_idx only shares the slot of grid_coord through a hash collision."""
+        result = True
+        if ti.static(self.hashed_grid):
+            result = (self.particle_cell_coords[n_idx] == grid_coord).all()
+        return result
 
     @ti.kernel
-    def update_grid(self):
+    def compute_cell_indices(self):
         # 1. Calculate cell index for each particle
         for i in range(self.num_particles):
-            self.particle_grid_indices[i] = self.get_grid_cell_index(self.positions[i])
+            self.particle_grid_indices[i] = self.get_grid_cell_index(i)
             self.particle_ids_sorted[i] = i # Reset value array for sorting
 
-        # 2. Sort particle IDs based on their cell indices
-        #    Taichi's sort_pairs sorts keys (grid indices) and permutes values (particle ids)
-        #    NOTE: Requires Taichi >= 1.6.0 for built-in radix sort supporting pairs
-        #    If using older Taichi, you might need a custom radix sort implementation.
-        ti.algorithms.custom_radix_sort_pairs(keys=self.particle_grid_indices, values=self.particle_ids_sorted)
-        # If sort is not available or you prefer manual: implement counting sort or radix sort logic here.
-
-
+    @ti.kernel
+    def compute_cell_offsets(self):
         # 3. Calculate cell offsets (prefix sum)
         self.grid_cell_offsets.fill(0) # Reset offsets/counts
         # Count particles per cell (using the *sorted* indices)
@@ -125,13 +235,77 @@ class ParticleSimulationTaichi:
             ti.atomic_add(self.grid_cell_offsets[cell_idx + 1], 1) # Use cell_idx+1 for prefix sum logic
 
         # Perform prefix sum (exclusive scan) on counts to get offsets
-        # This can be done with Taichi's scan algorithms or manually
-        # Manual sequential prefix sum (can be parallelized too)
+        # Manual sequential prefix sum: the outermost loop is parallel by default, so serialize it
+        ti.loop_config(serialize=True)
         for i in range(self.num_grid_cells):
             self.grid_cell_offsets[i+1] += self.grid_cell_offsets[i]
         # Now grid_cell_offsets[cell_idx] is the start index in particle_ids_sorted
         # and grid_cell_offsets[cell_idx+1] is the end index (exclusive)
 
+    @ti.kernel
+    def bin_particles_counting(self):
+        """Counting sort of particles into cells; each top-level loop is one parallel pass."""
+        n_offsets = self.num_grid_cells + 1
+        B = self.scan_block
+        # 1. Count particles per cell, remembering each particle's rank within its cell
+        for c in range(n_offsets):
+            self.grid_cell_offsets[c] = 0
+        for i in range(self.num_particles):
+            cell_idx = self.get_grid_cell_index(i)
+            self.particle_grid_indices[i] = cell_idx
+            self.particle_cell_rank[i] = ti.atomic_add(self.grid_cell_offsets[cell_idx], 1)
+
+        # 2. Exclusive scan of the counts, in place (reduce, scan block totals, scan blocks)
+        for b in range(self.num_scan_blocks):
+            total = 0
+            for c in range(b * B, ti.min((b + 1) * B, n_offsets)):
+                total += self.grid_cell_offsets[c]
+            self.scan_block_sums[b] = total
+        ti.loop_config(serialize=True)
+        for b in range(1, self.num_scan_blocks):
+            self.scan_block_sums[b] += self.scan_block_sums[b - 1] # Inclusive over blocks
+        for b in range(self.num_scan_blocks):
+            running = 0
+            if b > 0:
+                running = self.scan_block_sums[b - 1]
+            for c in range(b * B, ti.min((b + 1) * B, n_offsets)):
+                count = self.grid_cell_offsets[c]
+                self.grid_cell_offsets[c] = running
+                running += count
+
+        # 3. Scatter particle ids straight to their slot: cell start + rank
+        for i in range(self.num_particles):
+            slot = self.grid_cell_offsets[self.particle_grid_indices[i]] + self.particle_cell_rank[i]
+            self.particle_ids_sorted[slot] = i
+
+    def update_grid(self):
+        if self.binning == 'counting':
+            self.bin_particles_counting()
+            return
+
+        self.compute_cell_indices()
+
+        # 2. Sort particle IDs based on their cell indices
+        #    Taichi's parallel_sort sorts keys (grid indices) and permutes values (particle ids).
+        #    It launches its own kernels, so it runs from Python scope between the two kernels.
+        ti.algorithms.parallel_sort(self.particle_grid_indices, self.particle_ids_sorted)
+
+        self.compute_cell_offsets()
+
+    @ti.func
+    def pair_force(self, dist_vec, dist_sq):
+        """Force on a particle from a neighbour at dist_vec (neighbour - particle) within the radius."""
+        force = tm.vec3(0.0)
+        min_dist_particle = self.particle_radius[None] * 2.0
+        # Collision check (simple spring repulsion)
+        if dist_sq < min_dist_particle * min_dist_particle:
+            dist = tm.sqrt(dist_sq)
+            overlap = min_dist_particle - dist
+            force_dir = dist_vec / dist
+            force -= force_dir * self.collision_k * overlap * 0.5 # Share force
+        # --- Add other forces here (e.g., Lennard-Jones, attraction) ---
+        return force
+
     @ti.kernel
     def calculate_forces(self):
         # Clear forces from previous step
@@ -139,17 +313,16 @@ class ParticleSimulationTaichi:
             self.forces[i] = self.gravity[None] * self.mass[i]
 
         inter_radius_sq = self.interaction_radius[None]**2
-        min_dist_particle = self.particle_radius[None] * 2.0
-        min_dist_sq = min_dist_particle * min_dist_particle
 
         # Iterate through each particle ('p_idx' is the ORIGINAL particle index)
         for p_idx_orig in range(self.num_particles):
             pos_p = self.positions[p_idx_orig]
             mass_p = self.mass[p_idx_orig]
             force_p = tm.vec3(0.0) # Accumulate interaction forces locally
+            tested, within = 0, 0
 
             # Get grid cell coordinates of particle p
-            grid_coord_p = tm.floor((pos_p - self.bounds_min) / self.grid_cell_size).cast(int)
+            grid_coord_p = self.get_grid_coord(pos_p)
 
             # Iterate through the 3x3x3 neighboring cells (including p's own cell)
             for dx in range(-1, 2):
@@ -157,14 +330,9 @@ class ParticleSimulationTaichi:
                     for dz in range(-1, 2):
                         neighbor_grid_coord = grid_coord_p + tm.ivec3(dx, dy, dz)
 
-                        # Check if neighbor cell is within grid bounds
-                        if (tm.all(neighbor_grid_coord >= 0) and
-                            tm.all(neighbor_grid_coord < self.grid_dims)):
-
-                            # Get 1D index of neighbor cell
-                            neighbor_cell_idx = neighbor_grid_coord.x + \
-                                                neighbor_grid_coord.y * self.grid_dims.x + \
-                                                neighbor_grid_coord.z * self.grid_dims.x * self.grid_dims.y
+                        # Get 1D slot of neighbor cell (-1 if outside the dense grid bounds)
+                        neighbor_cell_idx = self.get_cell_slot(neighbor_grid_coord)
+                        if neighbor_cell_idx >= 0:
 
                             # Get start and end indices for particles in this neighbor cell
                             start_idx = self.grid_cell_offsets[neighbor_cell_idx]
@@ -175,25 +343,19 @@ class ParticleSimulationTaichi:
                                 # Get the ORIGINAL index ('n_idx_orig') of the neighbor particle
                                 n_idx_orig = self.particle_ids_sorted[n_sorted_idx]
 
-                                # Don't interact with self
-                                if p_idx_orig == n_idx_orig:
+                                # Don't interact with self, or with hash-colliding cells
+                                if p_idx_orig == n_idx_orig or not self.in_cell(n_idx_orig, neighbor_grid_coord):
                                     continue
 
                                 pos_n = self.positions[n_idx_orig]
                                 dist_vec = pos_n - pos_p
-                                dist_sq = tm.length_sq(dist_vec)
+                                dist_sq = dist_vec.norm_sqr()
+                                tested += 1
 
-                                # Check if within interaction radius AND potential collision
+                                # Check if within interaction radius
                                 if dist_sq < inter_radius_sq and dist_sq > 1e-9: # Avoid division by zero
-                                    # Collision check (simple spring repulsion)
-                                    if dist_sq < min_dist_sq:
-                                        dist = tm.sqrt(dist_sq)
-                                        overlap = min_dist_particle - dist
-                                        force_dir = dist_vec / dist
-                                        repulsion_force = force_dir * self.collision_k * overlap * 0.5 # Share force
-                                        force_p -= repulsion_force
-
-                                    # --- Add other forces here (e.g., Lennard-Jones, attraction) ---
+                                    force_p += self.pair_force(dist_vec, dist_sq)
+                                    within += 1
 
 
             # Atomically add the locally accumulated forces to the global force field
@@ -203,7 +365,103 @@ class ParticleSimulationTaichi:
             # Correction: Since each outer loop iteration calculates force for *one* specific
             # p_idx_orig, writing directly to self.forces[p_idx_orig] should be safe.
             self.forces[p_idx_orig] += force_p
+            if ti.static(self.profile):
+                ti.atomic_add(self.pair_counters[0], tested)
+                ti.atomic_add(self.pair_counters[1], within)
+
 
+    @ti.kernel
+    def build_neighbor_list(self) -> ti.i64:
+        """Fills the lists from the current grid; returns the number of stored pairs, or -1 on overflow."""
+        list_radius = self.interaction_radius[None] + self.skin
+        list_radius_sq = list_radius * list_radius
+        total = ti.i64(0)
+        overflow = 0
+        for p_idx in range(self.num_particles):
+            pos_p = self.positions[p_idx]
+            self.list_positions[p_idx] = pos_p
+            grid_coord_p = self.get_grid_coord(pos_p)
+            count = 0
+            for offset in ti.static(self.stencil):
+                neighbor_grid_coord = grid_coord_p + tm.ivec3(offset[0], offset[1], offset[2])
+                neighbor_cell_idx = self.get_cell_slot(neighbor_grid_coord)
+                if neighbor_cell_idx >= 0:
+                    for n_sorted_idx in range(self.grid_cell_offsets[neighbor_cell_idx],
+                                              self.grid_cell_offsets[neighbor_cell_idx + 1]):
+                        n_idx = self.particle_ids_sorted[n_sorted_idx]
+                        keep = n_idx != p_idx and self.in_cell(n_idx, neighbor_grid_coord)
+                        if ti.static(self.half_shell and offset == (0, 0, 0)):
+                            keep = keep and n_idx > p_idx # Own cell: each pair once, by id
+                        if keep and (self.positions[n_idx] - pos_p).norm_sqr() < list_radius_sq:
+                            if count < self.max_neighbors:
+                                self.neighbor_ids[p_idx, count] = n_idx
+                            count += 1
+            if count > self.max_neighbors:
+                overflow += 1
+                count = self.max_neighbors
+            self.neighbor_count[p_idx] = count
+            total += count
+        if overflow > 0:
+            total = -1
+        return total
+
+    @ti.kernel
+    def max_displacement_sq(self) -> ti.f32:
+        """Largest squared distance any particle has moved since the lists were built."""
+        result = 0.0
+        for i in range(self.num_particles):
+            ti.atomic_max(result, (self.positions[i] - self.list_positions[i]).norm_sqr())
+        return result
+
+    @ti.kernel
+    def calculate_forces_neighbor_list(self):
+        for i in range(self.num_particles):
+            self.forces[i] = self.gravity[None] * self.mass[i]
+
+        inter_radius_sq = self.interaction_radius[None]**2
+        for p_idx in range(self.num_particles):
+            pos_p = self.positions[p_idx]
+            force_p = tm.vec3(0.0)
+            within = 0
+            for k in range(self.neighbor_count[p_idx]):
+                n_idx = self.neighbor_ids[p_idx, k]
+                dist_vec = self.positions[n_idx] - pos_p
+                dist_sq = dist_vec.norm_sqr()
+                if dist_sq < inter_radius_sq and dist_sq > 1e-9:
+                    f = self.pair_force(dist_vec, dist_sq)
+                    force_p += f
+                    within += 1
+                    if ti.static(self.half_shell):
+                        ti.atomic_sub(self.forces[n_idx], f) # Newton's third law
+            if ti.static(self.half_shell):
+                ti.atomic_add(self.forces[p_idx], force_p)
+            else:
+                self.forces[p_idx] += force_p
+            if ti.static(self.profile):
+                ti.atomic_add(self.pair_counters[0], self.neighbor_count[p_idx])
+                ti.atomic_add(self.pair_counters[1], within)
+
+    def update_neighbor_list(self):
+        """Rebuilds grid and lists if they are stale (some particle moved more than skin / 2)."""
+        if self.list_valid and self.max_displacement_sq() <= (0.5 * self.skin) ** 2:
+            return
+        self.update_grid()
+        pairs = self.build_neighbor_list()
+        if pairs < 0:
+            raise RuntimeError(f"Neighbor list overflow: some particles have more than "
+                               f"{self.max_neighbors} neighbours; increase params['max_neighbors']")
+        self.list_pairs = pairs
+        self.list_valid = True
+        self.neighbor_counters['rebuilds'] += 1
+
+    def neighbor_list_stats(self):
+        """Counters for tuning the skin: rebuild frequency and pairs evaluated."""
+        c = self.neighbor_counters
+        steps = max(c['steps'], 1)
+        return {**c,
+                'rebuild_frequency': c['rebuilds'] / steps,
+                'pairs_per_step': c['pairs_evaluated'] / steps,
+                'mean_neighbors': self.list_pairs / max(self.num_particles, 1)}
 
     @ti.kernel
     def update_particles(self, dt: ti.f32):
@@ -232,16 +490,215 @@ class ParticleSimulationTaichi:
                           self.positions[i][d] -= self.domain_size[d]
 
 
+    @ti.func
+    def spread_bits(self, v):
+        """Inserts two zero bits between each of the low 10 bits of v (Morton encoding)."""
+        x = ti.cast(v, ti.u32) & ti.u32(0x3FF)
+        x = (x | (x << 16)) & ti.u32(0x030000FF)
+        x = (x | (x << 8)) & ti.u32(0x0300F00F)
+        x = (x | (x << 4)) & ti.u32(0x030C30C3)
+        x = (x | (x << 2)) & ti.u32(0x09249249)
+        return x
+
+    @ti.kernel
+    def compute_morton_keys(self):
+        for i in range(self.num_particles):
+            # Grid cell coordinate folded into 10 bits per axis (cells beyond 1024 alias)
+            c = self.get_grid_coord(self.positions[i])
+            key = self.spread_bits(c.x) | (self.spread_bits(c.y) << 1) | (self.spread_bits(c.z) << 2)
+            self.reorder_keys[i] = ti.cast(key, ti.i32)
+            self.reorder_perm[i] = i
+
+    @ti.kernel
+    def copy_cell_order(self):
+        for i in range(self.num_particles):
+            self.reorder_perm[i] = self.particle_ids_sorted[i]
+
+    @ti.kernel
+    def gather_particles(self):
+        """Applies reorder_perm (new slot -> old slot) to every per-particle field."""
+        for k in range(self.num_particles):
+            old = self.reorder_perm[k]
+            self.reorder_positions[k] = self.positions[old]
+            self.reorder_velocities[k] = self.velocities[old]
+            self.reorder_mass[k] = self.mass[old]
+            self.reorder_ext_ids[k] = self.particle_ext_ids[old]
+        for k in range(self.num_particles):
+            self.positions[k] = self.reorder_positions[k]
+            self.velocities[k] = self.reorder_velocities[k]
+            self.mass[k] = self.reorder_mass[k]
+            self.particle_ext_ids[k] = self.reorder_ext_ids[k]
+
+    def reorder_particles(self):
+        """Permutes particle storage into self.reorder order; external ids follow the particles."""
+        if self.reorder == 'cell':
+            self.update_grid()
+            self.copy_cell_order()
+        else:
+            self.compute_morton_keys()
+            ti.algorithms.parallel_sort(self.reorder_keys, self.reorder_perm)
+        self.gather_particles()
+        self.storage_permuted = True
+        self.list_valid = False # Lists store storage slots
+
+    def get_positions(self):
+        """Positions as an (N, 3) NumPy array indexed by external particle id."""
+        return self._export(self.positions)
+
+    def get_velocities(self):
+        """Velocities as an (N, 3) NumPy array indexed by external particle id."""
+        return self._export(self.velocities)
+
+    def _export(self, field):
+        prof = self.profiler
+        t0 = prof.tic() if prof else 0.0
+        values = self._by_external_id(field.to_numpy())
+        if prof:
+            prof.toc('export', t0)
+            prof.count('bytes_exported', values.nbytes)
+        return values
+
+    def _by_external_id(self, values):
+        if not self.storage_permuted:
+            return values
+        out = np.empty_like(values)
+        out[self.particle_ext_ids.to_numpy()] = values
+        return out
+
+    def _profile_grid(self, prof):
+        """
+        Adds the current particles-per-cell counts to the profiler's histogram. A hash slot can hold
+        several cells, so the hashed grid bins particles by their cell coordinate instead; there
+        the zero bin stays empty, since cells outside the domain have no fixed count.
+        """
+        if self.hashed_grid:
+            _, counts = np.unique(self.particle_cell_coords.to_numpy(), axis=0, return_counts=True)
+        else:
+            counts = np.diff(self.grid_cell_offsets.to_numpy())
+        prof.histogram('particles_per_cell', np.bincount(counts))
+
+    def _profile_pairs(self, prof):
+        counts = self.pair_counters.to_numpy()
+        prof.count('pairs_tested', int(counts[0]))
+        prof.count('pairs_in_radius', int(counts[1]))
+        self.pair_counters.fill(0)
+
     def step(self, dt):
         """Performs one simulation step."""
-        # 1. Update the spatial grid based on current positions
-        self.update_grid()
-        # 2. Calculate forces based on neighbors found via the grid
-        self.calculate_forces()
+        prof = self.profiler
+        t0 = prof.tic() if prof else 0.0
+        if self.reorder and self.step_count % self.reorder_interval == 0:
+            self.reorder_particles()
+            if prof:
+                t0 = prof.toc('reorder', t0)
+        self.step_count += 1
+
+        if self.neighbor_list:
+            rebuilds = self.neighbor_counters['rebuilds']
+            # 1-2. Refresh grid and Verlet lists only when stale, then sweep the lists
+            self.update_neighbor_list()
+            if prof:
+                t0 = prof.toc('update_neighbor_list', t0)
+            self.calculate_forces_neighbor_list()
+            self.neighbor_counters['steps'] += 1
+            self.neighbor_counters['pairs_evaluated'] += self.list_pairs
+            regridded = self.neighbor_counters['rebuilds'] != rebuilds
+        else:
+            # 1. Update the spatial grid based on current positions
+            self.update_grid()
+            if prof:
+                t0 = prof.toc('update_grid', t0)
+            # 2. Calculate forces based on neighbors found via the grid
+            self.calculate_forces()
+            regridded = True
+        if prof:
+            t0 = prof.toc('calculate_forces', t0)
         # 3. Update particle positions and velocities
         self.update_particles(dt)
 
+        if prof:
+            prof.toc('update_particles', t0)
+            # Counter readback stays outside the timed phases
+            if regridded:
+                self._profile_grid(prof)
+            self._profile_pairs(prof)
+            prof.end_step()
+
+    def run(self, n_steps, dt=0.01, stride=1):
+        """
+        Advances n_steps without rendering and returns (positions, velocities) as NumPy
+        arrays of shape (n_steps // stride, num_particles, 3), sampled after every stride-th step
+        and indexed by external particle id.
+        """
+        if stride < 1:
+            raise ValueError("stride must be at least 1")
+        n_frames = n_steps // stride
+        positions = np.empty((n_frames, self.num_particles, 3), dtype=np.float32)
+        velocities = np.empty((n_frames, self.num_particles, 3), dtype=np.float32)
+        for step in range(1, n_steps + 1):
+            self.step(dt)
+            if step % stride == 0:
+                frame = step // stride - 1
+                positions[frame] = self.get_positions()
+                velocities[frame] = self.get_velocities()
+        return positions, velocities
+
     def run_visualization(self, dt=0.01, steps_per_frame=1):
+        """Opens a ParticleRenderer on this simulation and runs until the window closes."""
+        ParticleRenderer(self).run(dt=dt, steps_per_frame=steps_per_frame)
+
+
+class ParticleRenderer:
+    """ti.ui window that attaches to a (possibly already running) ParticleSimulationTaichi."""
+
+    def __init__(self, sim, resolution=(800, 800)):
+        self.sim = sim
+        self.window = ti.ui.Window("Taichi Particle Simulation", resolution, vsync=True)
+        self.canvas = self.window.get_canvas()
+        self.scene = ti.ui.Scene()
+        self.camera = ti.ui.Camera()
+        center, size = sim.domain_center, sim.domain_size
+        self.camera.position(center.x, center.y, center.z + size.z * 1.2) # Adjust camera distance
+        self.camera.lookat(center.x, center.y, center.z)
+        self.camera.up(0, 1, 0)
+
+        # Bounding box lines, uploaded once
+        lo, hi = sim.bounds_min, sim.bounds_max
+        box_corners = np.array([
+            [lo[0], lo[1], lo[2]], [hi[0], lo[1], lo[2]], [hi[0], hi[1], lo[2]], [lo[0], hi[1], lo[2]],
+            [lo[0], lo[1], hi[2]], [hi[0], lo[1], hi[2]], [hi[0], hi[1], hi[2]], [lo[0], hi[1], hi[2]],
+        ], dtype=np.float32)
+        box_lines_indices = np.array([
+            [0, 1], [1, 2], [2, 3], [3, 0],  # Bottom face
+            [4, 5], [5, 6], [6, 7], [7, 4],  # Top face
+            [0, 4], [1, 5], [2, 6], [3, 7]   # Connecting edges
+        ], dtype=np.int32)
+        self.box_corners = ti.Vector.field(3, ti.f32, shape=box_corners.shape[0])
+        self.box_lines_indices = ti.field(ti.i32, shape=box_lines_indices.size)
+        self.box_corners.from_numpy(box_corners)
+        self.box_lines_indices.from_numpy(box_lines_indices.flatten())
+
+    def render(self):
+        """Draws the simulation's current state into the window."""
+        sim = self.sim
+        self.scene.set_camera(self.camera)
+        self.scene.ambient_light((0.5, 0.5, 0.5))
+        # Point light source for better shading
+        self.scene.point_light(pos=(sim.domain_center.x + sim.domain_size.x,
+                                    sim.domain_center.y + sim.domain_size.y,
+                                    sim.domain_center.z + sim.domain_size.z),
+                               color=(1, 1, 1))
+
+        # Draw particles
+        self.scene.particles(sim.positions, radius=sim.particle_radius[None], color=(0.2, 0.6, 1.0))
+        # Draw bounding box
+        self.scene.lines(self.box_corners, indices=self.box_lines_indices, color=(0.8, 0.8, 0.8), width=1.0)
+
+        # Render the scene
+        self.canvas.scene(self.scene)
+        self.window.show()
+
+    def run(self, dt=0.01, steps_per_frame=1):
         """Runs the simulation loop with ti.ui visualization."""
         frame = 0
         last_time = time.time()
@@ -249,50 +706,13 @@ class ParticleSimulationTaichi:
         while self.window.running:
             # Run simulation steps
             for _ in range(steps_per_frame):
-                self.step(dt)
-
-            # Setup scene
-            self.scene.set_camera(self.camera)
-            self.scene.ambient_light((0.5, 0.5, 0.5))
-            # Point light source for better shading
-            self.scene.point_light(pos=(self.domain_center.x + self.domain_size.x,
-                                        self.domain_center.y + self.domain_size.y,
-                                        self.domain_center.z + self.domain_size.z),
-                                   color=(1, 1, 1))
-
-            # Draw particles
-            self.scene.particles(self.positions, radius=self.particle_radius[None], color=(0.2, 0.6, 1.0))
-
-            # Draw bounding box (optional)
-            box_corners = np.array([
-                [self.bounds_min[0], self.bounds_min[1], self.bounds_min[2]],
-                [self.bounds_max[0], self.bounds_min[1], self.bounds_min[2]],
-                [self.bounds_max[0], self.bounds_max[1], self.bounds_min[2]],
-                [self.bounds_min[0], self.bounds_max[1], self.bounds_min[2]],
-                [self.bounds_min[0], self.bounds_min[1], self.bounds_max[2]],
-                [self.bounds_max[0], self.bounds_min[1], self.bounds_max[2]],
-                [self.bounds_max[0], self.bounds_max[1], self.bounds_max[2]],
-                [self.bounds_min[0], self.bounds_max[1], self.bounds_max[2]],
-            ])
-            box_lines_indices = np.array([
-                [0, 1], [1, 2], [2, 3], [3, 0],  # Bottom face
-                [4, 5], [5, 6], [6, 7], [7, 4],  # Top face
-                [0, 4], [1, 5], [2, 6], [3, 7]   # Connecting edges
-            ], dtype=np.int32)
-            self.scene.lines(ti.Vector.field(3,ti.f32, shape=box_corners.shape[0]),
-                             indices=ti.field(ti.i32, shape=box_lines_indices.shape[0]*2),
-                             color=(0.8, 0.8, 0.8), width=1.0)
-            # Need to copy data to the fields for lines (ti.ui limitation sometimes)
-            # Possible bug/feature: scene.lines might expect fields directly
-            box_corners_field = ti.Vector.field(3, ti.f32, shape=box_corners.shape[0])
-            box_lines_indices_field = ti.field(ti.i32, shape=box_lines_indices.flatten().shape[0])
-            box_corners_field.from_numpy(box_corners)
-            box_lines_indices_field.from_numpy(box_lines_indices.flatten())
-            self.scene.lines(box_corners_field, indices=box_lines_indices_field, color=(0.8, 0.8, 0.8), width=1.0)
-
-            # Render the scene
-            self.canvas.scene(self.scene)
-            self.window.show()
+                self.sim.step(dt)
+
+            prof = self.sim.profiler
+            t0 = prof.tic() if prof else 0.0
+            self.render()
+            if prof:
+                prof.toc('render', t0)
 
             frame += 1
             current_time = time.time()
@@ -305,6 +725,15 @@ class ParticleSimulationTaichi:
 
 # --- Example Usage ---
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Taichi particle simulation")
+    parser.add_argument('--headless', action='store_true', help="Step without a window and report timing")
+    parser.add_argument('--steps', type=int, default=1000, help="Steps to run in headless mode")
+    parser.add_argument('--arch', default='auto', help="Taichi backend: auto, cpu, cuda, vulkan, metal, opengl")
+    parser.add_argument('--cpu-threads', type=int, default=None, help="Thread count for the cpu backend")
+    args = parser.parse_args()
+
     sim_params = {
         'num_particles': 20000,        # Can handle much more now!
         'domain_size': [20.0, 20.0, 20.0],
@@ -312,13 +741,22 @@ if __name__ == "__main__":
         'gravity': [0, -5.0, 0],       # Adjusted gravity
         'interaction_radius': 0.4,     # Interaction check radius
         'particle_radius': 0.05,        # Visual radius
-        'boundary_mode': 'reflect',    # 'reflect' or 'wrap'
+        'boundary_mode': 'reflect',    # 'reflect', 'wrap' or 'open'
         'initial_velocity_range': 5.0,
         'collision_spring_k': 20000.0, # Stiffness of collision
-        'damping': 0.99                 # Velocity damping
+        'damping': 0.99,                # Velocity damping
+        'arch': args.arch,
+        'cpu_threads': args.cpu_threads,
     }
 
     simulation = ParticleSimulationTaichi(sim_params)
 
-    # Run with visualization
-    simulation.run_visualization(dt=0.01, steps_per_frame=2) # Adjust dt and steps_per_frame
\ No newline at end of file
+    if args.headless:
+        start = time.time()
+        positions, velocities = simulation.run(args.steps, dt=0.01, stride=max(1, args.steps // 10))
+        elapsed = time.time() - start
+        print(f"{args.steps} steps in {elapsed:.2f}s ({args.steps / elapsed:.1f} steps/s), "
+              f"{positions.shape[0]} frames captured")
+    else:
+        # Run with visualization
+        simulation.run_visualization(dt=0.01, steps_per_frame=2) # Adjust dt and steps_per_frame
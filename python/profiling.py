@@ -0,0 +1,114 @@
+"""
+Per-phase timers and counters for the simulation engines.
+
+Engines create a Profiler when constructed with params['profile'] = True and keep it in
+self.profiler; otherwise self.profiler is None and every hook reduces to one `if` on None.
+Phases are timed with tic()/toc() pairs, which call the device sync function (ti.sync for
+Taichi) before reading the clock, so asynchronous kernels are charged to the right phase.
+
+    sim = Coulomb(800, 600, {'n_particles': 10_000, 'profile': True})
+    for _ in range(100):
+        sim.update(0.01)
+    sim.profiler.records()   # [{'kind': 'phase', 'name': 'force', 'calls': 100, ...}, ...]
+
+Imported lazily by test.py and main.py (only profiling runs need it, and it is not shipped to Pyodide).
+"""
+import json
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+
+class Profiler:
+    def __init__(self, sync: Optional[Callable[[], None]] = None, keep_samples: int = 1024):
+        """
+        sync is called before every clock read (None for synchronous engines). The last keep_samples
+        durations of each phase are kept for percentiles; 0 keeps aggregates only.
+        """
+        self.sync = sync
+        self.keep_samples = int(keep_samples)
+        self.reset()
+
+    def reset(self) -> None:
+        self.steps = 0
+        self.phases: Dict[str, List[float]] = {}   # name -> [calls, total, min, max]
+        self.samples: Dict[str, deque] = {}
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, np.ndarray] = {}
+
+    def tic(self) -> float:
+        if self.sync is not None:
+            self.sync()
+        return time.perf_counter()
+
+    def toc(self, phase: str, t0: float) -> float:
+        """Charges the time since t0 to phase and returns the current time, so phases can be chained."""
+        now = self.tic()
+        self.add(phase, now - t0)
+        return now
+
+    def add(self, phase: str, seconds: float) -> None:
+        stats = self.phases.get(phase)
+        if stats is None:
+            self.phases[phase] = [1, seconds, seconds, seconds]
+            if self.keep_samples:
+                self.samples[phase] = deque([seconds], maxlen=self.keep_samples)
+            return
+        stats[0] += 1
+        stats[1] += seconds
+        if seconds < stats[2]:
+            stats[2] = seconds
+        if seconds > stats[3]:
+            stats[3] = seconds
+        if self.keep_samples:
+            self.samples[phase].append(seconds)
+
+    def count(self, name: str, value: float = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def histogram(self, name: str, counts: np.ndarray) -> None:
+        """Accumulates a bincount-style histogram (index = value, entry = occurrences)."""
+        counts = np.asarray(counts, dtype=np.int64)
+        acc = self.histograms.get(name)
+        if acc is None or acc.shape[0] < counts.shape[0]:
+            grown = np.zeros(counts.shape[0], dtype=np.int64)
+            if acc is not None:
+                grown[:acc.shape[0]] = acc
+            acc = self.histograms[name] = grown
+        acc[:counts.shape[0]] += counts
+
+    def end_step(self) -> None:
+        self.steps += 1
+
+    def records(self) -> List[Dict[str, Any]]:
+        """Phases, counters and histograms as flat dicts (seconds; per_step is per end_step call)."""
+        steps = max(self.steps, 1)
+        out = []
+        for name, (calls, total, lo, hi) in self.phases.items():
+            rec = {'kind': 'phase', 'name': name, 'calls': calls, 'total_s': total,
+                   'mean_s': total / calls, 'min_s': lo, 'max_s': hi, 'per_step_s': total / steps}
+            if self.keep_samples:
+                p50, p95, p99 = np.percentile(np.fromiter(self.samples[name], dtype=np.float64), (50, 95, 99))
+                rec.update(p50_s=float(p50), p95_s=float(p95), p99_s=float(p99))
+            out.append(rec)
+        for name, value in self.counters.items():
+            out.append({'kind': 'counter', 'name': name, 'value': value, 'per_step': value / steps})
+        for name, counts in self.histograms.items():
+            out.append({'kind': 'histogram', 'name': name, 'counts': counts.tolist()})
+        return out
+
+    def to_json(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump({'steps': self.steps, 'records': self.records()}, f, indent=1)
+
+    def report(self) -> str:
+        """Human-readable table of the phase timings and counters."""
+        lines = [f"{self.steps} steps", f"{'phase':>22} {'calls':>7} {'mean (ms)':>10} {'per step (ms)':>14}"]
+        for rec in self.records():
+            if rec['kind'] == 'phase':
+                lines.append(f"{rec['name']:>22} {rec['calls']:>7} {rec['mean_s']*1e3:>10.3f} {rec['per_step_s']*1e3:>14.3f}")
+            elif rec['kind'] == 'counter':
+                lines.append(f"{rec['name']:>22} {rec['value']:>18.0f} ({rec['per_step']:.1f}/step)")
+        return "\n".join(lines)
@@ -0,0 +1,80 @@
+"""
+Persistent worker pool for stepping the NumPy Coulomb engines on several cores.
+
+The particles are split into fixed contiguous shards, one per worker. Each step every worker
+evaluates the fixed-charge force for its own rows, waits at a barrier until all forces are in,
+then integrates its rows. Workers are threads: NumPy releases the GIL inside its ufuncs and
+reductions, and threads share the engine's particle and charge arrays directly, so nothing is
+copied or pickled per step. Each row's force and update are computed exactly as in the serial
+step, so results match serial stepping bit-for-bit whatever the worker count.
+
+Used through params['workers'] in main.Coulomb and test.Coulomb; imported lazily because
+Pyodide has no threads.
+"""
+import threading
+import weakref
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+
+def shard_bounds(n: int, n_shards: int) -> List[Tuple[int, int]]:
+    """Contiguous [lo, hi) row ranges covering n rows, sizes differing by at most one."""
+    edges = np.linspace(0, n, n_shards + 1).round().astype(int)
+    return list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+
+
+class ShardPool:
+    def __init__(self, n_workers: int, owner=None):
+        """Starts n_workers daemon threads that wait for run() calls; they exit when owner is collected."""
+        self.n_workers = max(1, int(n_workers))
+        self._start = threading.Barrier(self.n_workers + 1)
+        self._done = threading.Barrier(self.n_workers + 1)
+        self._phase = threading.Barrier(self.n_workers) # Between force and integration
+        self._task = None
+        self._errors = []
+        self._threads = [threading.Thread(target=self._worker, args=(i,), daemon=True, name=f"shard-{i}")
+                         for i in range(self.n_workers)]
+        for t in self._threads:
+            t.start()
+        if owner is not None:
+            weakref.finalize(owner, self.close)
+
+    def _worker(self, index: int) -> None:
+        while True:
+            self._start.wait()
+            task = self._task
+            if task is None: # close()
+                return
+            try:
+                task(index, self._phase.wait)
+            except threading.BrokenBarrierError:
+                pass # Another worker failed and aborted the phase barrier
+            except BaseException as e:
+                self._errors.append(e)
+                self._phase.abort()
+            task = None # Do not keep the owner alive between steps
+            self._done.wait()
+
+    def run(self, task: Callable[[int, Callable[[], None]], None]) -> None:
+        """
+        Calls task(worker_index, barrier) on every worker and returns once all have finished.
+        barrier() blocks until every worker has reached it. The first worker exception is re-raised.
+        """
+        self._task = task
+        self._start.wait()
+        self._done.wait()
+        self._task = None
+        if self._errors:
+            error = self._errors[0]
+            self._errors = []
+            self._phase.reset()
+            raise error
+
+    def close(self) -> None:
+        if self._threads:
+            self._task = None
+            self._start.wait()
+            for t in self._threads:
+                t.join()
+            self._threads = []
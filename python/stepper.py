@@ -0,0 +1,287 @@
+"""
+Background stepping of a simulation into a ring of preallocated frame buffers.
+
+AsyncStepper runs the engine on a producer thread, ahead of the consumer (a render loop, a
+recorder, an asyncio task). After every frame's steps it copies the frame into a free ring slot
+and publishes it. A slot is never written while a consumer holds it, and a published slot is
+never modified, so consumers never see a torn frame. Policies decide what happens when the
+consumer falls behind:
+
+    'block'    - lossless FIFO: the producer waits for a free slot
+    'drop'     - FIFO, never waits: the oldest unread frame is overwritten (counted in 'dropped')
+    'decouple' - the producer paces itself to `rate` frames/s (or free-runs when None),
+                 independent of the consumer, which reads the newest frame with latest()
+
+Consumers use next() for frames in order, or latest() for the newest one (skipping older
+unread frames). Both return a Frame that must be released; use it as a context manager.
+metrics() reports produced/consumed/dropped counts, queue depth and publish-to-consume
+latency percentiles for sizing the ring.
+
+Works with test.Coulomb and main.Coulomb (update) and ParticleSimulationTaichi (step).
+Not loaded by Pyodide, which has no threads.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+
+POLICIES = ('block', 'drop', 'decouple')
+
+
+def default_extract(sim) -> Dict[str, np.ndarray]:
+    """The arrays a renderer draws: test.Coulomb's frame buffer, main.Coulomb's positions, Taichi's positions."""
+    if hasattr(sim, 'frame'):
+        return {'frame': sim.frame}
+    if hasattr(sim, 'get_positions'):
+        return {'positions': sim.get_positions()}
+    return {'particles': sim.particles}
+
+
+class Frame:
+    """A published ring slot held by a consumer until release()."""
+
+    def __init__(self, stepper, slot: int, seq: int, step: int, published: float, arrays: Dict[str, np.ndarray]):
+        self._stepper = stepper
+        self.slot = slot
+        self.seq = seq              # Frames published before this one
+        self.step = step            # Simulation steps taken when it was copied
+        self.published = published  # time.perf_counter() at publication
+        self.arrays = arrays
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.arrays[name]
+
+    def release(self) -> None:
+        if self._stepper is not None:
+            self._stepper._release(self.slot)
+            self._stepper = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class AsyncStepper:
+    def __init__(self, sim, dt: float, n_buffers: int = 3, policy: str = 'drop', steps_per_frame: int = 1,
+                 rate: Optional[float] = None, extract: Callable[[Any], Dict[str, np.ndarray]] = default_extract,
+                 keep_samples: int = 4096):
+        """
+        sim is stepped by dt, steps_per_frame times per published frame. extract(sim) returns the arrays
+        copied into each slot; the ring is preallocated from its first result. rate (frames/s) paces
+        the 'decouple' policy. The last keep_samples latencies and queue depths are kept for metrics().
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"unknown policy {policy!r}; use one of {', '.join(POLICIES)}")
+        if n_buffers < 2:
+            raise ValueError("n_buffers must be at least 2 (one being written, one readable)")
+        self.sim = sim
+        self.dt = dt
+        self.policy = policy
+        self.steps_per_frame = max(1, int(steps_per_frame))
+        self.rate = rate
+        self.extract = extract
+        self._step = sim.step if hasattr(sim, 'step') else sim.update
+
+        first = extract(sim)
+        self.slots = [{name: np.empty_like(np.asarray(a)) for name, a in first.items()} for _ in range(n_buffers)]
+        self._held = [0] * n_buffers          # Consumers holding each slot
+        self._seq = [-1] * n_buffers          # Published frame in each slot (-1: none)
+        self._slot_step = [0] * n_buffers
+        self._published = [0.0] * n_buffers
+        self._queue = deque()                 # Unread slots, oldest first
+        self._latest = None                   # Newest published slot
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stop = False
+        self._error = None
+        self.steps = 0
+
+        self._latency = deque(maxlen=keep_samples)
+        self._depth = deque(maxlen=keep_samples)
+        self._counts = {'produced': 0, 'consumed': 0, 'dropped': 0, 'skipped': 0}
+        self._step_time = 0.0
+        self._blocked_time = 0.0
+        self._started = None
+
+    @property
+    def n_buffers(self) -> int:
+        return len(self.slots)
+
+    # --- Producer ---
+
+    def start(self) -> 'AsyncStepper':
+        if self._thread is None:
+            self._stop = False
+            self._started = time.perf_counter()
+            self._thread = threading.Thread(target=self._produce, daemon=True, name="AsyncStepper")
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stops the producer after its current frame; frames already published stay readable."""
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _acquire_slot(self) -> Optional[int]:
+        """A slot that no consumer holds and nobody can still read, or None once stopped."""
+        with self._cond:
+            t0 = time.perf_counter()
+            while not self._stop:
+                unread = set(self._queue)
+                for i in range(self.n_buffers):
+                    if not self._held[i] and i != self._latest and i not in unread:
+                        self._blocked_time += time.perf_counter() - t0
+                        return i
+                if self.policy != 'block':
+                    # Recycle the oldest unread frame that no consumer holds
+                    for i in self._queue:
+                        if not self._held[i] and i != self._latest:
+                            self._queue.remove(i)
+                            self._counts['dropped' if self.policy == 'drop' else 'skipped'] += 1
+                            self._blocked_time += time.perf_counter() - t0
+                            return i
+                self._cond.wait()
+            return None
+
+    def _produce(self) -> None:
+        period = 1.0 / self.rate if self.policy == 'decouple' and self.rate else 0.0
+        deadline = time.perf_counter()
+        try:
+            while True:
+                slot = self._acquire_slot()
+                if slot is None:
+                    return
+                t0 = time.perf_counter()
+                for _ in range(self.steps_per_frame):
+                    self._step(self.dt)
+                self.steps += self.steps_per_frame
+                for name, a in self.extract(self.sim).items():
+                    np.copyto(self.slots[slot][name], a)
+                now = time.perf_counter()
+                self._step_time += now - t0
+                with self._cond:
+                    self._seq[slot] = self._counts['produced']
+                    self._slot_step[slot] = self.steps
+                    self._published[slot] = now
+                    self._counts['produced'] += 1
+                    self._queue.append(slot)
+                    self._latest = slot
+                    self._depth.append(len(self._queue))
+                    self._cond.notify_all()
+                if period:
+                    deadline = max(deadline + period, now - period) # Do not burst to catch up
+                    delay = deadline - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+        except BaseException as e:
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
+
+    # --- Consumers ---
+
+    def _take(self, slot: int) -> Frame:
+        self._held[slot] += 1
+        return Frame(self, slot, self._seq[slot], self._slot_step[slot], self._published[slot], self.slots[slot])
+
+    def _consume(self, slot: int, now: float) -> None:
+        self._counts['consumed'] += 1
+        self._latency.append(now - self._published[slot])
+
+    def _wait(self, ready: Callable[[], bool], timeout: Optional[float]) -> bool:
+        end = None if timeout is None else time.perf_counter() + timeout
+        while not ready():
+            if self._error is not None:
+                raise self._error
+            if self._stop:
+                return False
+            remaining = None if end is None else end - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                return False
+            self._cond.wait(remaining)
+        return True
+
+    def next(self, timeout: Optional[float] = None) -> Optional[Frame]:
+        """The oldest unread frame, waiting up to timeout seconds for one; None on timeout or when stopped."""
+        with self._cond:
+            if not self._wait(lambda: bool(self._queue), timeout):
+                return None
+            slot = self._queue.popleft()
+            now = time.perf_counter()
+            self._consume(slot, now)
+            self._depth.append(len(self._queue))
+            self._cond.notify_all()
+            return self._take(slot)
+
+    def latest(self, timeout: Optional[float] = None) -> Optional[Frame]:
+        """
+        The newest published frame, marking older unread ones as skipped. Returns the same frame again
+        (same seq) if nothing new was published; waits up to timeout only for the very first frame.
+        """
+        with self._cond:
+            if not self._wait(lambda: self._latest is not None, timeout):
+                return None
+            now = time.perf_counter()
+            if self._queue:
+                self._counts['skipped'] += len(self._queue) - 1
+                self._consume(self._queue[-1], now)
+                self._queue.clear()
+                self._depth.append(0)
+                self._cond.notify_all()
+            return self._take(self._latest)
+
+    def _release(self, slot: int) -> None:
+        with self._cond:
+            self._held[slot] -= 1
+            self._cond.notify_all()
+
+    async def next_async(self, timeout: Optional[float] = None) -> Optional[Frame]:
+        """next() without blocking the event loop."""
+        return await asyncio.to_thread(self.next, timeout)
+
+    async def latest_async(self, timeout: Optional[float] = None) -> Optional[Frame]:
+        return await asyncio.to_thread(self.latest, timeout)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Frame:
+        frame = await self.next_async()
+        if frame is None:
+            raise StopAsyncIteration
+        return frame
+
+    def metrics(self) -> Dict[str, Any]:
+        """Counts, rates, queue depth and publish-to-consume latency (ms) so far."""
+        with self._cond:
+            elapsed = max(time.perf_counter() - self._started, 1e-9) if self._started else 0.0
+            lat = np.array(self._latency) * 1e3
+            depth = np.array(self._depth)
+            produced = self._counts['produced']
+            out = {**self._counts, 'policy': self.policy, 'n_buffers': self.n_buffers,
+                   'queue_depth': len(self._queue),
+                   'max_queue_depth': int(depth.max()) if depth.size else 0,
+                   'mean_queue_depth': float(depth.mean()) if depth.size else 0.0,
+                   'producer_fps': produced / elapsed if elapsed else 0.0,
+                   'consumer_fps': self._counts['consumed'] / elapsed if elapsed else 0.0,
+                   'frame_ms': self._step_time / produced * 1e3 if produced else 0.0,
+                   'producer_blocked_s': self._blocked_time}
+            if lat.size:
+                p50, p95, p99 = np.percentile(lat, (50, 95, 99))
+                out['latency_ms'] = {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(lat.max())}
+            return out
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
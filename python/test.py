@@ -1,36 +1,307 @@
 # coulomb.py
 import numpy as np
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
+
+# Slots ahead of the interleaved (x, y, ke) particle data in the frame buffer.
+# Slot 0 holds the frame counter modulo FRAME_COUNTER_WRAP: float32 represents every integer
+# only up to 2^24, so an unwrapped counter would stop changing after ~16.7M frames and the host's
+# "new frame?" check would go stale. self.frame_count keeps the exact count.
+FRAME_HEADER = 1
+FRAME_COUNTER_WRAP = 1 << 24
+
+def _catmull_rom_weights(t: np.ndarray) -> List[np.ndarray]:
+    """Cubic convolution weights for the 4 nodes at offsets -1, 0, 1, 2 around t in [0, 1)."""
+    t2 = t * t
+    t3 = t2 * t
+    return [0.5 * (-t3 + 2*t2 - t),
+            0.5 * (3*t3 - 5*t2 + 2),
+            0.5 * (-3*t3 + 4*t2 + t),
+            0.5 * (t3 - t2)]
+
+# Relative error left by subtracting one charge's field from a cached sum above which the
+# affected points are recomputed exactly instead (see Coulomb._patch_field)
+_EDIT_RTOL = 1e-5
+
+def _resize_rows(rows: np.ndarray, n: int) -> np.ndarray:
+    """
+    Returns a view of the first n rows of the buffer behind rows (or of rows itself if it owns its data),
+    doubling the buffer when it is too small so repeated appends cost amortized O(1).
+    """
+    buf = rows.base
+    if buf is None or buf.shape[1:] != rows.shape[1:] or buf.ctypes.data != rows.ctypes.data:
+        buf = rows
+    if buf.shape[0] < n:
+        grown = np.empty((max(n, 2 * buf.shape[0]),) + rows.shape[1:], dtype=rows.dtype)
+        grown[:rows.shape[0]] = rows
+        buf = grown
+    return buf[:n]
+
+def _apply_row_edit(rows: np.ndarray, row: int, new) -> np.ndarray:
+    """
+    Edits an (n, ...) prefix view in place and returns the new view: row == n appends new,
+    new None deletes the row by moving the last row into its place, otherwise the row is overwritten.
+    """
+    n = rows.shape[0]
+    if new is None:
+        rows[row] = rows[n - 1]
+        return rows[:n - 1]
+    if row == n:
+        rows = _resize_rows(rows, n + 1)
+    rows[row] = new
+    return rows
 
 class Coulomb:
     def __init__(self, width: float, height: float, params: Dict[str, Any]):
         self.width = width
         self.height = height
+        self.params = params
         self.k = float(params.get('charge_strength', 1000.0))
         self.epsilon = 1e-6
+        # 'list' returns a list-of-lists from update (compat), 'buffer' returns the frame buffer
+        self.export = str(params.get('export', 'list'))
+        # 'exact' sums every particle-charge pair each step; 'lattice' samples E from a cached
+        # grid of lattice_resolution nodes per axis ('bilinear' or 'bicubic'), O(N) per step
+        self.field_mode = str(params.get('field_mode', 'exact'))
+        res = params.get('lattice_resolution', 128)
+        self.lattice_shape = (int(res), int(res)) if np.isscalar(res) else (int(res[0]), int(res[1]))
+        if min(self.lattice_shape) < 2:
+            raise ValueError("lattice_resolution must be at least 2 nodes per axis")
+        self.interpolation = str(params.get('interpolation', 'bilinear'))
+        self._lattice = None
+        self._lattice_charges = None
+        # All state, the frame buffer and the lattice share one dtype (float32 by default)
+        self.dtype = np.dtype(params.get('dtype', 'float32'))
+        # Scratch buffers sized at construction; steady-state updates then run entirely in
+        # place (exact and bilinear lattice fields) and allocate no arrays
+        self.preallocate = bool(params.get('preallocate', False))
+        # 'euler' is semi-implicit Euler (the preallocated path only covers this one);
+        # 'verlet' is kick-drift-kick velocity Verlet / leapfrog
+        self.integrator = str(params.get('integrator', 'euler'))
+        # Verlet block time steps: each particle takes 2^l substeps (up to max_substeps, rounded
+        # up to a power of two) no longer than sqrt(2 * step_tolerance / |a|), i.e. the time to
+        # cover step_tolerance (distance units) from rest under its current acceleration
+        self.max_substeps = 1 << max(0, int(np.ceil(np.log2(max(1, int(params.get('max_substeps', 1)))))))
+        self.step_tolerance = float(params.get('step_tolerance', 0.002))
+        self.force_evals = 0  # Particle force evaluations in the last update
+        # Multi-core Euler step (sharded.py, imported on first use): `workers` threads each own a
+        # contiguous block of particles; matches the serial step bit-for-bit
+        self.workers = max(1, int(params.get('workers', 1)))
+        if self.workers > 1 and (self.integrator != 'euler' or self.preallocate):
+            raise ValueError("workers > 1 supports the 'euler' integrator without preallocate")
+        self._pool = None
+        self._shards = (None, None)
+
+        # Per-phase timers and counters (profiling.py, imported only when enabled); with None
+        # every hook is a single check
+        self.profiler = None
+        if params.get('profile', False):
+            import profiling
+            self.profiler = profiling.Profiler()
+        self._accel = None
+        self._accel_charges = None
 
         n_p = int(params.get('n_particles', 50))
         n_c = int(params.get('n_charges',    3))
-        rng = np.random.default_rng()
+        # Kept on the instance (and seedable) so checkpoints can save and restore its state
+        self.rng = rng = np.random.default_rng(params.get('seed'))
+
+        # The charges are the first n_c rows of a growable buffer (room for charge_capacity before it
+        # doubles), with a stable ID per charge for add_charge/update_charge/remove_charge.
+        # _charge_ids[i] is the ID of charges[i]; _charge_slot maps an ID back to its row
+        self._charge_buf = np.empty((max(n_c, int(params.get('charge_capacity', 0))),3), dtype=self.dtype)
+        self.charges = self._charge_buf[:n_c]
+        self._charge_ids = np.arange(n_c, dtype=np.int64)
+        self._charge_slot = {i: i for i in range(n_c)}
+        self._next_charge_id = n_c
+        self.charges[:,:2] = rng.uniform([0,0], [width, height], size=(n_c,2))
+        self.charges[:,2] = rng.choice([-1.0,1.0], size=n_c)
 
-        self.charges = rng.uniform([0,0], [width, height], size=(n_c,2)).astype(np.float32)
-        signs = rng.choice([-1.0,1.0], size=n_c).astype(np.float32)
-        self.charges = np.hstack([self.charges, signs[:,None]])
+        # particles is a view into the frame buffer, so stepping writes the exported frame in place
+        self.frame = np.zeros(FRAME_HEADER + n_p*3, dtype=self.dtype)
+        self.frame_count = 0
+        self.particles = self.frame[FRAME_HEADER:].reshape(n_p, 3)
+        self.particles[:,:2] = rng.uniform([0,0], [width, height], size=(n_p,2))
+        self.velocities = np.zeros((n_p,2), dtype=self.dtype)
 
-        self.particles  = rng.uniform([0,0], [width, height], size=(n_p,2)).astype(np.float32)
-        self.particles = np.hstack([self.particles, np.zeros((n_p,1), dtype=np.float32)])
-        self.velocities = np.zeros((n_p,2), dtype=np.float32)
+        self._ws = None
+        if self.preallocate:
+            self._allocate_workspace()
 
     def get_charges(self) -> List[List[float]]:
         return [[float(x), float(y), float(q)] for x,y,q in self.charges]
 
-    def update(self, dt: float) -> List[List[float]]:
-        if self.particles.shape[0] == 0:
-            return []
+    def get_charges_buffer(self) -> np.ndarray:
+        """Contiguous (n_c, 3) array of (x, y, q) in self.dtype; wrap with getBuffer('f32') on the host."""
+        return self.charges
+
+    def charge_ids(self) -> np.ndarray:
+        """IDs of the charges in row order (charges[i] has ID charge_ids()[i]); deletions reorder rows."""
+        return self._charge_ids
+
+    def set_charges(self, charges: np.ndarray, ids: Optional[np.ndarray] = None) -> None:
+        """Replaces every charge with the (M, 3) rows of charges, IDed 0..M-1 unless ids are given."""
+        charges = np.array(charges, dtype=self.dtype).reshape(-1, 3)
+        n = charges.shape[0]
+        ids = np.arange(n, dtype=np.int64) if ids is None else np.array(ids, dtype=np.int64).reshape(n)
+        if np.unique(ids).shape[0] != n:
+            raise ValueError("charge IDs must be unique")
+        if self._charge_buf.shape[0] < n:
+            self._charge_buf = np.empty((n, 3), dtype=self.dtype)
+        self.charges = self._charge_buf[:n]
+        self.charges[:] = charges
+        self._charge_ids = ids
+        self._charge_slot = {int(i): row for row, i in enumerate(ids)}
+        self._next_charge_id = int(ids.max()) + 1 if n else 0
+        self.invalidate_field()
+
+    def add_charge(self, x: float, y: float, q: float) -> int:
+        """Adds a charge and returns its ID. Amortized O(1) plus the cache patch (see _edit_charge)."""
+        self._sync_charge_store()
+        charge_id = self._next_charge_id
+        self._next_charge_id += 1
+        n = self.charges.shape[0]
+        self._charge_ids = _apply_row_edit(self._charge_ids, n, charge_id)
+        self._charge_slot[charge_id] = n
+        self._edit_charge(n, np.array([x, y, q], dtype=self.dtype))
+        return charge_id
+
+    def update_charge(self, charge_id: int, x: Optional[float] = None, y: Optional[float] = None,
+                      q: Optional[float] = None) -> None:
+        """Moves and/or recharges a charge; arguments left as None keep their value."""
+        self._sync_charge_store()
+        row = self._charge_row(charge_id)
+        new = self.charges[row].copy()
+        for i, value in enumerate((x, y, q)):
+            if value is not None:
+                new[i] = value
+        self._edit_charge(row, new)
+
+    def remove_charge(self, charge_id: int) -> None:
+        """Deletes a charge; the last row moves into its place, so other IDs keep their charges."""
+        self._sync_charge_store()
+        row = self._charge_row(charge_id)
+        del self._charge_slot[charge_id]
+        last = self.charges.shape[0] - 1
+        if row != last:
+            self._charge_slot[int(self._charge_ids[last])] = row
+        self._charge_ids = _apply_row_edit(self._charge_ids, row, None)
+        self._edit_charge(row, None)
+
+    def _charge_row(self, charge_id: int) -> int:
+        row = self._charge_slot.get(charge_id)
+        if row is None:
+            raise KeyError(f"no charge with ID {charge_id}")
+        return row
+
+    def _sync_charge_store(self) -> None:
+        # self.charges replaced by another array (rather than edited in place): adopt it, with new IDs
+        if (self.charges.base is not self._charge_buf or self.charges.ctypes.data != self._charge_buf.ctypes.data
+                or self._charge_ids.shape[0] != self.charges.shape[0]):
+            self.set_charges(self.charges)
 
-        p_xy = self.particles[:,:2][:,None,:]  # (n_p,1,2)
-        c_xy = self.charges[:,:2][None,:,:]    # (1,n_c,2)
-        c_q  = self.charges[:,2][None,:]       # (1,n_c)
+    def _edit_charge(self, row: int, new: Optional[np.ndarray]) -> None:
+        """
+        Applies one row edit (see _apply_row_edit) to self.charges and patches the caches derived from
+        them instead of dropping them. The lattice (when built) gets the edited charge's field change at
+        every node: O(nodes) whatever the charge count, where a rebuild is O(M nodes). Only the nodes
+        _patch_field finds noisy are recomputed from all charges. Verlet accelerations are patched the
+        same way (exact field, O(N)) or resampled from the lattice. Each cache's copy of the charges
+        gets the same edit, so _ensure_lattice and _step_verlet see them as current.
+        Caches already stale from in-place edits of self.charges are left for those checks to rebuild.
+        """
+        prof = self.profiler
+        t0 = prof.tic() if prof else 0.0
+        n = self.charges.shape[0]
+        self.charges = _apply_row_edit(self.charges, row, new)
+        self._charge_buf = self.charges.base
+
+        if self._lattice is not None and self._lattice_charges.shape[0] == n:
+            old = self._lattice_charges[row].copy() if row < n else None
+            self._lattice_charges = _apply_row_edit(self._lattice_charges, row, new)
+            self._charges_equal = _resize_rows(self._charges_equal, self.charges.shape[0])
+            self._patch_field(self._lattice, self._lattice_nodes, old, new)
+
+        if self._accel is not None and self._accel_charges.shape[0] == n:
+            old = self._accel_charges[row].copy() if row < n else None
+            self._accel_charges = _apply_row_edit(self._accel_charges, row, new)
+            if self.field_mode != 'lattice':
+                self._patch_field(self._accel, self.particles[:,:2], old, new)
+            elif self._lattice is not None:
+                self._accel = self.lattice_field(self.particles[:,:2])
+            else:
+                self._accel = None
+        if prof:
+            prof.toc('charge_edit', t0)
+            prof.count('charge_edits')
+
+    def _patch_field(self, field: np.ndarray, xy: np.ndarray, old: Optional[np.ndarray],
+                     new: Optional[np.ndarray]) -> None:
+        """
+        Adds charge new's field and subtracts charge old's (either may be None) at points xy (..., 2),
+        in place. Where the subtracted field dwarfs what is left (right next to the old charge, or near a
+        zero of the total field) rounding would leave mostly noise, so those points are recomputed exactly.
+        """
+        pts = xy.reshape(-1, 2)
+        delta = np.zeros(pts.shape, dtype=field.dtype)
+        removed = None
+        if old is not None:
+            removed = self.field_at(pts, old[None])
+            delta -= removed
+        if new is not None:
+            delta += self.field_at(pts, new[None])
+        field += delta.reshape(field.shape)
+        if removed is not None:
+            eps = np.finfo(field.dtype).eps
+            noisy = (eps * np.linalg.norm(removed, axis=1) > _EDIT_RTOL * np.linalg.norm(field.reshape(-1, 2), axis=1))
+            if noisy.any():
+                mask = noisy.reshape(field.shape[:-1])
+                field[mask] = self.field_at(xy[mask])
+
+    def get_frame(self) -> np.ndarray:
+        """
+        The preallocated frame buffer (self.dtype): [frame_count mod 2^24, x0, y0, ke0, x1, y1, ke1, ...].
+        The same array is reused across steps, so the host can hold a typed-array view of it.
+        """
+        return self.frame
+
+    def update(self, dt: float):
+        prof = self.profiler
+        if self.particles.shape[0] > 0:
+            self._step(dt)
+        self.frame_count += 1
+        self.frame[0] = self.frame_count % FRAME_COUNTER_WRAP
+
+        if prof is None:
+            return self.frame if self.export == 'buffer' else self._frame_list()
+        t0 = prof.tic()
+        if self.export == 'buffer':
+            out, nbytes = self.frame, self.frame.nbytes
+        else:
+            out = self._frame_list()
+            nbytes = 3 * len(out) * 8 # Python floats are doubles
+        prof.toc('export', t0)
+        prof.count('bytes_exported', nbytes)
+        if self.particles.shape[0] > 0:
+            self._count_pairs(prof)
+        prof.end_step()
+        return out
+
+    def _count_pairs(self, prof) -> None:
+        """Particle-charge pairs summed this step (exact), or lattice samples taken (lattice)."""
+        if self.field_mode == 'lattice':
+            prof.count('lattice_samples', self.force_evals)
+        else:
+            prof.count('pairs_tested', self.force_evals * self.charges.shape[0])
+
+    def _frame_list(self) -> List[List[float]]:
+        return [[float(x), float(y), float(k)] for x,y,k in self.particles.tolist()]
+
+    def field_at(self, xy: np.ndarray, charges: Optional[np.ndarray] = None) -> np.ndarray:
+        """Exact field (force on a unit particle) at points xy (P, 2) from all charges (or the given ones)."""
+        charges = self.charges if charges is None else charges
+        p_xy = xy[:,None,:]                    # (P,1,2)
+        c_xy = charges[:,:2][None,:,:]         # (1,n_c,2)
+        c_q  = charges[:,2][None,:]            # (1,n_c)
 
         disp = p_xy - c_xy
         dist_sq = np.sum(disp**2, axis=2)
@@ -39,7 +310,335 @@ class Coulomb:
         f_mag = self.k * c_q / np.maximum(dist_sq, self.epsilon)
         unit = disp / (dist[:,:,None] + self.epsilon)
         f_vec = f_mag[:,:,None] * unit
-        total_f = np.sum(f_vec, axis=1)
+        return np.sum(f_vec, axis=1)
+
+    def invalidate_field(self) -> None:
+        """Drops the cached field lattice and Verlet accelerations; both are rebuilt on next use."""
+        self._lattice = None
+        self._lattice_charges = None
+        self._accel = None
+
+    def energy(self) -> Dict[str, float]:
+        """Kinetic, potential (k q / r with the force's distance floor) and total energy."""
+        disp = self.particles[:,None,:2] - self.charges[None,:,:2]
+        dist = np.sqrt(np.maximum(np.sum(disp**2, axis=2), self.epsilon))
+        potential = float(np.sum(self.k * self.charges[:,2] / dist, dtype=np.float64))
+        kinetic = float(0.5 * np.sum(self.velocities**2, dtype=np.float64))
+        return {'kinetic': kinetic, 'potential': potential, 'total': kinetic + potential}
+
+    def _ensure_lattice(self) -> None:
+        # Rebuild whenever the charges differ from the ones the lattice was built for,
+        # including in-place edits of self.charges
+        if (self._lattice is not None and self._lattice_charges.shape == self.charges.shape
+                and np.equal(self._lattice_charges, self.charges, out=self._charges_equal).all()):
+            return
+        nx, ny = self.lattice_shape
+        hx, hy = self.width / (nx - 1), self.height / (ny - 1)
+        # One ghost node on each side so bicubic stencils at the border stay in range
+        gx = (np.arange(-1, nx + 1) * hx).astype(self.dtype)
+        gy = (np.arange(-1, ny + 1) * hy).astype(self.dtype)
+        nodes = np.stack(np.meshgrid(gx, gy), axis=-1).reshape(-1, 2)
+        self._lattice = self.field_at(nodes).astype(self.dtype).reshape(ny + 2, nx + 2, 2)
+        self._lattice_nodes = nodes.reshape(ny + 2, nx + 2, 2)
+        self._lattice_charges = self.charges.copy()
+        self._charges_equal = np.empty(self.charges.shape, dtype=bool)
+        self._lattice_flat = self._lattice.reshape(-1, 2)
+
+    def lattice_field(self, xy: np.ndarray) -> np.ndarray:
+        """Field at points xy interpolated from the cached lattice (built on first use)."""
+        self._ensure_lattice()
+        return self._sample_lattice(xy)
+
+    def _sample_lattice(self, xy: np.ndarray) -> np.ndarray:
+        """lattice_field without the rebuild check: only reads the lattice, so workers can share it."""
+        nx, ny = self.lattice_shape
+        fx = np.clip(xy[:,0] * ((nx - 1) / self.width), 0, nx - 1)
+        fy = np.clip(xy[:,1] * ((ny - 1) / self.height), 0, ny - 1)
+        ix = np.minimum(fx.astype(np.intp), nx - 2)
+        iy = np.minimum(fy.astype(np.intp), ny - 2)
+        tx = (fx - ix).astype(self.dtype)[:,None]
+        ty = (fy - iy).astype(self.dtype)[:,None]
+        lat = self._lattice
+        ix += 1 # Skip the ghost node
+        iy += 1
+
+        if self.interpolation == 'bicubic':
+            wx, wy = _catmull_rom_weights(tx), _catmull_rom_weights(ty)
+            e = np.zeros((xy.shape[0], 2), dtype=self.dtype)
+            for a in range(4):
+                row = np.zeros_like(e)
+                for b in range(4):
+                    row += wx[b] * lat[iy + a - 1, ix + b - 1]
+                e += wy[a] * row
+            return e
+
+        return ((1 - ty) * ((1 - tx) * lat[iy, ix] + tx * lat[iy, ix + 1])
+                + ty * ((1 - tx) * lat[iy + 1, ix] + tx * lat[iy + 1, ix + 1]))
+
+    def lattice_error(self, n_samples: int = 20000, seed: int = 0) -> Dict[str, float]:
+        """
+        Relative error |E_lattice - E_exact| / |E_exact| at uniformly random points,
+        summarized as percentiles to help pick lattice_resolution.
+        """
+        rng = np.random.default_rng(seed)
+        xy = rng.uniform([0,0], [self.width, self.height], size=(n_samples,2)).astype(self.dtype)
+        exact = self.field_at(xy)
+        err = np.linalg.norm(self.lattice_field(xy) - exact, axis=1) / np.maximum(np.linalg.norm(exact, axis=1), 1e-30)
+        return {'median': float(np.median(err)), 'p95': float(np.percentile(err, 95)),
+                'p99': float(np.percentile(err, 99)), 'max': float(err.max())}
+
+    def _allocate_workspace(self) -> None:
+        """
+        (Re)allocates the scratch buffers for the charge buffer's capacity, so adding or removing
+        charges only rebinds views (_bind_workspace) until the charge buffer grows.
+        """
+        n_p, cap = self.particles.shape[0], max(self._charge_buf.shape[0], self.charges.shape[0])
+        dt = self.dtype
+        ws = {
+            'capacity': cap,
+            # Flat storage for the (n_p, n_c, ...) pair arrays; the contiguous prefix is viewed per n_c
+            'disp_buf': np.empty(n_p*cap*2, dtype=dt),
+            'sq_buf': np.empty(n_p*cap*2, dtype=dt),
+            'dist_sq_buf': np.empty(n_p*cap, dtype=dt),
+            'dist_buf': np.empty(n_p*cap, dtype=dt),
+            'kq_buf': np.empty(cap, dtype=dt),
+            'force': np.empty((n_p,2), dtype=dt),
+            'vec': np.empty((n_p,2), dtype=dt),
+            # Bilinear lattice sampling
+            'fx': np.empty(n_p, dtype=dt), 'fy': np.empty(n_p, dtype=dt),
+            'tx': np.empty(n_p, dtype=dt), 'ty': np.empty(n_p, dtype=dt),
+            'w': np.empty(n_p, dtype=dt),
+            'ix': np.empty(n_p, dtype=np.intp), 'iy': np.empty(n_p, dtype=np.intp),
+            'idx': np.empty(n_p, dtype=np.intp), 'corner_idx': np.empty(n_p, dtype=np.intp),
+        }
+        ws['p_xy'] = self.particles[:,:2][:,None,:]
+        ws['w_col'] = ws['w'][:,None]
+        ws['x'], ws['y'], ws['ke'] = self.particles[:,0], self.particles[:,1], self.particles[:,2]
+        ws['xy'] = self.particles[:,:2]
+        self._ws = ws
+        self._bind_workspace(ws)
+
+    def _bind_workspace(self, ws) -> None:
+        """Points the workspace's per-charge views at the current self.charges."""
+        n_p, n_c = self.particles.shape[0], self.charges.shape[0]
+        ws['charges'] = self.charges
+        ws['n_c'] = n_c
+        ws['disp'] = ws['disp_buf'][:n_p*n_c*2].reshape(n_p,n_c,2)
+        ws['sq'] = ws['sq_buf'][:n_p*n_c*2].reshape(n_p,n_c,2)
+        ws['dist_sq'] = ws['dist_sq_buf'][:n_p*n_c].reshape(n_p,n_c)
+        ws['dist'] = ws['dist_buf'][:n_p*n_c].reshape(n_p,n_c)
+        ws['kq'] = ws['kq_buf'][:n_c]
+        ws['c_xy'] = self.charges[:,:2][None,:,:]
+        ws['sq_x'], ws['sq_y'] = ws['sq'][:,:,0], ws['sq'][:,:,1]
+        ws['kq_row'] = ws['kq'][None,:]
+        ws['f_col'] = ws['dist'][:,:,None]
+
+    def _field_inplace(self, ws) -> np.ndarray:
+        """field_at(particles) written into ws['force'] without allocating."""
+        disp, dist_sq, dist = ws['disp'], ws['dist_sq'], ws['dist']
+        np.subtract(ws['p_xy'], ws['c_xy'], out=disp)
+        np.multiply(disp, disp, out=ws['sq'])
+        np.add(ws['sq_x'], ws['sq_y'], out=dist_sq)
+        np.maximum(dist_sq, self.epsilon, out=dist_sq)
+        np.sqrt(dist_sq, out=dist)
+        np.add(dist, self.epsilon, out=dist)
+        np.multiply(dist, dist_sq, out=dist)         # max(d^2, eps) * (d + eps)
+        np.multiply(self.charges[:,2], self.k, out=ws['kq'])
+        np.divide(ws['kq_row'], dist, out=dist)      # k q / (max(d^2, eps) * (d + eps))
+        np.multiply(disp, ws['f_col'], out=disp)
+        return np.sum(disp, axis=1, out=ws['force'])
+
+    def _lattice_inplace(self, ws) -> np.ndarray:
+        """Bilinear lattice_field(particles) written into ws['force'] without allocating."""
+        self._ensure_lattice()
+        nx, ny = self.lattice_shape
+        row = nx + 2
+        flat = self._lattice_flat
+        fx, fy, tx, ty, w = ws['fx'], ws['fy'], ws['tx'], ws['ty'], ws['w']
+        ix, iy, idx, corner_idx = ws['ix'], ws['iy'], ws['idx'], ws['corner_idx']
+        out, vec = ws['force'], ws['vec']
+
+        for f, t, i, coord, n, size in ((fx, tx, ix, ws['x'], nx, self.width), (fy, ty, iy, ws['y'], ny, self.height)):
+            np.multiply(coord, (n - 1) / size, out=f)
+            np.clip(f, 0, n - 1, out=f)
+            np.floor(f, out=t)
+            np.minimum(t, n - 2, out=t)
+            np.copyto(i, t, casting='unsafe')
+            np.subtract(f, t, out=t)
+
+        # Flat index of node (iy, ix), shifted past the ghost ring
+        np.multiply(iy, row, out=idx)
+        np.add(idx, ix, out=idx)
+        np.add(idx, row + 1, out=idx)
+
+        out.fill(0)
+        for offset, wx_far, wy_far in ((0, False, False), (1, True, False), (row, False, True), (row + 1, True, True)):
+            if wx_far:
+                np.copyto(w, tx)
+            else:
+                np.subtract(1, tx, out=w)
+            if wy_far:
+                np.multiply(w, ty, out=w)
+            else:
+                np.subtract(w, np.multiply(w, ty, out=fx), out=w) # w * (1 - ty); fx is free now
+            np.add(idx, offset, out=corner_idx)
+            np.take(flat, corner_idx, axis=0, out=vec, mode='clip') # 'raise' would buffer out
+            np.multiply(vec, ws['w_col'], out=vec)
+            np.add(out, vec, out=out)
+        return out
+
+    def _step_inplace(self, dt: float) -> None:
+        ws = self._ws
+        if ws is None or ws['capacity'] < self.charges.shape[0]:
+            self._allocate_workspace()
+            ws = self._ws
+        elif ws['charges'] is not self.charges: # Charges added, removed or replaced
+            self._bind_workspace(ws)
+        prof = self.profiler
+        t0 = prof.tic() if prof else 0.0
+        if self.field_mode == 'lattice' and self.interpolation == 'bilinear':
+            total_f = self._lattice_inplace(ws)
+        elif self.field_mode == 'lattice':
+            total_f = ws['force']
+            np.copyto(total_f, self.lattice_field(ws['xy'])) # Bicubic sampling still allocates
+        else:
+            total_f = self._field_inplace(ws)
+        if prof:
+            t0 = prof.toc('force', t0)
+
+        vel, vec = self.velocities, ws['vec']
+        if dt > 0:
+            np.multiply(total_f, dt, out=total_f)
+            np.add(vel, total_f, out=vel)
+            np.multiply(vel, dt, out=vec)
+            np.add(ws['xy'], vec, out=ws['xy'])
+            np.clip(ws['x'], 0, self.width, out=ws['x'])
+            np.clip(ws['y'], 0, self.height, out=ws['y'])
+
+        np.multiply(vel, vel, out=vec)
+        np.sum(vec, axis=1, out=ws['ke'])
+        np.multiply(ws['ke'], 0.5, out=ws['ke'])
+        if prof:
+            prof.toc('integrate', t0)
+
+    def _field(self, xy: np.ndarray) -> np.ndarray:
+        if self.field_mode == 'lattice':
+            return self.lattice_field(xy)
+        return self.field_at(xy)
+
+    def _substep_counts(self, dt: float, accel: np.ndarray) -> np.ndarray:
+        """Power-of-two substeps per particle from the |a| time step criterion."""
+        if self.max_substeps == 1:
+            return np.ones(accel.shape[0], dtype=np.intp)
+        a = np.maximum(np.sqrt(np.sum(accel.astype(np.float64)**2, axis=1)), 1e-30)
+        dt_i = np.sqrt(2 * self.step_tolerance / a)
+        level = np.ceil(np.log2(np.maximum(dt / dt_i, 1.0)))
+        return (1 << np.minimum(level, np.log2(self.max_substeps)).astype(np.intp))
+
+    def _step_verlet(self, dt: float, prof=None) -> float:
+        """Advances one step; returns the seconds spent in field evaluations when profiling (else 0)."""
+        xy, vel = self.particles[:,:2], self.velocities
+        force_time = 0.0
+        if (self._accel is None or self._accel_charges.shape != self.charges.shape
+                or not np.array_equal(self._accel_charges, self.charges)):
+            t0 = prof.tic() if prof else 0.0
+            self._accel = self._field(xy)
+            self._accel_charges = self.charges.copy()
+            if prof:
+                force_time += prof.tic() - t0
+        accel = self._accel
+        lo, hi = np.zeros(2, dtype=self.dtype), np.array([self.width, self.height], dtype=self.dtype)
+
+        # Particles only feel the fixed charges, so each one can take its own substeps independently.
+        # Slot s of max_substeps runs the particles whose (power of two) stride divides s, i.e. whose
+        # stride is at most the lowest set bit of s: a prefix of the particles sorted by stride
+        n_sub = self._substep_counts(dt, accel)
+        stride = self.max_substeps // n_sub
+        order = np.argsort(stride, kind='stable')
+        sorted_stride = stride[order]
+        h_all = (dt / n_sub).astype(self.dtype)[:,None]
+        self.force_evals = 0
+        for s in range(0, self.max_substeps, int(sorted_stride[0]) if stride.size else self.max_substeps):
+            act = order[:np.searchsorted(sorted_stride, s & -s, side='right')] if s else slice(None)
+            h = h_all[act]
+            v = vel[act] + 0.5 * h * accel[act]
+            p = np.clip(xy[act] + v * h, lo, hi)
+            t0 = prof.tic() if prof else 0.0
+            a = self._field(p)
+            if prof:
+                force_time += prof.tic() - t0
+            vel[act] = v + 0.5 * h * a
+            xy[act] = p
+            accel[act] = a
+            self.force_evals += a.shape[0]
+        return force_time
+
+    def _step_sharded(self, dt: float, prof=None) -> None:
+        """The Euler step of _step() over the worker pool; each worker owns a contiguous block of rows."""
+        import sharded
+        if self._pool is None:
+            self._pool = sharded.ShardPool(self.workers, owner=self)
+        n = self.particles.shape[0]
+        if self._shards[0] != n:
+            self._shards = (n, sharded.shard_bounds(n, self.workers))
+        bounds = self._shards[1]
+        if self.field_mode == 'lattice':
+            self._ensure_lattice() # Built once here, never concurrently by the workers
+        parts, vel = self.particles, self.velocities
+
+        def task(i, barrier):
+            lo, hi = bounds[i]
+            p = prof if i == 0 else None # Worker 0 reports the phase times
+            t0 = p.tic() if p else 0.0
+            xy = parts[lo:hi, :2]
+            total_f = self._sample_lattice(xy) if self.field_mode == 'lattice' else self.field_at(xy)
+            barrier() # Every force is in before any position moves
+            if p:
+                t0 = p.toc('force', t0)
+            v = vel[lo:hi]
+            if dt > 0:
+                v += total_f * dt
+                parts[lo:hi, :2] += v * dt
+                parts[lo:hi, 0] = np.clip(parts[lo:hi, 0], 0, self.width)
+                parts[lo:hi, 1] = np.clip(parts[lo:hi, 1], 0, self.height)
+            parts[lo:hi, 2] = (0.5 * np.sum(v**2, axis=1)).astype(self.dtype)
+            if p:
+                p.toc('integrate', t0)
+
+        self._pool.run(task)
+
+    def close(self) -> None:
+        """Stops the worker threads, if any (they also stop when the instance is collected)."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def _step(self, dt: float) -> None:
+        prof = self.profiler
+        if self.integrator == 'verlet':
+            t0 = prof.tic() if prof else 0.0
+            if dt > 0:
+                force_time = self._step_verlet(dt, prof)
+            else:
+                force_time, self.force_evals = 0.0, 0 # No substeps, no field evaluations
+            self.particles[:,2] = 0.5 * np.sum(self.velocities**2, axis=1)
+            if prof:
+                prof.add('force', force_time)
+                prof.add('integrate', prof.tic() - t0 - force_time)
+            return
+
+        self.force_evals = self.particles.shape[0]
+        if self.workers > 1:
+            self._step_sharded(dt, prof)
+            return
+        if self.preallocate:
+            self._step_inplace(dt)
+            return
+
+        t0 = prof.tic() if prof else 0.0
+        total_f = self._field(self.particles[:,:2])
+        if prof:
+            t0 = prof.toc('force', t0)
 
         if dt > 0:
             self.velocities += total_f * dt
@@ -48,6 +647,6 @@ class Coulomb:
             self.particles[:,1] = np.clip(self.particles[:,1], 0, self.height)
 
         ke = 0.5 * np.sum(self.velocities**2, axis=1)
-        self.particles[:,2] = ke.astype(np.float32)
-
-        return [[float(x), float(y), float(k)] for x,y,k in self.particles.tolist()]
\ No newline at end of file
+        self.particles[:,2] = ke.astype(self.dtype)
+        if prof:
+            prof.toc('integrate', t0)
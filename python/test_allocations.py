@@ -0,0 +1,44 @@
+import tracemalloc
+
+import pytest
+
+import main
+from test import Coulomb
+
+ENGINES = {
+    'test': lambda p: Coulomb(800, 600, {**p, 'export': 'buffer'}),
+    'main': lambda p: main.Coulomb(800, 600, p),
+    'main-tiled': lambda p: main.Coulomb(800, 600, {**p, 'force_mode': 'tiled', 'tile_bytes': 256 * 1024}),
+    'test-lattice': lambda p: Coulomb(800, 600, {**p, 'export': 'buffer', 'field_mode': 'lattice'}),
+}
+
+
+def _traced_steps(sim, steps=10, warmup=3, dt=0.01):
+    """(net growth, peak above baseline) in traced bytes over `steps` updates after a warm-up."""
+    for _ in range(warmup):
+        sim.update(dt)
+    tracemalloc.start()
+    try:
+        sim.update(dt)
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        for _ in range(steps):
+            sim.update(dt)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return current - base, peak - base
+
+
+@pytest.mark.parametrize('dtype', ['float64', 'float32'])
+@pytest.mark.parametrize('engine', sorted(ENGINES))
+def test_preallocated_step_does_not_allocate_per_particle(engine, dtype):
+    # NumPy keeps a fixed-size iterator buffer for broadcasting ufuncs, so the peak is not zero,
+    # but it must neither accumulate across steps nor scale with N
+    peaks = []
+    for n in (5_000, 50_000):
+        sim = ENGINES[engine]({'n_particles': n, 'n_charges': 20, 'dtype': dtype, 'preallocate': True})
+        growth, peak = _traced_steps(sim)
+        assert growth <= 4096, f"N={n}: {growth} B retained over the steps"
+        peaks.append(peak)
+    assert peaks[1] - peaks[0] <= 16 * 1024, f"peak grows with N: {peaks}"
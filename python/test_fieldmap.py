@@ -0,0 +1,32 @@
+import numpy as np
+
+import fieldmap
+
+
+def test_cell_keys_unique_at_max_depth():
+    depth = fieldmap.MAX_DEPTH
+    level = np.arange(depth + 1)
+    last = (1 << level) - 1
+    keys = np.concatenate([fieldmap._cell_keys(level, 0, 0, depth), fieldmap._cell_keys(level[1:], last[1:], last[1:], depth)])
+    assert (keys >= 0).all()
+    assert np.unique(keys).shape[0] == keys.shape[0]
+
+
+def test_locate_round_trips_at_max_depth():
+    # Without a distance floor or core, refinement chases the singularity down to max_depth
+    charges = np.array([[400.3, 300.7, 1.0]])
+    fm = fieldmap.adaptive_field_map(charges, 800, 600, epsilon=1e-30, tolerance=0.1, core_radius=0.0,
+                                     field_floor=1e3, max_depth=fieldmap.MAX_DEPTH, max_samples=20000)
+    assert fm.level.max() == fieldmap.MAX_DEPTH
+    # Leaf centres in float64 from the integer cell coordinates (float32 points cannot resolve them)
+    size = np.array([800.0, 600.0]) / 2.0 ** fm.level[:, None]
+    centres = (fm.cell_xy + 0.5) * size
+    np.testing.assert_array_equal(fm.locate(centres), np.arange(len(fm)))
+
+
+def test_max_depth_above_cap_rejected():
+    try:
+        fieldmap.adaptive_field_map(np.zeros((1, 3)), 800, 600, max_depth=fieldmap.MAX_DEPTH + 1)
+    except ValueError:
+        return
+    raise AssertionError("max_depth above MAX_DEPTH was accepted")
@@ -0,0 +1,422 @@
+"""
+Streaming trajectory files and checkpoints for the simulation engines.
+
+A file is a fixed preamble, a JSON header and a frame region:
+
+    magic (8 bytes) | header_bytes, n_frames, index_offset (3 x uint64 LE) | JSON header, space padded
+    frames: n_frames records of the header's record dtype, memory-mapped in place, or with
+            compression='zlib' chunks of up to chunk_frames records, each compressed on its own,
+            followed by an index of (offset, nbytes, n_records) uint64 triples at index_offset
+
+TrajectoryWriter preallocates the file for the expected number of frames and writes each
+recorded frame straight into the mapping (or into a one-chunk buffer when compressing).
+TrajectoryReader maps the file and slices frames without loading the rest; compressed
+files only decompress the chunks a slice touches.
+
+A checkpoint is the same format with a single record holding the engine's full state, and
+its scalars, RNG state and constructor params in the header. load_checkpoint rebuilds the
+simulation, which then resumes bit-for-bit where the saved one left off.
+
+Engines are recognized by class: test.Coulomb, main.Coulomb and octree.ParticleSimulationTaichi
+(Taichi is imported only when loading one of its checkpoints).
+"""
+import importlib
+import json
+import struct
+import zlib
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+MAGIC = b'WDTRAJ1\n'
+PREAMBLE = struct.Struct('<8sQQQ')  # magic, header_bytes, n_frames, index_offset
+HEADER_ALIGN = 4096
+INDEX_DTYPE = np.dtype('<u8')
+
+
+def _json_default(o):
+    if hasattr(o, 'tolist'):    # NumPy scalars and arrays
+        return o.tolist()
+    if hasattr(o, 'to_list'):   # Taichi vectors
+        return o.to_list()
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+
+def _record_dtype(fields) -> np.dtype:
+    """Little-endian structured dtype with one (sub)array per field, from [{name, dtype, shape}, ...]."""
+    return np.dtype([(f['name'], np.dtype(f['dtype']).newbyteorder('<'), tuple(f['shape'])) for f in fields])
+
+
+def _rng_state(rng: np.random.Generator) -> Dict[str, Any]:
+    return rng.bit_generator.state
+
+
+def _set_rng_state(sim, state: Dict[str, Any]) -> None:
+    if sim.rng.bit_generator.state['bit_generator'] != state['bit_generator']:
+        sim.rng = np.random.Generator(getattr(np.random, state['bit_generator'])())
+    sim.rng.bit_generator.state = state
+
+
+# --- Engine adapters ---
+# frame(sim)   -> arrays recorded per trajectory frame (caller-visible particle order)
+# state(sim)   -> (arrays, scalars): everything a checkpoint needs to resume bit-for-bit
+# restore(sim, arrays, scalars), create(params, scalars) -> a new instance to restore into
+
+class _TestCoulomb:
+    name = 'test.Coulomb'
+
+    @staticmethod
+    def frame(sim):
+        return {'frame_count': np.int64(sim.frame_count), 'particles': sim.particles, 'velocities': sim.velocities}
+
+    @staticmethod
+    def state(sim):
+        arrays = {'particles': sim.particles, 'velocities': sim.velocities, 'charges': sim.charges,
+                  'charge_ids': sim.charge_ids()}
+        if sim._accel is not None: # Verlet carries accelerations between steps
+            arrays['accel'] = sim._accel
+            arrays['accel_charges'] = sim._accel_charges
+        scalars = {'width': sim.width, 'height': sim.height, 'frame_count': sim.frame_count,
+                   'next_charge_id': sim._next_charge_id, 'rng': _rng_state(sim.rng)}
+        return arrays, scalars
+
+    @staticmethod
+    def create(params, scalars):
+        module = importlib.import_module('test')
+        return module.Coulomb(scalars['width'], scalars['height'], params)
+
+    @staticmethod
+    def restore(sim, arrays, scalars):
+        if sim.particles.shape != arrays['particles'].shape:
+            raise ValueError(f"checkpoint has {arrays['particles'].shape[0]} particles, simulation has {sim.particles.shape[0]}")
+        sim.particles[:] = arrays['particles']
+        sim.velocities[:] = arrays['velocities']
+        sim.set_charges(arrays['charges'], arrays.get('charge_ids'))
+        sim._next_charge_id = int(scalars.get('next_charge_id', sim._next_charge_id))
+        if 'accel' in arrays:
+            sim._accel = np.array(arrays['accel'], dtype=sim.dtype)
+            sim._accel_charges = np.array(arrays['accel_charges'], dtype=sim.dtype)
+        sim.frame_count = int(scalars['frame_count'])
+        sim.frame[0] = sim.frame_count % importlib.import_module('test').FRAME_COUNTER_WRAP
+        _set_rng_state(sim, scalars['rng'])
+
+
+class _MainCoulomb:
+    name = 'main.Coulomb'
+
+    @staticmethod
+    def frame(sim):
+        return {'particles': sim.particles, 'velocities': sim.velocities}
+
+    @staticmethod
+    def state(sim):
+        arrays = {'particles': sim.particles, 'velocities': sim.velocities, 'charges': sim.charges}
+        for name in ('accel', 'mutual_accel', 'accel_charges'):
+            value = getattr(sim, '_' + name)
+            if value is not None:
+                arrays[name] = value
+        return arrays, {'width': sim.width, 'height': sim.height, 'rng': _rng_state(sim.rng)}
+
+    @staticmethod
+    def create(params, scalars):
+        module = importlib.import_module('main')
+        return module.Coulomb(scalars['width'], scalars['height'], params)
+
+    @staticmethod
+    def restore(sim, arrays, scalars):
+        sim.particles = np.array(arrays['particles'], dtype=sim.dtype)
+        sim.velocities = np.array(arrays['velocities'], dtype=sim.dtype)
+        sim.charges = np.array(arrays['charges'], dtype=sim.dtype)
+        for name in ('accel', 'mutual_accel', 'accel_charges'):
+            setattr(sim, '_' + name, np.array(arrays[name], dtype=sim.dtype) if name in arrays else None)
+        _set_rng_state(sim, scalars['rng'])
+
+
+class _Taichi:
+    """
+    Storage-order fields are saved as they are, so a permuted layout and valid neighbor lists resume
+    unchanged. Kernels do not draw from Taichi's RNG after init_particles, so it is not saved.
+    """
+    name = 'octree.ParticleSimulationTaichi'
+    FIELDS = ('positions', 'velocities', 'forces', 'mass', 'particle_ext_ids')
+    LIST_FIELDS = ('neighbor_ids', 'neighbor_count', 'list_positions')
+
+    @staticmethod
+    def frame(sim):
+        return {'positions': sim.get_positions(), 'velocities': sim.get_velocities()}
+
+    @classmethod
+    def state(cls, sim):
+        names = cls.FIELDS + (cls.LIST_FIELDS if sim.neighbor_list else ())
+        arrays = {name: getattr(sim, name).to_numpy() for name in names}
+        scalars = {'step_count': sim.step_count, 'storage_permuted': sim.storage_permuted,
+                   'list_valid': sim.list_valid, 'list_pairs': int(sim.list_pairs),
+                   'neighbor_counters': sim.neighbor_counters,
+                   'interaction_radius': float(sim.interaction_radius[None]),
+                   'particle_radius': float(sim.particle_radius[None]),
+                   'gravity': sim.gravity[None].to_list()}
+        return arrays, scalars
+
+    @staticmethod
+    def create(params, scalars):
+        module = importlib.import_module('octree')
+        return module.ParticleSimulationTaichi(params)
+
+    @classmethod
+    def restore(cls, sim, arrays, scalars):
+        for name in cls.FIELDS + (cls.LIST_FIELDS if sim.neighbor_list else ()):
+            getattr(sim, name).from_numpy(np.ascontiguousarray(arrays[name]))
+        sim.step_count = int(scalars['step_count'])
+        sim.storage_permuted = bool(scalars['storage_permuted'])
+        sim.list_valid = bool(scalars['list_valid']) and sim.neighbor_list
+        sim.list_pairs = int(scalars['list_pairs'])
+        sim.neighbor_counters = dict(scalars['neighbor_counters'])
+        sim.interaction_radius[None] = scalars['interaction_radius']
+        sim.particle_radius[None] = scalars['particle_radius']
+        sim.gravity[None] = scalars['gravity']
+
+
+ENGINES = {e.name: e for e in (_TestCoulomb, _MainCoulomb, _Taichi)}
+
+
+def _engine(sim):
+    name = f"{type(sim).__module__}.{type(sim).__qualname__}"
+    if name not in ENGINES:
+        raise TypeError(f"no trajectory support for {name}; expected one of {', '.join(ENGINES)}")
+    return ENGINES[name]
+
+
+class TrajectoryWriter:
+    def __init__(self, path: str, fields: Dict[str, Tuple[tuple, Any]], n_frames: int = 1024,
+                 dt: Optional[float] = None, params: Optional[Dict[str, Any]] = None, stride: int = 1,
+                 compression: Optional[str] = None, chunk_frames: int = 64, meta: Optional[Dict[str, Any]] = None):
+        """
+        Creates `path` for records of `fields` (name -> (shape, dtype)), plus an int64 'step' field.
+
+        n_frames is the expected frame count: uncompressed files are preallocated for it and grow
+        by doubling if more frames arrive. record() keeps every stride-th call. compression='zlib'
+        compresses chunks of chunk_frames records. meta entries are merged into the JSON header.
+        """
+        if compression not in (None, 'zlib'):
+            raise ValueError(f"unknown compression {compression!r}; use None or 'zlib'")
+        self.path = path
+        self.stride = max(1, int(stride))
+        self.compression = compression
+        self.chunk_frames = max(1, int(chunk_frames))
+        self.n_frames = 0
+        self.calls = 0 # record() calls so far, including the ones skipped by the stride
+        self._engine = None # Set by for_simulation; record() needs it
+        field_list = [{'name': 'step', 'dtype': '<i8', 'shape': []}]
+        field_list += [{'name': name, 'dtype': np.dtype(dtype).newbyteorder('<').str, 'shape': list(shape)}
+                       for name, (shape, dtype) in fields.items()]
+        self.dtype = _record_dtype(field_list)
+        self.header = {'format': 1, 'kind': 'trajectory', **(meta or {}),
+                       'fields': field_list, 'record_bytes': self.dtype.itemsize,
+                       'dt': dt, 'stride': self.stride, 'params': params or {},
+                       'compression': compression, 'chunk_frames': self.chunk_frames}
+        text = json.dumps(self.header, default=_json_default).encode()
+        self.header_bytes = -(-(PREAMBLE.size + len(text)) // HEADER_ALIGN) * HEADER_ALIGN
+
+        self._file = open(path, 'w+b')
+        self._file.write(PREAMBLE.pack(MAGIC, self.header_bytes, 0, 0))
+        self._file.write(text.ljust(self.header_bytes - PREAMBLE.size))
+        self._map = None
+        if compression:
+            self._chunk = np.zeros(self.chunk_frames, dtype=self.dtype)
+            self._fill = 0            # Records in the current chunk
+            self._end = self.header_bytes
+            self._index = []
+        else:
+            self._capacity = 0
+            self._grow(max(1, int(n_frames)))
+
+    @classmethod
+    def for_simulation(cls, sim, path: str, n_frames: int = 1024, dt: Optional[float] = None,
+                       stride: int = 1, **kwargs) -> 'TrajectoryWriter':
+        """Writer whose record(sim) stores the engine's frame: positions, velocities (and frame counter)."""
+        engine = _engine(sim)
+        fields = {name: (np.shape(a), np.asarray(a).dtype) for name, a in engine.frame(sim).items()}
+        writer = cls(path, fields, n_frames=n_frames, dt=dt, params=getattr(sim, 'params', None), stride=stride,
+                     meta={'engine': engine.name}, **kwargs)
+        writer._engine = engine
+        return writer
+
+    def _grow(self, capacity: int) -> None:
+        self._map = None
+        self._file.truncate(self.header_bytes + capacity * self.dtype.itemsize)
+        self._map = np.memmap(self._file, dtype=self.dtype, mode='r+', offset=self.header_bytes, shape=(capacity,))
+        self._views = {name: self._map[name] for name in self.dtype.names}
+        self._capacity = capacity
+
+    def record(self, sim) -> bool:
+        """Counts one step of sim and appends its frame on every stride-th call; True if it was written."""
+        if self._engine is None:
+            raise TypeError("record() needs a writer from TrajectoryWriter.for_simulation; use append() otherwise")
+        self.calls += 1
+        if self.calls % self.stride:
+            return False
+        self.append(step=self.calls, **self._engine.frame(sim))
+        return True
+
+    def append(self, step: int = None, **arrays) -> None:
+        """Appends one record; arrays are copied into the file (or chunk buffer) field by field."""
+        if self.compression:
+            views, i = self._chunk, self._fill
+        else:
+            if self.n_frames == self._capacity:
+                self._grow(2 * self._capacity)
+            views, i = self._views, self.n_frames
+        views['step'][i] = self.n_frames if step is None else step
+        for name, value in arrays.items():
+            views[name][i] = value
+        self.n_frames += 1
+        if self.compression:
+            self._fill += 1
+            if self._fill == self.chunk_frames:
+                self._write_chunk()
+
+    def _write_chunk(self) -> None:
+        data = zlib.compress(self._chunk[:self._fill].tobytes(), 6)
+        self._file.seek(self._end)
+        self._file.write(data)
+        self._index.append((self._end, len(data), self._fill))
+        self._end += len(data)
+        self._fill = 0
+
+    def flush(self) -> None:
+        """
+        Makes everything appended so far readable (a partial compressed chunk becomes a short chunk).
+        Mapped frames already sit in the page cache, so this does not msync them to disk.
+        """
+        index_offset = 0
+        if self.compression:
+            if self._fill:
+                self._write_chunk()
+            self._file.seek(self._end)
+            self._file.write(np.array(self._index, dtype=INDEX_DTYPE).reshape(-1, 3).tobytes())
+            self._file.truncate()
+            index_offset = self._end
+        self._file.seek(0)
+        self._file.write(PREAMBLE.pack(MAGIC, self.header_bytes, self.n_frames, index_offset))
+        self._file.flush()
+
+    def close(self) -> None:
+        """Flushes and trims the preallocated space past the last frame."""
+        if self._file.closed:
+            return
+        self.flush()
+        if not self.compression:
+            self._map = self._views = None
+            self._file.truncate(self.header_bytes + self.n_frames * self.dtype.itemsize)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TrajectoryReader:
+    def __init__(self, path: str):
+        """Opens a trajectory or checkpoint; frames are only read when sliced."""
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, header_bytes, self.n_frames, index_offset = PREAMBLE.unpack(f.read(PREAMBLE.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a trajectory file")
+            self.header = json.loads(f.read(header_bytes - PREAMBLE.size))
+            if self.header['compression']:
+                f.seek(index_offset)
+                self._index = np.frombuffer(f.read(), dtype=INDEX_DTYPE).reshape(-1, 3).astype(np.int64)
+        self.dtype = _record_dtype(self.header['fields'])
+        self._frames = None
+        self._cached_chunk = (-1, None)
+        if self.header['compression']:
+            self._starts = np.concatenate(([0], np.cumsum(self._index[:, 2])))
+        elif self.n_frames:
+            self._frames = np.memmap(path, dtype=self.dtype, mode='r', offset=header_bytes, shape=(self.n_frames,))
+        else:
+            self._frames = np.zeros(0, dtype=self.dtype)
+
+    @property
+    def fields(self):
+        return self.dtype.names
+
+    def __len__(self) -> int:
+        return self.n_frames
+
+    def __getitem__(self, key):
+        """
+        reader[name] is a lazily mapped (n_frames, *shape) array (decompressed in full when compressed);
+        reader[i], reader[a:b:s] or reader[index_array] return structured records.
+        """
+        if isinstance(key, str):
+            if self._frames is not None:
+                return self._frames[key]
+            return self[:][key]
+        if self._frames is not None:
+            return self._frames[key]
+        idx = np.arange(self.n_frames)[key]
+        scalar = np.ndim(idx) == 0
+        idx = np.atleast_1d(idx)
+        out = np.empty(idx.shape[0], dtype=self.dtype)
+        chunk_of = np.searchsorted(self._starts, idx, side='right') - 1
+        for c in np.unique(chunk_of):
+            sel = chunk_of == c
+            out[sel] = self._chunk(int(c))[idx[sel] - self._starts[c]]
+        return out[0] if scalar else out
+
+    def _chunk(self, c: int) -> np.ndarray:
+        if self._cached_chunk[0] != c:
+            offset, nbytes, _ = self._index[c]
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                data = zlib.decompress(f.read(nbytes))
+            self._cached_chunk = (c, np.frombuffer(data, dtype=self.dtype))
+        return self._cached_chunk[1]
+
+    def close(self) -> None:
+        self._frames = None
+        self._cached_chunk = (-1, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def save_checkpoint(sim, path: str, compression: Optional[str] = None) -> None:
+    """Writes the full state of sim (arrays, scalars, RNG state and params) as a one-record file."""
+    engine = _engine(sim)
+    arrays, scalars = engine.state(sim)
+    fields = {name: (a.shape, a.dtype) for name, a in arrays.items()}
+    meta = {'kind': 'checkpoint', 'engine': engine.name, 'state': scalars}
+    with TrajectoryWriter(path, fields, n_frames=1, params=getattr(sim, 'params', None),
+                          compression=compression, meta=meta) as writer:
+        writer.append(step=0, **arrays)
+
+
+def load_checkpoint(path: str, sim=None):
+    """
+    Restores a checkpoint into sim, or into a new instance built from the saved params when sim is None.
+    Returns the simulation.
+    """
+    with TrajectoryReader(path) as reader:
+        header = reader.header
+        if header.get('kind') != 'checkpoint':
+            raise ValueError(f"{path} is a {header.get('kind')}, not a checkpoint")
+        engine = ENGINES[header['engine']]
+        record = reader[0]
+        arrays = {name: np.array(record[name]) for name in reader.fields if name != 'step'}
+        if sim is None:
+            params = dict(header['params'])
+            if 'particles' in arrays: # Coulomb engines size their arrays from params
+                params['n_particles'] = arrays['particles'].shape[0]
+                params['n_charges'] = arrays['charges'].shape[0]
+            sim = engine.create(params, header['state'])
+        elif _engine(sim) is not engine:
+            raise TypeError(f"checkpoint is for {engine.name}, not {_engine(sim).name}")
+        engine.restore(sim, arrays, header['state'])
+    return sim